@@ -43,7 +43,7 @@ class InsertAffinitiesBase(luigi.Task):
     def default_task_config():
         config = LocalTask.default_task_config()
         config.update({'erode_by': 6, 'zero_objects_list': None,
-                       'chunks': None})
+                       'chunks': None, 'chunk_cache_size': 0})
         return config
 
     def requires(self):
@@ -211,8 +211,11 @@ def insert_affinities(job_id, config_path):
     block_list = config['block_list']
     block_shape = config['block_shape']
     offsets = config['offsets']
+    # the blocks are read with a halo, so we cache the chunks of the input
+    cache_size = config.get('chunk_cache_size', 0)
 
-    with vu.file_reader(input_path) as f_in, vu.file_reader(output_path) as f_out,\
+    with vu.file_reader(input_path, cache_size=cache_size) as f_in,\
+            vu.file_reader(output_path) as f_out,\
             vu.file_reader(objects_path) as f_obj:
         ds_in = f_in[input_key]
         ds_out = f_out[output_key]
@@ -226,6 +229,8 @@ def insert_affinities(job_id, config_path):
         [_insert_affinities_block(block_id, blocking, ds_in, ds_out, objects, offsets,
                                   erode_by, zero_objects_list)
          for block_id in block_list]
+        if cache_size > 0:
+            fu.log(f_in.cache.summary())
 
     fu.log_job_success(job_id)
 
@@ -1,9 +1,14 @@
 import os
+import sys
 import shutil
 import stat
 import json
 import time
 import fileinput
+import importlib
+import importlib.util
+import multiprocessing
+import traceback
 from concurrent import futures
 from subprocess import call, check_output, CalledProcessError, STDOUT
 from datetime import datetime, timedelta
@@ -12,7 +17,11 @@ from multiprocessing import cpu_count
 import numpy as np
 import luigi
 
-from .utils.parse_utils import parse_blocks_task, parse_job, parse_job_lsf
+from .utils import function_utils as fu
+from .utils.parse_utils import (parse_blocks_task, parse_job, parse_job_lsf,
+                                read_ledgers_task, parse_jobs_ledger, parse_blocks_ledger,
+                                parse_runtimes_ledger, profile_summary)
+from .utils.partition_utils import partition_blocks
 from .utils.task_utils import DummyTask
 
 
@@ -114,8 +123,17 @@ class BaseClusterTask(luigi.Task):
         """
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
                                                                         job_prefix)
-        log_prefix = os.path.join(self.tmp_folder, 'logs', '%s_' % job_name)
-        success_list = self.parse_jobs(log_prefix, n_jobs)
+        # check the job ledgers and fall back to parsing the logs if we don't have any
+        ledger_prefix = os.path.join(self.tmp_folder, 'ledgers', '%s_' % job_name)
+        ledgers = read_ledgers_task(ledger_prefix, n_jobs)
+        if ledgers is None:
+            log_prefix = os.path.join(self.tmp_folder, 'logs', '%s_' % job_name)
+            success_list = self.parse_jobs(log_prefix, n_jobs)
+        else:
+            success_list = parse_jobs_ledger(ledgers)
+
+        if ledgers is not None:
+            self._write_profile(ledgers, job_name)
 
         if len(success_list) == n_jobs:
             self._write_log("%s finished successfully" % self.task_name)
@@ -134,7 +152,7 @@ class BaseClusterTask(luigi.Task):
             retry = retry and len(failed_jobs) / n_jobs < 0.5
 
             if retry:
-                failed_blocks = self.get_failed_blocks(n_jobs, success_list, job_prefix)
+                failed_blocks = self.get_failed_blocks(n_jobs, success_list, job_prefix, ledgers)
                 self._write_log("resubmitting %i failed blocks in %i retry attempt" % (len(failed_blocks),
                                                                                        self.n_retries + 1))
                 self.n_retries += 1
@@ -150,21 +168,48 @@ class BaseClusterTask(luigi.Task):
                                                                             len(failed_jobs),
                                                                             n_jobs))
 
-    def get_failed_blocks(self, n_jobs, passed_jobs=[], job_prefix=None):
-        """ Parse the log of failed jobs to find the ids of all blocks that have failed.
+    def _write_profile(self, ledgers, job_name):
+        """ Write the summary of the block profiles to 'tmp_folder/job_name_profile.json'
+        """
+        summary = profile_summary(ledgers)
+        if summary is None:
+            return
+        profile_path = os.path.join(self.tmp_folder, '%s_profile.json' % job_name)
+        with open(profile_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        self._write_log("block times for %i blocks: total %f s, median %f s, max %f s" %
+                        (summary['n_blocks'], summary['total_block_time'],
+                         summary['block_time_percentiles']['50'], summary['max_block_time']))
+        self._write_log("read: %f s, compute: %f s, write: %f s, written profile to %s" %
+                        (summary['read_time'], summary['compute_time'],
+                         summary['write_time'], profile_path))
+
+    def get_failed_blocks(self, n_jobs, passed_jobs=[], job_prefix=None, ledgers=None):
+        """ Find the ids of all blocks that have failed from the job ledgers,
+            or from the logs of failed jobs if we don't have ledgers.
         """
-        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
-                                                                        job_prefix)
         # for the jobs that have completely passed, we can add the block list from the config
+        # (not all tasks log the success of individual blocks);
+        # with a block queue, the block list is only the partition the job started with
+        # and its blocks may have been claimed by a failed job, so we only use the logged blocks
         passed_blocks = []
-        for job_id in passed_blocks:
+        complete_jobs = []
+        for job_id in passed_jobs:
             config_path = self._config_path(job_id, job_prefix)
             with open(config_path, 'r') as f:
-                passed_blocks.extend(json.load(f)['block_list'])
-
-        # for the failed jobs, we parse the output logs
-        log_prefix = os.path.join(self.tmp_folder, 'logs', '%s_' % job_name)
-        passed_blocks.extend(parse_blocks_task(log_prefix, n_jobs, passed_jobs))
+                job_config = json.load(f)
+            if job_config.get('block_queue', None) is None:
+                passed_blocks.extend(job_config['block_list'])
+                complete_jobs.append(job_id)
+
+        # for the other jobs, we parse the ledgers or the output logs
+        if ledgers is None:
+            job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                            job_prefix)
+            log_prefix = os.path.join(self.tmp_folder, 'logs', '%s_' % job_name)
+            passed_blocks.extend(parse_blocks_task(log_prefix, n_jobs, complete_jobs))
+        else:
+            passed_blocks.extend(parse_blocks_ledger(ledgers))
 
         # return the list of failed blocks
         return list(set(self.block_list) - set(passed_blocks))
@@ -220,7 +265,13 @@ class BaseClusterTask(luigi.Task):
                 "roi_end": None,
                 "groupname": "kreshuk",
                 "max_num_retries": 0,
-                "block_list_path": None}
+                "block_list_path": None,
+                "block_partitioning": "round_robin",
+                "block_queue": False,
+                "block_queue_batch_size": 4,
+                "local_executor": "subprocess",
+                "poll_interval": 10,
+                "max_poll_interval": 120}
 
     def global_config_values(self, with_block_list_path=False):
         """ Load the global config values that are needed
@@ -242,6 +293,26 @@ class BaseClusterTask(luigi.Task):
         """
         pass
 
+    def get_block_costs(self, block_list, job_prefix=None):
+        """ Estimate the cost of processing the blocks, used to balance
+        the blocks between jobs if 'block_partitioning' is 'balanced' or 'lpt'.
+
+        The base implementation returns the runtimes from the job ledgers of a previous
+        run of this task, or None if there are none. Blocks without runtime get the median cost.
+        Over-ride in deriving classes to provide a task specific estimate, e.g. from a mask.
+        """
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        runtimes = parse_runtimes_ledger(os.path.join(self.tmp_folder, 'ledgers'), job_name)
+        if runtimes is None:
+            return None
+        block_ids, block_runtimes = runtimes
+        costs = np.full(len(block_list), np.median(block_runtimes), dtype='float64')
+        block_list = np.array(block_list)
+        have_runtime = np.isin(block_list, block_ids)
+        costs[have_runtime] = block_runtimes[np.searchsorted(block_ids, block_list[have_runtime])]
+        return costs
+
     # part of the luigi API
     def output(self):
         return luigi.LocalTarget(os.path.join(self.tmp_folder, self.task_name + '.log'))
@@ -269,6 +340,16 @@ class BaseClusterTask(luigi.Task):
         with open(log_file, 'a') as f:
             f.write('%s: %s\n' % (str(datetime.now()), msg))
 
+    def _ledger_path(self, job_id, job_prefix=None):
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        return os.path.join(self.tmp_folder, 'ledgers', '%s_%s.ledger' % (job_name, str(job_id)))
+
+    def _ledger_env(self, job_id, job_prefix=None):
+        """ Environment assignment passing the ledger path to a job
+        """
+        return '%s=%s' % (fu.LEDGER_ENV, self._ledger_path(job_id, job_prefix))
+
     def _config_path(self, job_id, job_prefix=None):
         if job_prefix is None:
             return os.path.join(self.tmp_folder, self.task_name + '_job_%s.config' % str(job_id))
@@ -287,6 +368,7 @@ class BaseClusterTask(luigi.Task):
         mkdir(self.tmp_folder)
         mkdir(os.path.join(self.tmp_folder, 'logs'))
         mkdir(os.path.join(self.tmp_folder, 'error_logs'))
+        mkdir(os.path.join(self.tmp_folder, 'ledgers'))
         self._write_log('created tmp-folder and log dirs @ %s' % self.tmp_folder)
 
     def _write_single_job_config(self, config, job_prefix):
@@ -296,40 +378,64 @@ class BaseClusterTask(luigi.Task):
 
     def _write_multiple_job_configs(self, n_jobs, block_list, config, job_prefix,
                                     consecutive_blocks):
-
-        # TODO there must be a more elegant way of doing this
+        # if `consecutive_blocks` is true, we keep the block_ids in the jobs consecutive,
+        # otherwise we use the partitioning from the global config
+        global_config = self.get_global_config()
+        method = global_config.get('block_partitioning', 'round_robin')
         if consecutive_blocks:
-            # distribute blocks to jobs as equal as possible
-            blocks_per_job = np.zeros(n_jobs, dtype='uint32')
-            block_count = len(block_list)
-            job_id = 0
-            while block_count > 0:
-                blocks_per_job[job_id] += 1
-                block_count -= 1
-                job_id += 1
-                job_id = job_id % n_jobs
-
-            assert np.sum(blocks_per_job) == len(block_list)
-            # make prepartition
-            prepartiion = []
-            block_id = 0
-            for bpj in blocks_per_job:
-                prepartiion.append(list(range(block_id, block_id + bpj)))
-                block_id += bpj
+            method = 'balanced' if method in ('balanced', 'lpt') else 'contiguous'
+        costs = None
+        if method in ('balanced', 'lpt'):
+            costs = self.get_block_costs(block_list, job_prefix)
+            cost_type = 'uniform' if costs is None else 'estimated'
+            self._write_log("partitioning blocks with %s and %s costs" % (method, cost_type))
+        block_jobs = partition_blocks(block_list, n_jobs, method, costs)
+
+        # if we use a block queue, the jobs that support it claim their blocks
+        # from the queue; the block lists are still written for the other jobs
+        queue_config = {}
+        if global_config.get('block_queue', False) and not consecutive_blocks:
+            batch_size = global_config.get('block_queue_batch_size', 4)
+            queue_dir = self._write_block_queue(block_jobs, batch_size, job_prefix)
+            queue_config = {'block_queue': queue_dir}
 
         # write the configurations for all jobs to the tmp folder
+        batch_offset = 0
         for job_id in range(n_jobs):
-            # if `consecutive_blocks` is true, we keep the block_ids in
-            # block_jobs consecutive
-            if consecutive_blocks:
-                block_jobs = prepartiion[job_id]
-            else:
-                block_jobs = block_list[job_id::n_jobs]
-            job_config = {'block_list': block_jobs, **config}
+            job_config = {'block_list': block_jobs[job_id], **config, **queue_config}
+            if queue_config:
+                job_config['block_queue_offset'] = batch_offset
+                batch_offset += int(np.ceil(len(block_jobs[job_id]) / float(batch_size)))
             config_path = self._config_path(job_id, job_prefix)
             with open(config_path, 'w') as f:
                 json.dump(job_config, f)
 
+    def _write_block_queue(self, block_jobs, batch_size, job_prefix):
+        """ Write the block queue shared by all jobs of the task.
+
+        Each batch of blocks is stored in a file in 'pending' and is claimed by
+        a job by moving it to 'claimed'. The batches follow the job partitioning,
+        so a job starting at its offset processes the same blocks as without the queue.
+        """
+        job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
+                                                                        job_prefix)
+        queue_dir = os.path.join(self.tmp_folder, 'queues', job_name)
+        # remove the queue of a previous attempt
+        if os.path.exists(queue_dir):
+            shutil.rmtree(queue_dir)
+        pending_dir = os.path.join(queue_dir, 'pending')
+        os.makedirs(pending_dir)
+        os.makedirs(os.path.join(queue_dir, 'claimed'))
+
+        batch_id = 0
+        for blocks in block_jobs:
+            for batch_start in range(0, len(blocks), batch_size):
+                with open(os.path.join(pending_dir, fu.QUEUE_BATCH % batch_id), 'w') as f:
+                    json.dump(blocks[batch_start:batch_start + batch_size], f)
+                batch_id += 1
+        self._write_log("written block queue with %i batches to %s" % (batch_id, queue_dir))
+        return queue_dir
+
     # TODO allow config for individual blocks
     def _write_job_config(self, n_jobs, block_list, config,
                           job_prefix=None, consecutive_blocks=False):
@@ -345,6 +451,11 @@ class BaseClusterTask(luigi.Task):
             self.block_list = block_list
             self._write_multiple_job_configs(n_jobs, block_list, config,
                                              job_prefix, consecutive_blocks)
+        # remove ledgers from previous attempts, because the jobs append to them
+        for job_id in range(n_jobs):
+            ledger_path = self._ledger_path(job_id, job_prefix)
+            if os.path.exists(ledger_path):
+                os.remove(ledger_path)
         self._write_log('written config for %i jobs' % n_jobs)
 
     # copy the python script to the temp folder and replace the shebang
@@ -371,6 +482,10 @@ class BaseClusterTask(luigi.Task):
         os.chmod(path, st.st_mode | stat.S_IEXEC)
 
 
+# states of slurm jobs that have not finished yet
+SLURM_ACTIVE_STATES = ('PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'SUSPENDED')
+
+
 class SlurmTask(BaseClusterTask):
     """
     Task for cluster with Slurm scheduling system
@@ -404,9 +519,10 @@ class SlurmTask(BaseClusterTask):
 
         # get file paths
         trgt_file = os.path.join(self.tmp_folder, self.task_name + '.py')
-        config_tmpl = self._config_path('$1', job_prefix)
+        # the jobs are submitted as job array and the job id is the array task id
+        config_tmpl = self._config_path('$SLURM_ARRAY_TASK_ID', job_prefix)
+        ledger_env = self._ledger_env('$SLURM_ARRAY_TASK_ID', job_prefix)
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name, job_prefix)
-        # TODO set the job-name so that we can parse the squeue output properly
         slurm_template = ("#!/bin/bash\n"
                           "#SBATCH -A %s\n"
                           "#SBATCH -N 1\n"
@@ -414,9 +530,9 @@ class SlurmTask(BaseClusterTask):
                           "#SBATCH --mem %s\n"
                           "#SBATCH -t %s\n"
                           "#SBATCH --qos=%s\n"
-                          "%s %s") % (groupname, n_threads,
-                                      mem_limit, time_limit, qos,
-                                      trgt_file, config_tmpl)
+                          "%s %s %s") % (groupname, n_threads,
+                                         mem_limit, time_limit, qos,
+                                         ledger_env, trgt_file, config_tmpl)
         script_path = os.path.join(self.tmp_folder, 'slurm_%s.sh' % job_name)
         with open(script_path, 'w') as f:
             f.write(slurm_template)
@@ -432,65 +548,151 @@ class SlurmTask(BaseClusterTask):
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name,
                                                                         job_prefix)
         script_path = os.path.join(self.tmp_folder, 'slurm_%s.sh' % job_name)
-        self.slurm_ids = []
-        for job_id in range(n_jobs):
-            out_file = os.path.join(self.tmp_folder, 'logs', '%s_%i.log' % (job_name, job_id))
-            err_file = os.path.join(self.tmp_folder, 'error_logs', '%s_%i.err' % (job_name,
-                                                                                  job_id))
-            command = ['sbatch', '-o', out_file, '-e', err_file, '-J',
-                       '%s_%i' % (job_name, job_id), script_path, str(job_id)]
-            # call(command)
-            outp = check_output(command).decode().rstrip()
-            # get the slurm job-id
-            slurm_id = int(outp.split()[-1])
-            self.slurm_ids.append(slurm_id)
-            # print slurm message
-            print(outp)
+        # submit all jobs with a single sbatch call as job array;
+        # slurm replaces '%a' in the log paths with the array task id
+        out_file = os.path.join(self.tmp_folder, 'logs', '%s_%%a.log' % job_name)
+        err_file = os.path.join(self.tmp_folder, 'error_logs', '%s_%%a.err' % job_name)
+        command = ['sbatch', '-o', out_file, '-e', err_file, '-J', job_name,
+                   '--array=0-%i%%%i' % (n_jobs - 1, self.max_jobs), script_path]
+        outp = check_output(command).decode().rstrip()
+        # get the slurm job-id of the array
+        self.slurm_array_id = int(outp.split()[-1])
+        # print slurm message
+        print(outp)
 
     def wait_for_jobs(self, job_prefix=None):
-        # TODO move to some config
-        wait_time = 10
+        config = self.get_global_config()
+        wait_time = config.get('poll_interval', 10)
+        max_wait_time = config.get('max_poll_interval', 120)
+        # only query the states of the unfinished tasks in this job array;
+        # slurm keeps listing finished tasks until they are purged from the queue
+        command = ['squeue', '-h', '-j', str(self.slurm_array_id), '-o', '%T',
+                   '-t', ','.join(SLURM_ACTIVE_STATES)]
         while True:
             time.sleep(wait_time)
 
             try:
-                outp = check_output(['squeue -u $USER | grep $USER'], shell=True).decode()
+                outp = check_output(command, stderr=STDOUT).decode()
             except CalledProcessError as e:
-                # handle error for empty queue
-                outp = e.output.decode().rstrip()
-                if outp == '':
+                # squeue fails if the array was already removed from the queue
+                outp = e.output.decode()
+                if 'Invalid job id' in outp:
                     break
                 else:
                     raise e
 
-            outp = [out for out in outp.split('\n') if out != '']
-            # check how many jobs there are in total, if none, stop waiting
-            n_running = len(outp)
-            if n_running == 0:
-                break
-            # if we have jobs, check how many belong to this task
-            n_running = sum([int(out.split()[0]) in self.slurm_ids for out in outp])
+            # if no task of the array is pending or running, stop waiting
+            n_running = len([out for out in outp.split('\n') if out.strip() in SLURM_ACTIVE_STATES])
             if n_running == 0:
                 break
+            # back off, so that we don't flood the controller for long running tasks
+            wait_time = min(2 * wait_time, max_wait_time)
+
+
+# persistent pool for running local jobs in-process, shared by all local tasks
+_inprocess_pool = None
+
+
+def _get_inprocess_pool(n_workers, preload):
+    global _inprocess_pool
+    if _inprocess_pool is None:
+        # the workers are forked from a forkserver that has the preload modules
+        # imported already, so a job does not pay the import cost again.
+        # modules that cannot be imported are skipped by the forkserver
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(list(preload))
+        _inprocess_pool = futures.ProcessPoolExecutor(n_workers, mp_context=ctx)
+    return _inprocess_pool
+
+
+def _shutdown_inprocess_pool():
+    global _inprocess_pool
+    if _inprocess_pool is not None:
+        _inprocess_pool.shutdown(wait=False)
+        _inprocess_pool = None
+
+
+def _import_task_module(src_file, module_name):
+    """ Import the module that implements a task, preferably by its name,
+        otherwise from the source file.
+    """
+    if module_name != '__main__':
+        try:
+            module = importlib.import_module(module_name)
+            if os.path.abspath(getattr(module, '__file__', '')) == src_file:
+                return module
+        except ImportError:
+            pass
+
+    name = '_ct_job_%s' % os.path.splitext(os.path.basename(src_file))[0]
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, src_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+
+def _run_job_inprocess(src_file, module_name, job_id, config_file, log_file, err_file, ledger_path):
+    """ Run the job function of a task module in a pool worker.
+
+    The job function has the same name as the module, e.g. `watershed.watershed`.
+    stdout and stderr are redirected to the job logs on the file descriptor
+    level, so the logs look the same as the logs of a job run in a sub-process.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout_fd, stderr_fd = os.dup(1), os.dup(2)
+    with open(log_file, 'w') as f_out, open(err_file, 'w') as f_err:
+        os.dup2(f_out.fileno(), 1)
+        os.dup2(f_err.fileno(), 2)
+        os.environ[fu.LEDGER_ENV] = ledger_path
+        fu.init_ledger()
+        try:
+            module = _import_task_module(src_file, module_name)
+            job_function = getattr(module, os.path.splitext(os.path.basename(src_file))[0])
+            job_function(job_id, config_file)
+        # the job has failed; this is picked up by `check_jobs`, because the log
+        # does not end with the 'processed job' message
+        except Exception:
+            traceback.print_exc()
+        finally:
+            del os.environ[fu.LEDGER_ENV]
+            fu.init_ledger()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(stdout_fd, 1)
+            os.dup2(stderr_fd, 2)
+            os.close(stdout_fd)
+            os.close(stderr_fd)
 
 
 class LocalTask(BaseClusterTask):
     """
     Task for running tasks locally via sub-processes
+
+    If 'local_executor' is set to 'inprocess' in the global config,
+    the jobs are run in a persistent pool of worker processes that have the
+    heavy dependencies imported already, instead of starting a new interpreter
+    for each job. In this case the shebang is not used.
     """
     # don't want to start too many local jobs, because
     # this is usually a sign that forgot to set the target
     # to slurm or lsf
     max_local_jobs = cpu_count()
+    # modules that are imported once by the in-process workers
+    inprocess_preload = ('numpy', 'luigi', 'vigra', 'nifty', 'nifty.tools',
+                         'nifty.graph', 'nifty.distributed', 'z5py', 'h5py',
+                         'cluster_tools.utils.volume_utils',
+                         'cluster_tools.utils.function_utils')
 
     def prepare_jobs(self, n_jobs, block_list, config,
                      job_prefix=None, consecutive_blocks=False):
         # write the job configs
         self._write_job_config(n_jobs, block_list, config, job_prefix, consecutive_blocks)
 
-    def _submit(self, job_id, job_prefix):
-        script_path = os.path.join(self.tmp_folder, self.task_name + '.py')
-        assert os.path.exists(script_path), script_path
+    def _job_files(self, job_id, job_prefix):
         config_file = self._config_path(job_id, job_prefix)
         assert os.path.exists(config_file), config_file
 
@@ -500,14 +702,43 @@ class LocalTask(BaseClusterTask):
                                 '%s_%i.log' % (job_name, job_id))
         err_file = os.path.join(self.tmp_folder, 'error_logs',
                                 '%s_%i.err' % (job_name, job_id))
+        ledger_path = self._ledger_path(job_id, job_prefix)
+        return config_file, log_file, err_file, ledger_path
+
+    def _submit(self, job_id, job_prefix):
+        script_path = os.path.join(self.tmp_folder, self.task_name + '.py')
+        assert os.path.exists(script_path), script_path
+        config_file, log_file, err_file, ledger_path = self._job_files(job_id, job_prefix)
+        env = dict(os.environ, **{fu.LEDGER_ENV: ledger_path})
         with open(log_file, 'w') as f_out, open(err_file, 'w') as f_err:
             assert os.path.exists(script_path), script_path
-            call([script_path, config_file], stdout=f_out, stderr=f_err)
+            call([script_path, config_file], stdout=f_out, stderr=f_err, env=env)
+
+    def _submit_inprocess(self, n_jobs, job_prefix):
+        pool = _get_inprocess_pool(self.max_local_jobs, self.inprocess_preload)
+        src_file = os.path.abspath(self.src_file)
+        module_name = type(self).__module__
+        tasks = [pool.submit(_run_job_inprocess, src_file, module_name, job_id,
+                             *self._job_files(job_id, job_prefix))
+                 for job_id in range(n_jobs)]
+        try:
+            [t.result() for t in tasks]
+        # a worker died, e.g. due to a segfault in a c++ extension;
+        # the unfinished jobs are marked as failed by `check_jobs`,
+        # but the pool cannot be used any more
+        except futures.process.BrokenProcessPool:
+            self._write_log("in-process worker pool broke, starting a new one for the next jobs")
+            _shutdown_inprocess_pool()
 
     def submit_jobs(self, n_jobs, job_prefix=None):
         assert n_jobs <= self.max_local_jobs,\
             "Trying to submit %i local jobs but limit is %i. Did you forget to set the target to slurm or lsf?" %\
             (n_jobs, self.max_local_jobs)
+        executor = self.get_global_config().get('local_executor', 'subprocess')
+        if executor == 'inprocess':
+            self._submit_inprocess(n_jobs, job_prefix)
+            return
+        assert executor == 'subprocess', "Invalid local executor %s" % executor
         with futures.ProcessPoolExecutor(n_jobs) as pp:
             tasks = [pp.submit(self._submit, job_id, job_prefix) for job_id in range(n_jobs)]
             [t.result() for t in tasks]
@@ -542,7 +773,7 @@ class LSFTask(BaseClusterTask):
 
         for job_id in range(n_jobs):
             config_file = self._config_path(job_id, job_prefix)
-            command = '%s %s' % (script_path, config_file)
+            command = '%s %s %s' % (self._ledger_env(job_id, job_prefix), script_path, config_file)
             log_file = os.path.join(self.tmp_folder, 'logs',
                                     '%s_%i.log' % (job_name, job_id))
             err_file = os.path.join(self.tmp_folder, 'error_logs',
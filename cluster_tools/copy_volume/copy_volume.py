@@ -10,6 +10,7 @@ import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 from cluster_tools.utils.task_utils import DummyTask
 
@@ -42,7 +43,7 @@ class CopyVolumeBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'chunks': None, 'compression': 'gzip'})
+        config.update({'chunks': None, 'compression': 'gzip', 'skip_empty_blocks': False})
         return config
 
     def requires(self):
@@ -117,7 +118,11 @@ class CopyVolumeBase(luigi.Task):
             shape = shape[1:]
 
         if self.n_retries == 0:
-            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+            # don't schedule the blocks that are empty in the input
+            occupancy = vu.load_occupancy(self.input_path, self.input_key)\
+                if task_config.pop('skip_empty_blocks', False) else None
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
+                                             occupancy=occupancy)
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list)
@@ -175,30 +180,41 @@ def cast_type(data, dtype):
         return data.astype(dtype)
 
 
+def _read_block(ds_in, blocking, block_id):
+    block = blocking.getBlock(block_id)
+    bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+    if ds_in.ndim == 4:
+        bb = (slice(None),) + bb
+
+    data = ds_in[bb]
+    # don't write empty blocks
+    if data.sum() == 0:
+        return None
+    return data
+
+
+def _write_block(ds_out, blocking, block_id, data, roi_begin):
+    block = blocking.getBlock(block_id)
+    bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+    # if we have a roi begin, we need to substract it
+    # from the output bounding box, because in this case
+    # the output shape has been fit to the roi
+    if roi_begin is not None:
+        bb = tuple(slice(b.start - off, b.stop - off)
+                   for b, off in zip(bb, roi_begin))
+    if ds_out.ndim == 4:
+        bb = (slice(None),) + bb
+    ds_out[bb] = data
+
+
 def _copy_blocks(ds_in, ds_out, blocking, block_list, roi_begin):
     dtype = ds_out.dtype
-    for block_id in block_list:
-        fu.log("start processing block %i" % block_id)
-
-        block = blocking.getBlock(block_id)
-        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
-        if ds_in.ndim == 4:
-            bb = (slice(None),) + bb
-
-        data = ds_in[bb]
-        # don't write empty blocks
-        if sum(data).sum() == 0:
-            fu.log_block_success(block_id)
-            continue
-
-        # if we have a roi begin, we need to substract it
-        # from the output bounding box, because in this case
-        # the output shape has been fit to the roi
-        if roi_begin is not None:
-            bb = tuple(slice(b.start - off, b.stop - off)
-                       for b, off in zip(bb, roi_begin))
-        ds_out[bb] = cast_type(data, dtype)
-        fu.log_block_success(block_id)
+    # read the next blocks and write the copied blocks while casting the current one
+    pipeline = BlockPipeline(lambda block_id: _read_block(ds_in, blocking, block_id),
+                             lambda block_id, data: cast_type(data, dtype),
+                             lambda block_id, data: _write_block(ds_out, blocking, block_id,
+                                                                 data, roi_begin))
+    pipeline.run(block_list)
 
 
 def copy_volume(job_id, config_path):
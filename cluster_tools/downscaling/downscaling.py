@@ -4,7 +4,6 @@ import os
 import sys
 import json
 from functools import partial
-from concurrent import futures
 
 import numpy as np
 import luigi
@@ -14,6 +13,7 @@ from skimage.measure import block_reduce
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 from cluster_tools.utils.task_utils import DummyTask
 
@@ -54,7 +54,8 @@ class DownscalingBase(luigi.Task):
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
         config.update({'library': 'vigra', 'chunks': None, 'compression': 'gzip',
-                       'library_kwargs': None})
+                       'library_kwargs': None, 'chunk_cache_size': 0,
+                       'skip_empty_blocks': False})
         return config
 
     def clean_up_for_retry(self, block_list):
@@ -167,8 +168,13 @@ class DownscalingBase(luigi.Task):
             self._write_log("ROI after scaling: %s to %s" % (str(roi_begin), str(roi_end)))
 
         if self.n_retries == 0:
+            # don't schedule the blocks that are empty in the input;
+            # with a halo, the empty blocks are only skipped by the jobs
+            occupancy = None
+            if task_config.get('skip_empty_blocks', False) and not self.halo:
+                occupancy = vu.load_occupancy(self.input_path, self.input_key, scale_factor)
             block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
-                                             block_list_path)
+                                             block_list_path, occupancy=occupancy)
             self._write_log("scheduled %i blocks to run" % len(block_list))
         else:
             block_list = self.block_list
@@ -224,13 +230,11 @@ def _ds_vol(x, out_shape, sampler, scale_factor, dtype):
     return out.astype(dtype)
 
 
-def _ds_block(blocking, block_id, ds_in, ds_out, scale_factor, halo, sampler):
-    fu.log("start processing block %i" % block_id)
-
+def _get_bbs(blocking, block_id, ds_in, scale_factor, halo):
     # load the block (output dataset / downsampled) coordinates
     if halo is None:
         block = blocking.getBlock(block_id)
-        local_bb = np.s_[:]
+        local_bb = (slice(None),) * 3
         in_bb = vu.block_to_bb(block)
         out_bb = vu.block_to_bb(block)
         out_shape = block.shape
@@ -256,23 +260,32 @@ def _ds_block(blocking, block_id, ds_in, ds_out, scale_factor, halo, sampler):
     else:
         in_bb = tuple(slice(ib.start * sf, min(ib.stop * sf, sh))
                       for ib, sf, sh in zip(in_bb, scale_factor, in_shape))
-    # load the input
     if ndim == 4:
         in_bb = (slice(None),) + in_bb
         out_bb = (slice(None),) + out_bb
         local_bb = (slice(None),) + local_bb
-    x = ds_in[in_bb]
+    return in_bb, out_bb, local_bb, out_shape
 
+
+def _read_ds_block(blocking, block_id, ds_in, scale_factor, halo, occupancy):
+    in_bb, _, _, _ = _get_bbs(blocking, block_id, ds_in, scale_factor, halo)
+    # don't read blocks without any chunks
+    if occupancy is not None and occupancy.is_empty(in_bb[-3:]):
+        return None
+    x = ds_in[in_bb]
     # don't sample empty blocks
     if np.sum(x != 0) == 0:
-        fu.log_block_success(block_id)
-        return
+        return None
+    return x
 
+
+def _compute_ds_block(blocking, block_id, ds_in, x, scale_factor, halo, sampler):
+    _, _, local_bb, out_shape = _get_bbs(blocking, block_id, ds_in, scale_factor, halo)
     dtype = x.dtype
     if np.dtype(dtype) != np.dtype('float32'):
         x = x.astype('float32')
 
-    if ndim == 4:
+    if x.ndim == 4:
         n_channels = x.shape[0]
         out = np.zeros((n_channels,) + tuple(out_shape), dtype=dtype)
         for c in range(n_channels):
@@ -281,12 +294,14 @@ def _ds_block(blocking, block_id, ds_in, ds_out, scale_factor, halo, sampler):
         out = _ds_vol(x, out_shape, sampler, scale_factor, dtype)
 
     try:
-        ds_out[out_bb] = out[local_bb]
+        return out[local_bb]
     except IndexError:
-        raise(IndexError("%s, %s, %s" % (str(out_bb), str(local_bb), str(out.shape))))
+        raise(IndexError("%s, %s" % (str(local_bb), str(out.shape))))
 
-    # log block success
-    fu.log_block_success(block_id)
+
+def _write_ds_block(blocking, block_id, ds_in, ds_out, out, scale_factor, halo):
+    _, out_bb, _, _ = _get_bbs(blocking, block_id, ds_in, scale_factor, halo)
+    ds_out[out_bb] = out
 
 
 # wrap vigra.sampling.resize
@@ -307,7 +322,7 @@ def _ds_skimage(inp, output_shape, sample_2d, block_size, func):
 
 def _submit_blocks(ds_in, ds_out, block_shape, block_list,
                    scale_factor, halo, library,
-                   library_kwargs, n_threads):
+                   library_kwargs, n_threads, occupancy):
 
     # get the blocking
     shape = ds_out.shape
@@ -324,15 +339,15 @@ def _submit_blocks(ds_in, ds_out, block_shape, block_list,
     else:
         raise ValueError("Invalid library %s, only vigra and skimage are supported" % library)
 
-    if n_threads <= 1:
-        for block_id in block_list:
-            _ds_block(blocking, block_id, ds_in, ds_out,
-                      scale_factor, halo, sampler)
-    else:
-        with futures.ThreadPoolExecutor(n_threads) as tp:
-            tasks = [tp.submit(_ds_block, blocking, block_id, ds_in, ds_out,
-                               scale_factor, halo, sampler) for block_id in block_list]
-            [t.result() for t in tasks]
+    # read the next blocks and write the results while downsampling the current blocks
+    pipeline = BlockPipeline(lambda block_id: _read_ds_block(blocking, block_id, ds_in,
+                                                             scale_factor, halo, occupancy),
+                             lambda block_id, x: _compute_ds_block(blocking, block_id, ds_in, x,
+                                                                   scale_factor, halo, sampler),
+                             lambda block_id, out: _write_ds_block(blocking, block_id, ds_in, ds_out,
+                                                                   out, scale_factor, halo),
+                             n_threads=n_threads, n_io_threads=n_threads)
+    pipeline.run(block_list)
 
 
 def downscaling(job_id, config_path):
@@ -359,23 +374,31 @@ def downscaling(job_id, config_path):
         library_kwargs = {}
     halo = config.get('halo', None)
     n_threads = config.get('threads_per_job', 1)
+    # if the blocks are read with a halo, we cache the chunks of the input
+    cache_size = config.get('chunk_cache_size', 0) if halo else 0
+    occupancy = vu.load_occupancy(input_path, input_key) if config.get('skip_empty_blocks', False) else None
 
     # submit blocks
     # check if in and out - file are the same
     # because hdf5 does not like opening files twice
     if input_path == output_path:
-        with vu.file_reader(output_path) as f:
+        with vu.file_reader(output_path, cache_size=cache_size) as f:
             ds_in = f[input_key]
             ds_out = f[output_key]
             _submit_blocks(ds_in, ds_out, block_shape, block_list, scale_factor, halo,
-                           library, library_kwargs, n_threads)
+                           library, library_kwargs, n_threads, occupancy)
+            if cache_size > 0:
+                fu.log(f.cache.summary())
 
     else:
-        with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
+        with vu.file_reader(input_path, 'r', cache_size=cache_size) as f_in,\
+                vu.file_reader(output_path) as f_out:
             ds_in = f_in[input_key]
             ds_out = f_out[output_key]
             _submit_blocks(ds_in, ds_out, block_shape, block_list, scale_factor, halo,
-                           library, library_kwargs, n_threads)
+                           library, library_kwargs, n_threads, occupancy)
+            if cache_size > 0:
+                fu.log(f_in.cache.summary())
 
     # log success
     fu.log_job_success(job_id)
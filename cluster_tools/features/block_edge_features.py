@@ -4,6 +4,7 @@ import os
 import sys
 import argparse
 import json
+import threading
 
 import numpy as np
 import luigi
@@ -13,6 +14,8 @@ import nifty.distributed as ndist
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.filter_utils import FilterBank
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -40,18 +43,19 @@ class BlockEdgeFeaturesBase(luigi.Task):
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
         config.update({'offsets': None, 'filters': None, 'sigmas': None, 'halo': [0, 0, 0],
-                       'apply_in_2d': False, 'channel_agglomeration': 'mean'})
+                       'apply_in_2d': False, 'channel_agglomeration': 'mean',
+                       'chunk_cache_size': 0})
         return config
 
     def clean_up_for_retry(self, block_list):
         super().clean_up_for_retry(block_list)
         # TODO remove any output of failed blocks because it might be corrupted
 
-    def run_impl(self):
-        # get the global config and init configs
-        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
-        self.init(shebang)
+    def stage_config(self, block_shape):
+        """ Get the job config and create the output group.
 
+        Returns the config and the shape of the volume that is processed blockwise.
+        """
         # load the task config
         config = self.get_task_config()
 
@@ -68,11 +72,20 @@ class BlockEdgeFeaturesBase(luigi.Task):
                        'graph_block_prefix': os.path.join(self.graph_path, 's0',
                                                           'sub_graphs', 'block_')})
 
+        shape = vu.get_shape(self.input_path, self.input_key)
+        if len(shape) == 4:
+            shape = shape[1:]
+        return config, shape
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        config, shape = self.stage_config(block_shape)
+
         if self.n_retries == 0:
-            # get shape and make block config
-            shape = vu.get_shape(self.input_path, self.input_key)
-            if len(shape) == 4:
-                shape = shape[1:]
+            # make block config
             block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
         else:
             block_list = self.block_list
@@ -142,19 +155,17 @@ def _accumulate(input_path, input_key,
                           block_list, out_prefix, offsets)
 
 
-def _accumulate_filter(input_, graph, labels, bb_local,
-                       filter_name, sigma, ignore_label,
-                       with_size, apply_in_2d):
-    response = vu.apply_filter(input_, filter_name, sigma,
-                               apply_in_2d=apply_in_2d)[bb_local]
+def _accumulate_filter(response, graph, labels, ignore_label, with_size):
     if response.ndim == 4:
         n_chan = response.shape[-1]
         assert response.shape[:-1] == labels.shape
+        # get the value ranges of all channels in one pass
+        spatial_axes = tuple(range(response.ndim - 1))
+        min_vals, max_vals = response.min(axis=spatial_axes), response.max(axis=spatial_axes)
         return np.concatenate([ndist.accumulateInput(graph, response[..., c], labels,
                                                      ignore_label,
                                                      with_size and c==n_chan-1,
-                                                     response[..., c].min(),
-                                                     response[..., c].max())
+                                                     min_vals[c], max_vals[c])
                                for c in range(n_chan)], axis=1)
     else:
         assert response.shape == labels.shape
@@ -163,22 +174,10 @@ def _accumulate_filter(input_, graph, labels, bb_local,
                                      response.min(), response.max())
 
 
-def _accumulate_block(block_id, blocking,
-                      ds_in, ds_labels,
-                      out_prefix, graph_block_prefix,
-                      filters, sigmas, halo, ignore_label,
-                      apply_in_2d, channel_agglomeration):
-
-    fu.log("start processing block %i" % block_id)
-    # load graph and check if this block has edges
-    graph = ndist.Graph(graph_block_prefix + str(block_id))
-    if graph.numberOfEdges == 0:
-        fu.log("block %i has no edges" % block_id)
-        fu.log_block_success(block_id)
-        return
-
-    shape = ds_labels.shape
-    # get the bounding
+def _block_bounding_boxes(block_id, blocking, shape, halo):
+    """ Get the bounding boxes of the input (with halo), of the labels and
+    of the labels in the local coordinates of the input.
+    """
     if sum(halo) > 0:
         block = blocking.getBlockWithHalo(block_id, halo)
         block_shape = block.outerBlock.shape
@@ -199,50 +198,104 @@ def _accumulate_block(block_id, blocking,
                          min(b.stop + 1, sh)) for b, sh in zip(bb, shape))
         bb_in = bb
         bb_local = slice(None)
+    return bb_in, bb, bb_local
 
+
+def _load_input(ds_in, bb_in, channel_agglomeration, profile=None):
     input_dim = ds_in.ndim
     # TODO make choice of channels optional
     if input_dim == 4:
         bb_in = (slice(0, 3),) + bb_in
 
-    input_ = vu.normalize(ds_in[bb_in])
+    input_ = vu.normalize(ds_in[bb_in] if profile is None else profile.read(ds_in, bb_in))
     if input_dim == 4:
         assert channel_agglomeration is not None
         input_ = getattr(np, channel_agglomeration)(input_, axis=0)
+    return input_
 
-    # load labels
-    labels = ds_labels[bb]
 
-    # TODO pre-smoothing ?!
-    # accumulate the edge features
-    edge_features = [_accumulate_filter(input_, graph, labels, bb_local,
-                                        filter_name, sigma, ignore_label,
-                                        filter_name==filters[-1] and sigma==sigmas[-1],
-                                        apply_in_2d)
-                     for filter_name in filters for sigma in sigmas]
-    edge_features = np.concatenate(edge_features, axis=1)
+def _accumulate_filters(input_, graph, labels, bb_local,
+                        filter_bank, ignore_label):
+    # the filter responses are cropped to the labels before they are accumulated
+    responses = filter_bank(input_, bb_local)
+    n_responses = len(responses)
+    edge_features = [_accumulate_filter(response, graph, labels, ignore_label,
+                                        response_id == n_responses - 1)
+                     for response_id, response in enumerate(responses)]
+    return np.concatenate(edge_features, axis=1)
 
-    # save the features
+
+# blocks are written from several threads and creating the
+# feature datasets in the same group is not thread-safe
+_create_lock = threading.Lock()
+
+
+def _write_features(edge_features, out_prefix, block_id, profile=None):
     save_path = out_prefix + str(block_id)
     fu.log("saving feature result of shape %s to %s" % (str(edge_features.shape),
                                                         save_path))
     save_root, save_key = os.path.split(save_path)
-    with z5py.N5File(save_root) as f:
-        f.create_dataset(save_key, data=edge_features,
-                         chunks=edge_features.shape)
+    profile = fu.BlockProfile() if profile is None else profile
+    with profile.phase('write'), z5py.N5File(save_root) as f:
+        with _create_lock:
+            ds = f.create_dataset(save_key, shape=edge_features.shape, dtype=edge_features.dtype,
+                                  chunks=edge_features.shape)
+        ds[:] = edge_features
+    profile.bytes_written += edge_features.nbytes
+
 
-    fu.log_block_success(block_id)
+def _read_features_block(block_id, blocking, ds_in, ds_labels,
+                         graph_block_prefix, halo, channel_agglomeration):
+    # load graph and check if this block has edges
+    graph = ndist.Graph(graph_block_prefix + str(block_id))
+    if graph.numberOfEdges == 0:
+        fu.log("block %i has no edges" % block_id)
+        return None
+
+    bb_in, bb, bb_local = _block_bounding_boxes(block_id, blocking, ds_labels.shape, halo)
+    input_ = _load_input(ds_in, bb_in, channel_agglomeration)
+    # load labels
+    labels = ds_labels[bb]
+    return graph, input_, labels, bb_local
+
+
+def _accumulate_block(block_id, blocking,
+                      ds_in, ds_labels,
+                      out_prefix, graph_block_prefix,
+                      filter_bank, halo, ignore_label,
+                      channel_agglomeration):
+
+    fu.log("start processing block %i" % block_id)
+    profile = fu.BlockProfile()
+    with profile.phase('read'):
+        inputs = _read_features_block(block_id, blocking, ds_in, ds_labels,
+                                      graph_block_prefix, halo, channel_agglomeration)
+    if inputs is None:
+        fu.log_block_success(block_id, profile)
+        return
+    graph, input_, labels, bb_local = inputs
+    profile.bytes_read += input_.nbytes + labels.nbytes
+
+    # TODO pre-smoothing ?!
+    # accumulate the edge features
+    with profile.phase('compute'):
+        edge_features = _accumulate_filters(input_, graph, labels, bb_local,
+                                            filter_bank, ignore_label)
+
+    # save the features
+    _write_features(edge_features, out_prefix, block_id, profile)
+    fu.log_block_success(block_id, profile)
 
 
 def _accumulate_with_filters(input_path, input_key,
                              labels_path, labels_key,
                              output_path, graph_block_prefix,
                              block_list, block_shape,
-                             filters, sigmas, halo,
-                             apply_in_2d, channel_agglomeration):
+                             filter_bank, halo, channel_agglomeration,
+                             cache_size=0, n_threads=1):
 
-    fu.log("accumulate features with applying filters:")
-    # TODO log filter and sigma values
+    fu.log("accumulate features with applying filters %s for sigmas %s" % (str(filter_bank.filters),
+                                                                          str(filter_bank.sigmas)))
     with vu.file_reader(input_path, 'r') as f:
         ds = f[input_key]
         dtype = ds.dtype
@@ -259,15 +312,64 @@ def _accumulate_with_filters(input_path, input_key,
     with z5py.File(graph_block_prefix + str(block_list[0])) as f:
         ignore_label = f.attrs['ignoreLabel']
 
-    with vu.file_reader(input_path) as f, vu.file_reader(labels_path) as f_l:
+    # the input is read with a halo and the labels with an overlap of one pixel,
+    # so we cache the chunks of both
+    with vu.file_reader(input_path, cache_size=cache_size) as f,\
+            vu.file_reader(labels_path, cache_size=cache_size) as f_l:
         ds_in = f[input_key]
         ds_labels = f_l[labels_key]
-        for block_id in block_list:
-            _accumulate_block(block_id, blocking,
-                              ds_in, ds_labels,
-                              out_prefix, graph_block_prefix,
-                              filters, sigmas, halo, ignore_label,
-                              apply_in_2d, channel_agglomeration)
+
+        # process the blocks in parallel, the pipeline bounds the number
+        # of blocks that are held in memory
+        def _read(block_id):
+            return _read_features_block(block_id, blocking, ds_in, ds_labels,
+                                        graph_block_prefix, halo, channel_agglomeration)
+
+        def _compute(block_id, inputs):
+            graph, input_, labels, bb_local = inputs
+            return _accumulate_filters(input_, graph, labels, bb_local,
+                                       filter_bank, ignore_label)
+
+        def _write(block_id, edge_features):
+            _write_features(edge_features, out_prefix, block_id)
+
+        pipeline = BlockPipeline(_read, _compute, _write, n_threads=n_threads)
+        pipeline.run(block_list)
+        if cache_size > 0:
+            fu.log(f.cache.summary())
+            fu.log(f_l.cache.summary())
+
+
+def fused_stage(job_id, config, store):
+    """ Block function for fused jobs, see fusion.FusedBlocks.
+    """
+    filters = config.get('filters', None)
+    sigmas = config.get('sigmas', None)
+    # the accumulation without filters is implemented in nifty
+    # and reads the data from file, so it can't be fused
+    assert filters is not None, "Only the accumulation with filters can be fused"
+    assert config.get('offsets', None) is None, "Filters and offsets are not supported"
+    assert sigmas is not None, "Need sigma values"
+
+    ds_in = store.dataset(config['input_path'], config['input_key'])
+    ds_labels = store.dataset(config['labels_path'], config['labels_key'])
+    out_prefix = os.path.join(config['output_path'], 'blocks', 'block_')
+    graph_block_prefix = config['graph_block_prefix']
+    halo = config.get('halo', [0, 0, 0])
+    filter_bank = FilterBank(filters, sigmas, config.get('apply_in_2d', False),
+                             config.get('threads_per_job', 1))
+    channel_agglomeration = config.get('channel_agglomeration', 'mean')
+    assert channel_agglomeration in ('mean', 'max', 'min', None)
+
+    def _stage(block_id, blocking):
+        with z5py.File(graph_block_prefix + str(block_id)) as f:
+            ignore_label = f.attrs['ignoreLabel']
+        _accumulate_block(block_id, blocking,
+                          ds_in, ds_labels,
+                          out_prefix, graph_block_prefix,
+                          filter_bank, halo, ignore_label,
+                          channel_agglomeration)
+    return _stage
 
 
 def block_edge_features(job_id, config_path):
@@ -305,12 +407,15 @@ def block_edge_features(job_id, config_path):
     else:
         assert offsets is None, "Filters and offsets are not supported"
         assert sigmas is not None, "Need sigma values"
+        # the blocks are processed in parallel, so the filters of a block are evaluated serially
+        n_threads = config.get('threads_per_job', 1)
+        filter_bank = FilterBank(filters, sigmas, apply_in_2d)
         _accumulate_with_filters(input_path, input_key,
                                  labels_path, labels_key,
                                  output_path, graph_block_prefix,
                                  block_list, block_shape,
-                                 filters, sigmas, halo,
-                                 apply_in_2d, channel_agglomeration)
+                                 filter_bank, halo, channel_agglomeration,
+                                 config.get('chunk_cache_size', 0), n_threads)
 
     fu.log_job_success(job_id)
 
@@ -44,11 +44,11 @@ class ImageFilterBase(luigi.Task):
         super().clean_up_for_retry(block_list)
         # TODO remove any output of failed blocks because it might be corrupted
 
-    def run_impl(self):
-        # get the global config and init configs
-        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
-        self.init(shebang)
+    def stage_config(self, block_shape):
+        """ Get the job config and create the output dataset.
 
+        Returns the config and the shape of the volume that is processed blockwise.
+        """
         config = self.get_task_config()
         config.update({'input_path': self.input_path, 'input_key': self.input_key,
                        'output_path': self.output_path, 'output_key': self.output_key,
@@ -60,10 +60,17 @@ class ImageFilterBase(luigi.Task):
         with vu.file_reader(self.output_path) as f:
             f.require_dataset(self.output_key, shape=shape, dtype='float32',
                               compression='gzip', chunks=chunks)
+        return config, shape
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        config, shape = self.stage_config(block_shape)
 
         if self.n_retries == 0:
-            # get shape and make block config
-            shape = vu.get_shape(self.input_path, self.input_key)
+            # make block config
             block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
         else:
             block_list = self.block_list
@@ -115,6 +122,22 @@ def _apply_filter(blocking, block_id, ds_in, ds_out,
     fu.log_block_success(block_id)
 
 
+def fused_stage(job_id, config, store):
+    """ Block function for fused jobs, see fusion.FusedBlocks.
+    """
+    ds_in = store.dataset(config['input_path'], config['input_key'])
+    ds_out = store.dataset(config['output_path'], config['output_key'], mode='a')
+    halo = config['halo']
+    sigma = config['sigma']
+    filter_name = config['filter_name']
+    apply_in_2d = config.get('apply_in_2d', False)
+
+    def _stage(block_id, blocking):
+        _apply_filter(blocking, block_id, ds_in, ds_out,
+                      halo, filter_name, sigma, apply_in_2d)
+    return _stage
+
+
 def image_filter(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
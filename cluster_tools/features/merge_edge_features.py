@@ -12,6 +12,7 @@ import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.graph.map_edge_ids import blocks_in_edge_range
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -85,7 +86,8 @@ class MergeEdgeFeaturesBase(luigi.Task):
         # update the task config
         # TODO make scale we extract features at accessible
         feat_block_prefix = os.path.join(self.output_path, 'blocks', 'block_')
-        config.update({'graph_block_prefix': os.path.join(self.graph_path, 's0',
+        config.update({'graph_path': self.graph_path,
+                       'graph_block_prefix': os.path.join(self.graph_path, 's0',
                                                           'sub_graphs', 'block_'),
                        'feature_block_prefix': feat_block_prefix,
                        'output_path': self.output_path, 'output_key': self.output_key,
@@ -155,6 +157,12 @@ def merge_edge_features(job_id, config_path):
 
     # the block list might either be the number of blocks or a list of blocks
     block_ids = list(range(block_ids)) if isinstance(block_ids, int) else block_ids
+    # only load the blocks that contain edges of this job
+    n_blocks = len(block_ids)
+    block_ids = blocks_in_edge_range(config['graph_path'], 0, block_ids,
+                                     edge_begin, edge_end)
+    fu.log("merging features for edges %i to %i from %i of %i blocks" % (edge_begin, edge_end,
+                                                                         len(block_ids), n_blocks))
 
     ndist.mergeFeatureBlocks(graph_block_prefix,
                              feature_block_prefix,
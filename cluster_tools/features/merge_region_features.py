@@ -38,16 +38,19 @@ class MergeRegionFeaturesBase(luigi.Task):
 
         # load the task config
         config = self.get_task_config()
-        chunk_size = min(10000, self.number_of_labels)
+
+        # temporary output dataset
+        tmp_path = os.path.join(self.tmp_folder, 'region_features_tmp.n5')
+        tmp_key = 'bucket_feats'
+
+        # the node chunks correspond to the buckets of the block features
+        with vu.file_reader(tmp_path, 'r') as f:
+            chunk_size = f[tmp_key].attrs['bucket_size']
 
         # require the output dataset
         with vu.file_reader(self.output_path) as f:
             f.require_dataset(self.output_key, dtype='float32', shape=(self.number_of_labels,),
                               chunks=(chunk_size,), compression='gzip')
-
-        # temporary output dataset
-        tmp_path = os.path.join(self.tmp_folder, 'region_features_tmp.n5')
-        tmp_key = 'block_feats'
         # update the task config
         config.update({'output_path': self.output_path, 'output_key': self.output_key,
                        'tmp_path': tmp_path, 'tmp_key': tmp_key,
@@ -87,46 +90,51 @@ class MergeRegionFeaturesLSF(MergeRegionFeaturesBase, LSFTask):
 # Implementation
 #
 
-def _extract_and_merge_region_features(blocking, ds_in, ds, node_begin, node_end):
+def _load_bucket(ds_in, ds_path, bucket_id):
+    # the chunks of this bucket hold the results of all blocks that contain its ids;
+    # n5 stores the chunk (block_id, bucket_id) at 'bucket_id/block_id',
+    # so we only need to read the chunks in the directory of the bucket
+    bucket_dir = os.path.join(ds_path, str(bucket_id))
+    if not os.path.exists(bucket_dir):
+        return None
+    block_ids = sorted(int(name) for name in os.listdir(bucket_dir) if name.isdigit())
+    data = [ds_in.read_chunk((block_id, bucket_id)) for block_id in block_ids]
+    data = [d for d in data if d is not None]
+    if not data:
+        return None
+    return np.concatenate(data)
+
+
+def _merge_bucket(data, bucket_size):
+    # TODO support more features
+    # extract ids and features
+    ids = data[::3].astype('int64')
+    counts = data[1::3].astype('float64')
+    mean = data[2::3]
+
+    # the merged mean is the count-weighted mean of the block means
+    tot_counts = np.bincount(ids, weights=counts, minlength=bucket_size)
+    tot_feats = np.bincount(ids, weights=counts * mean, minlength=bucket_size)
+    out_features = np.zeros(bucket_size, dtype='float32')
+    has_counts = tot_counts > 0
+    out_features[has_counts] = tot_feats[has_counts] / tot_counts[has_counts]
+    return out_features
+
+
+def _extract_and_merge_region_features(ds_in, ds_path, ds, node_blocking, node_block_list):
+    node_begin = node_blocking.getBlock(node_block_list[0]).begin[0]
+    node_end = node_blocking.getBlock(node_block_list[-1]).end[0]
     fu.log("processing node range %i to %i" % (node_begin, node_end))
-    out_features = np.zeros(node_end - node_begin, dtype='float32')
-    out_counts = np.zeros(node_end - node_begin, dtype='float32')
-
-    chunks = ds_in.chunks
-    for block_id in range(blocking.numberOfBlocks):
-        block = blocking.getBlock(block_id)
-        chunk_id = tuple(beg // ch for beg, ch in zip(block.begin, chunks))
 
-        # load the data
-        data = ds_in.read_chunk(chunk_id)
+    for bucket_id in node_block_list:
+        block = node_blocking.getBlock(bucket_id)
+        bucket_begin, bucket_end = block.begin[0], block.end[0]
+        data = _load_bucket(ds_in, ds_path, bucket_id)
         if data is None:
+            ds[bucket_begin:bucket_end] = 0
             continue
-
-        # TODO support more features
-        # extract ids and features
-        ids = data[::3].astype('uint64')
-        counts = data[1::3]
-        mean = data[2::3]
-
-        # check if any ids overlap with our id range
-        overlap_mask = np.logical_and(ids >= node_begin,
-                                      ids < node_end)
-        if np.sum(overlap_mask) == 0:
-            continue
-
-        overlapping_ids = ids[overlap_mask]
-        overlapping_ids -= node_begin
-        overlapping_counts = counts[overlap_mask]
-        overlapping_mean = mean[overlap_mask]
-
-        # calculate cumulative moving average
-        prev_counts = out_counts[overlapping_ids]
-        tot_counts = (prev_counts + overlapping_counts)
-        out_feats = (overlapping_counts * overlapping_mean + prev_counts * out_features[overlapping_ids]) / tot_counts
-        out_features[overlapping_ids] = out_feats
-        out_counts[overlapping_ids] += overlapping_counts
-
-    ds[node_begin:node_end] = out_features
+        out_features = _merge_bucket(data, node_blocking.blockShape[0])
+        ds[bucket_begin:bucket_end] = out_features[:bucket_end - bucket_begin]
 
 
 def merge_region_features(job_id, config_path):
@@ -150,15 +158,10 @@ def merge_region_features(job_id, config_path):
         ds = f[output_key]
         n_nodes = ds.shape[0]
 
+        # the node blocks are the buckets of the block features
         node_blocking = nt.blocking([0], [n_nodes], [node_chunk_size])
-        node_begin = node_blocking.getBlock(node_block_list[0]).begin[0]
-        node_end = node_blocking.getBlock(node_block_list[-1]).end[0]
-
-        shape = list(ds_in.shape)
-        chunks = list(ds_in.chunks)
-        blocking = nt.blocking([0, 0, 0], shape, chunks)
-
-        _extract_and_merge_region_features(blocking, ds_in, ds, node_begin, node_end)
+        _extract_and_merge_region_features(ds_in, os.path.join(tmp_path, tmp_key),
+                                           ds, node_blocking, node_block_list)
 
     fu.log_job_success(job_id)
 
@@ -12,6 +12,7 @@ import vigra
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -40,24 +41,24 @@ class RegionFeaturesBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'ignore_label': 0})
+        config.update({'ignore_label': 0, 'bucket_size': 10000})
         return config
 
     def clean_up_for_retry(self, block_list):
         super().clean_up_for_retry(block_list)
         # TODO remove any output of failed blocks because it might be corrupted
 
-    def run_impl(self):
-        # get the global config and init configs
-        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
-        self.init(shebang)
+    def stage_config(self, block_shape):
+        """ Get the job config and create the output dataset.
 
+        Returns the config and the shape of the volume that is processed blockwise.
+        """
         # load the task config
         config = self.get_task_config()
 
         # temporary output dataset
         output_path = os.path.join(self.tmp_folder, 'region_features_tmp.n5')
-        output_key = 'block_feats'
+        output_key = 'bucket_feats'
 
         # TODO make the scale at which we extract features accessible
         # update the config with input and output paths and keys
@@ -69,10 +70,30 @@ class RegionFeaturesBase(luigi.Task):
         # TODO support multi-channel
         shape = vu.get_shape(self.input_path, self.input_key)
 
-        # require the temporary output data-set
+        # the block results are partitioned into buckets of consecutive node ids,
+        # so that the merge jobs only need to read the buckets of their node range
+        with vu.file_reader(self.labels_path, 'r') as f:
+            n_labels = int(f[self.labels_key].attrs['maxId']) + 1
+        bucket_size = min(config.get('bucket_size', 10000), n_labels)
+        n_buckets = (n_labels + bucket_size - 1) // bucket_size
+        n_blocks = nt.blocking([0, 0, 0], list(shape), list(block_shape)).numberOfBlocks
+        config.update({'bucket_size': bucket_size})
+
+        # require the temporary output data-set,
+        # the chunk (block_id, bucket_id) holds the results of the block for this bucket;
+        # n5 stores it at 'bucket_id/block_id', so the chunks of a bucket share a directory
         f_out = z5py.File(output_path)
-        f_out.require_dataset(output_key, shape=shape, compression='gzip',
-                              chunks=tuple(block_shape), dtype='float32')
+        ds_out = f_out.require_dataset(output_key, shape=(n_blocks, n_buckets), compression='gzip',
+                                       chunks=(1, 1), dtype='float32')
+        ds_out.attrs['bucket_size'] = bucket_size
+        return config, shape
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        config, shape = self.stage_config(block_shape)
 
         if self.n_retries == 0:
             # get shape and make block config
@@ -114,28 +135,25 @@ class RegionFeaturesLSF(RegionFeaturesBase, LSFTask):
 #
 
 
-def _block_features(block_id, blocking,
-                    ds_in, ds_labels, ds_out,
-                    ignore_label):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
-
+def _read_block(block_id, blocking, ds_in, ds_labels, ignore_label):
+    bb = vu.block_to_bb(blocking.getBlock(block_id))
     labels = ds_labels[bb]
 
     # check if we have an ignore label and return
     # if this block is purely ignore label
     if ignore_label is not None:
         if np.sum(labels != ignore_label) == 0:
-            fu.log_block_success(block_id)
-            return
+            return None
+    return ds_in[bb], labels
+
 
+def _compute_features(input_, labels, ignore_label):
     # TODO support multichannel
     # get global normalization values
     min_val = 0
-    max_val = 255. if ds_in.dtype == np.dtype('uint8') else 1.
+    max_val = 255. if input_.dtype == np.dtype('uint8') else 1.
 
-    input_ = vu.normalize(ds_in[bb], min_val, max_val)
+    input_ = vu.normalize(input_, min_val, max_val)
     # TODO support more features
     # TODO we might want to check for overflows and in general allow vigra to
     # work with uint64s ...
@@ -146,22 +164,58 @@ def _block_features(block_id, blocking,
     counts = feats['count']
     feats = feats['mean']
 
-    # make serialization
     ids = np.unique(labels)
-    data = np.zeros(3 * len(ids), dtype='float32')
-    # write the ids
-    data[::3] = ids.astype('float32')
-    # write the counts
-    data[1::3] = counts[ids]
-    # write the features
-    data[2::3] = feats[ids]
-
-    chunks = blocking.blockShape
-    chunk_id = tuple(b.start // ch for b, ch in zip(bb, chunks))
-    ds_out.write_chunk(chunk_id, data, True)
+    return ids, counts[ids], feats[ids]
+
+
+def _write_block(block_id, ds_out, bucket_size, features):
+    ids, counts, feats = features
+    # the ids are sorted, so each bucket corresponds to a slice of the features
+    buckets = ids // bucket_size
+    bucket_ids = np.unique(buckets)
+    bucket_starts = np.searchsorted(buckets, bucket_ids)
+    bucket_stops = np.append(bucket_starts[1:], len(ids))
+    for bucket_id, start, stop in zip(bucket_ids, bucket_starts, bucket_stops):
+        # make serialization
+        # the ids are stored relative to the bucket start, so they can be
+        # represented exactly as float32
+        data = np.zeros(3 * (stop - start), dtype='float32')
+        # write the ids
+        data[::3] = ids[start:stop] - bucket_id * bucket_size
+        # write the counts
+        data[1::3] = counts[start:stop]
+        # write the features
+        data[2::3] = feats[start:stop]
+        ds_out.write_chunk((block_id, int(bucket_id)), data, True)
+
+
+def _block_features(block_id, blocking,
+                    ds_in, ds_labels, ds_out,
+                    ignore_label, bucket_size):
+    fu.log("start processing block %i" % block_id)
+    inputs = _read_block(block_id, blocking, ds_in, ds_labels, ignore_label)
+    if inputs is not None:
+        features = _compute_features(inputs[0], inputs[1], ignore_label)
+        _write_block(block_id, ds_out, bucket_size, features)
     fu.log_block_success(block_id)
 
 
+def fused_stage(job_id, config, store):
+    """ Block function for fused jobs, see fusion.FusedBlocks.
+    """
+    ds_in = store.dataset(config['input_path'], config['input_key'])
+    ds_labels = store.dataset(config['labels_path'], config['labels_key'])
+    ds_out = store.dataset(config['output_path'], config['output_key'], mode='a')
+    ignore_label = config['ignore_label']
+    bucket_size = config['bucket_size']
+
+    def _stage(block_id, blocking):
+        _block_features(block_id, blocking,
+                        ds_in, ds_labels, ds_out,
+                        ignore_label, bucket_size)
+    return _stage
+
+
 def region_features(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -171,7 +225,6 @@ def region_features(job_id, config_path):
     with open(config_path, 'r') as f:
         config = json.load(f)
 
-    block_list = config['block_list']
     input_path = config['input_path']
     input_key = config['input_key']
     labels_path = config['labels_path']
@@ -180,6 +233,7 @@ def region_features(job_id, config_path):
     output_key = config['output_key']
     block_shape = config['block_shape']
     ignore_label = config['ignore_label']
+    bucket_size = config['bucket_size']
 
     with vu.file_reader(input_path) as f_in,\
             vu.file_reader(labels_path) as f_l,\
@@ -189,13 +243,19 @@ def region_features(job_id, config_path):
         ds_labels = f_l[labels_key]
         ds_out = f_out[output_key]
 
-        shape = ds_out.shape
+        shape = ds_labels.shape
         blocking = nt.blocking([0, 0, 0], shape, block_shape)
 
-        for block_id in block_list:
-            _block_features(block_id, blocking,
-                            ds_in, ds_labels, ds_out,
-                            ignore_label)
+        # the blocks are computed in parallel, the pipeline bounds
+        # the number of blocks that are held in memory
+        pipeline = BlockPipeline(lambda block_id: _read_block(block_id, blocking,
+                                                              ds_in, ds_labels, ignore_label),
+                                 lambda block_id, inputs: _compute_features(inputs[0], inputs[1],
+                                                                            ignore_label),
+                                 lambda block_id, features: _write_block(block_id, ds_out,
+                                                                         bucket_size, features),
+                                 n_threads=config.get('threads_per_job', 1))
+        pipeline.run(fu.iterate_blocks(config))
 
     fu.log_job_success(job_id)
 
@@ -0,0 +1 @@
+from .fused_blocks import FusedBlocksLocal, FusedBlocksSlurm, FusedBlocksLSF
@@ -0,0 +1,310 @@
+#! /bin/python
+
+import os
+import sys
+import json
+import time
+import importlib
+
+import numpy as np
+import luigi
+import nifty.tools as nt
+
+import cluster_tools.utils.volume_utils as vu
+import cluster_tools.utils.function_utils as fu
+from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
+
+
+# block tasks that can be fused: task name -> (module, task class prefix)
+# the modules implement `fused_stage(job_id, config, store)`, which returns
+# the function that processes a single block, reading and writing via the store
+FUSABLE_TASKS = {'image_filter': ('cluster_tools.features.image_filter', 'ImageFilter'),
+                 'region_features': ('cluster_tools.features.region_features', 'RegionFeatures'),
+                 'block_edge_features': ('cluster_tools.features.block_edge_features',
+                                         'BlockEdgeFeatures'),
+                 'block_node_labels': ('cluster_tools.node_labels.block_node_labels',
+                                       'BlockNodeLabels'),
+                 'block_morphology': ('cluster_tools.morphology.block_morphology',
+                                      'BlockMorphology')}
+
+
+#
+# Fused Blocks Tasks
+#
+
+class FusedBlocksBase(luigi.Task):
+    """ FusedBlocks base class
+
+    Runs a chain of block tasks per block in one job.
+    Volumes that were read or written by a stage are kept in memory for the
+    following stages of the same block, so each block is only read once.
+    Volumes listed in `intermediates` are not written to file at all.
+
+    This is a generic helper for chains of the tasks in `FUSABLE_TASKS`, which is
+    not used by any of the workflows yet. The watershed and the sub-graph extraction
+    are not fusable and the block edge features can only be fused with filters.
+    """
+
+    task_name = 'fused_blocks'
+    src_file = os.path.abspath(__file__)
+
+    # the stages, given by dicts with the 'task_name' of a fusable task
+    # and the parameters of this task, e.g.
+    # {'task_name': 'block_morphology', 'input_path': ..., 'input_key': ...,
+    #  'output_path': ..., 'output_key': ...}
+    stages = luigi.ListParameter()
+    # volumes (path, key) that are written by a stage and read by
+    # the following stages; these are not written to file
+    intermediates = luigi.ListParameter(default=[])
+    dependency = luigi.TaskParameter()
+
+    def requires(self):
+        return self.dependency
+
+    def clean_up_for_retry(self, block_list):
+        super().clean_up_for_retry(block_list)
+        # TODO remove any output of failed blocks because it might be corrupted
+
+    def _stage_task(self, params):
+        params = dict(params)
+        task_name = params.pop('task_name')
+        if task_name not in FUSABLE_TASKS:
+            raise ValueError("Task %s cannot be fused, fusable tasks are %s" % (task_name,
+                                                                               ', '.join(FUSABLE_TASKS)))
+        module_name, class_name = FUSABLE_TASKS[task_name]
+        task_cls = getattr(importlib.import_module(module_name), class_name + 'Local')
+        if 'dependency' in task_cls.get_param_names():
+            params['dependency'] = self.dependency
+        task = task_cls(tmp_folder=self.tmp_folder, max_jobs=self.max_jobs,
+                        config_dir=self.config_dir, **params)
+        return task, module_name
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        # load the task config
+        config = self.get_task_config()
+
+        # get the job configs of the stages and check that they
+        # are processed with the same blocking
+        stages = []
+        shape = None
+        for params in self.stages:
+            task, module_name = self._stage_task(params)
+            stage_config, stage_shape = task.stage_config(block_shape)
+            stage_shape = list(stage_shape)
+            if shape is None:
+                shape = stage_shape
+            elif shape != stage_shape:
+                raise RuntimeError("Cannot fuse %s, shape %s does not match %s" % (task.task_name,
+                                                                                   str(stage_shape),
+                                                                                   str(shape)))
+            stages.append({'task_name': task.task_name, 'module': module_name,
+                           'config': stage_config})
+
+        config.update({'stages': stages, 'shape': shape, 'block_shape': block_shape,
+                       'intermediates': [list(inter) for inter in self.intermediates]})
+
+        if self.n_retries == 0:
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+        else:
+            block_list = self.block_list
+            self.clean_up_for_retry(block_list)
+
+        n_jobs = min(len(block_list), self.max_jobs)
+        # prime and run the jobs
+        self.prepare_jobs(n_jobs, block_list, config)
+        self.submit_jobs(n_jobs)
+
+        # wait till jobs finish and check for job success
+        self.wait_for_jobs()
+        self.check_jobs(n_jobs)
+
+
+class FusedBlocksLocal(FusedBlocksBase, LocalTask):
+    """ FusedBlocks on local machine
+    """
+    pass
+
+
+class FusedBlocksSlurm(FusedBlocksBase, SlurmTask):
+    """ FusedBlocks on slurm cluster
+    """
+    pass
+
+
+class FusedBlocksLSF(FusedBlocksBase, LSFTask):
+    """ FusedBlocks on lsf cluster
+    """
+    pass
+
+
+#
+# Implementation
+#
+
+def _normalize_bb(bb, shape):
+    if not isinstance(bb, tuple):
+        bb = (bb,)
+    bb = bb + (slice(None),) * (len(shape) - len(bb))
+    return tuple(slice(*b.indices(sh)[:2]) for b, sh in zip(bb, shape))
+
+
+def _contains(outer, inner):
+    return all(ob.start <= ib.start and ib.stop <= ob.stop
+               for ob, ib in zip(outer, inner))
+
+
+class BlockStore(object):
+    """ Data of the block that is currently processed by a fused job.
+    """
+    def __init__(self, shape, intermediates):
+        self.shape = tuple(shape)
+        self.intermediates = set((path, key) for path, key in intermediates)
+        self.modes = {}
+        self.files = {}
+        self.data = {}
+        self.profile = fu.BlockProfile()
+
+    def dataset(self, path, key, mode='r'):
+        """ Get dataset that is read from / written to memory if possible.
+        """
+        # the files are opened when the first block is processed,
+        # after all stages have requested their datasets
+        if (path, key) not in self.intermediates and self.modes.get(path, 'r') == 'r':
+            self.modes[path] = mode
+        return StoredDataset(self, path, key)
+
+    def _file_dataset(self, path, key):
+        if path not in self.files:
+            self.files[path] = vu.file_reader(path, self.modes.get(path, 'r'))
+        return self.files[path][key]
+
+    def _lookup(self, path, key, bb):
+        for stored_bb, data in self.data.get((path, key), []):
+            if len(stored_bb) == len(bb) and _contains(stored_bb, bb):
+                local_bb = tuple(slice(b.start - sb.start, b.stop - sb.start)
+                                 for b, sb in zip(bb, stored_bb))
+                return data[local_bb]
+        return None
+
+    def _add(self, path, key, bb, data):
+        self.data.setdefault((path, key), []).append((bb, data))
+
+    def next_block(self):
+        self.data = {}
+        self.profile = fu.BlockProfile()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class StoredDataset(object):
+    """ Dataset proxy that serves data of the current block from memory.
+    """
+    def __init__(self, store, path, key):
+        self.store = store
+        self.path = path
+        self.key = key
+        self.is_intermediate = (path, key) in store.intermediates
+
+    @property
+    def ds(self):
+        return None if self.is_intermediate else self.store._file_dataset(self.path, self.key)
+
+    @property
+    def shape(self):
+        return self.store.shape if self.is_intermediate else self.ds.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        if not self.is_intermediate:
+            return self.ds.dtype
+        stored = self.store.data.get((self.path, self.key), [])
+        if not stored:
+            raise RuntimeError("Intermediate %s:%s was not written yet" % (self.path, self.key))
+        return stored[0][1].dtype
+
+    def __getattr__(self, name):
+        # forward everything else (attrs, write_chunk, ...) to the file dataset
+        if name in ('store', 'path', 'key', 'is_intermediate'):
+            raise AttributeError(name)
+        if self.is_intermediate:
+            raise AttributeError("Intermediate %s:%s has no attribute %s" % (self.path, self.key, name))
+        return getattr(self.ds, name)
+
+    def __getitem__(self, bb):
+        bb = _normalize_bb(bb, self.shape)
+        data = self.store._lookup(self.path, self.key, bb)
+        if data is not None:
+            # the stages may change the data in place
+            return data.copy()
+        if self.is_intermediate:
+            raise RuntimeError("Intermediate %s:%s is read outside of the region it was written to; "
+                               "stages that read intermediates must not use a halo" % (self.path,
+                                                                                       self.key))
+        data = self.store.profile.read(self.ds, bb)
+        self.store._add(self.path, self.key, bb, data)
+        return data.copy()
+
+    def __setitem__(self, bb, data):
+        bb = _normalize_bb(bb, self.shape)
+        data = np.array(data)
+        self.store._add(self.path, self.key, bb, data)
+        if not self.is_intermediate:
+            self.store.profile.write(self.ds, bb, data)
+
+
+def _fused_block(block_id, blocking, stage_functions, store):
+    fu.log("start processing fused block %i" % block_id)
+    store.next_block()
+    with fu.mute_block_success():
+        for stage_function in stage_functions:
+            stage_function(block_id, blocking)
+    # everything that was not measured as reading or writing by the store
+    # is counted as compute time
+    profile = store.profile
+    profile.times['compute'] = max(time.time() - profile.start -
+                                   profile.times['read'] - profile.times['write'], 0.)
+    fu.log_block_success(block_id, profile)
+
+
+def fused_blocks(job_id, config_path):
+
+    fu.log("start processing job %i" % job_id)
+    fu.log("reading config from %s" % config_path)
+
+    # get the config
+    with open(config_path) as f:
+        config = json.load(f)
+    shape = config['shape']
+    block_shape = config['block_shape']
+
+    store = BlockStore(shape, config['intermediates'])
+    stage_functions = []
+    for stage in config['stages']:
+        fu.log("fusing stage %s" % stage['task_name'])
+        module = importlib.import_module(stage['module'])
+        stage_functions.append(module.fused_stage(job_id, stage['config'], store))
+
+    blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+    for block_id in fu.iterate_blocks(config):
+        _fused_block(block_id, blocking, stage_functions, store)
+    store.close()
+
+    fu.log_job_success(job_id)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    assert os.path.exists(path), path
+    job_id = int(os.path.split(path)[1].split('.')[0].split('_')[-1])
+    fused_blocks(job_id, path)
@@ -1 +1 @@
-from .graph_workflow import GraphWorkflow
+from .graph_workflow import GraphWorkflow, GraphAndFeaturesWorkflow
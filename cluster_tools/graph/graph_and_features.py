@@ -0,0 +1,324 @@
+#! /bin/python
+
+import os
+import sys
+import json
+
+import numpy as np
+import luigi
+import z5py
+import nifty.tools as nt
+
+import cluster_tools.utils.volume_utils as vu
+import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.filter_utils import FilterBank
+from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
+from cluster_tools.features.block_edge_features import (_block_bounding_boxes, _load_input,
+                                                        _write_features)
+
+
+#
+# Graph And Features Tasks
+#
+
+
+class GraphAndFeaturesBase(luigi.Task):
+    """ GraphAndFeatures base class
+
+    Extracts the sub-graphs and the edge features of the blocks in one pass,
+    so that each label block is only read once.
+    The sub-graphs and feature blocks have the same format as the ones
+    from InitialSubGraphs and BlockEdgeFeatures, but the quantiles of the features
+    are computed exactly instead of from a histogram.
+    """
+
+    task_name = 'graph_and_features'
+    src_file = os.path.abspath(__file__)
+
+    # input volumes, labels, graph and features
+    input_path = luigi.Parameter()
+    input_key = luigi.Parameter()
+    labels_path = luigi.Parameter()
+    labels_key = luigi.Parameter()
+    graph_path = luigi.Parameter()
+    output_path = luigi.Parameter()
+    #
+    dependency = luigi.TaskParameter()
+
+    def requires(self):
+        return self.dependency
+
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        config.update({'ignore_label': True, 'filters': None, 'sigmas': None,
+                       'halo': [0, 0, 0], 'apply_in_2d': False,
+                       'channel_agglomeration': 'mean', 'chunk_cache_size': 0})
+        return config
+
+    def clean_up_for_retry(self, block_list):
+        super().clean_up_for_retry(block_list)
+        # TODO remove any output of failed blocks because it might be corrupted
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        # load the task config
+        config = self.get_task_config()
+
+        # make graph file and write shape as attribute
+        shape = vu.get_shape(self.labels_path, self.labels_key)
+        with vu.file_reader(self.graph_path) as f:
+            f.attrs['shape'] = shape
+            f.require_group('s0/sub_graphs')
+
+        # require output group
+        with vu.file_reader(self.output_path) as f:
+            f.require_group('blocks')
+
+        config.update({'input_path': self.input_path, 'input_key': self.input_key,
+                       'labels_path': self.labels_path, 'labels_key': self.labels_key,
+                       'graph_path': self.graph_path, 'output_path': self.output_path,
+                       'block_shape': block_shape})
+
+        if self.n_retries == 0:
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+        else:
+            block_list = self.block_list
+            self.clean_up_for_retry(block_list)
+
+        n_jobs = min(len(block_list), self.max_jobs)
+        # prime and run the jobs
+        self.prepare_jobs(n_jobs, block_list, config)
+        self.submit_jobs(n_jobs)
+
+        # wait till jobs finish and check for job success
+        self.wait_for_jobs()
+        self.check_jobs(n_jobs)
+
+
+class GraphAndFeaturesLocal(GraphAndFeaturesBase, LocalTask):
+    """ GraphAndFeatures on local machine
+    """
+    pass
+
+
+class GraphAndFeaturesSlurm(GraphAndFeaturesBase, SlurmTask):
+    """ GraphAndFeatures on slurm cluster
+    """
+    pass
+
+
+class GraphAndFeaturesLSF(GraphAndFeaturesBase, LSFTask):
+    """ GraphAndFeatures on lsf cluster
+    """
+    pass
+
+
+#
+# Implementation
+#
+
+
+def _extract_sub_graph(labels, ignore_label):
+    """ Get the nodes and the lexicographically sorted edges of the region graph of the labels,
+    in accordance with ndist.computeMergeableRegionGraph.
+    Also returns the faces between the labels, given by the bounding boxes of the voxel pairs
+    along each axis and the masks of the pairs that are edges, and the edge ids of the faces.
+    """
+    nodes = np.unique(labels)
+    if ignore_label:
+        nodes = nodes[nodes != 0]
+
+    uv_ids, faces = [], []
+    for axis in range(labels.ndim):
+        bb_u = tuple(slice(0, -1) if d == axis else slice(None) for d in range(labels.ndim))
+        bb_v = tuple(slice(1, None) if d == axis else slice(None) for d in range(labels.ndim))
+        u, v = labels[bb_u], labels[bb_v]
+        is_edge = u != v
+        if ignore_label:
+            is_edge = np.logical_and(is_edge, np.logical_and(u != 0, v != 0))
+        u, v = u[is_edge], v[is_edge]
+        uv_ids.append(np.stack([np.minimum(u, v), np.maximum(u, v)], axis=1))
+        faces.append((bb_u, bb_v, is_edge))
+    uv_ids = np.concatenate(uv_ids, axis=0).astype('uint64')
+    if len(uv_ids) > 0:
+        uv_ids, face_edges = np.unique(uv_ids, axis=0, return_inverse=True)
+    else:
+        face_edges = np.zeros(0, dtype='int64')
+    return nodes.astype('uint64'), uv_ids, faces, face_edges.ravel()
+
+
+def _write_sub_graph(f_graph, block_key, nodes, edges, bb, ignore_label):
+    g = f_graph.require_group(block_key)
+    if len(nodes) > 0:
+        g.create_dataset('nodes', data=nodes, chunks=nodes.shape)
+    if len(edges) > 0:
+        g.create_dataset('edges', data=edges, chunks=edges.shape)
+    g.attrs['numberOfNodes'] = len(nodes)
+    g.attrs['numberOfEdges'] = len(edges)
+    g.attrs['ignoreLabel'] = bool(ignore_label)
+    g.attrs['roiBegin'] = [b.start for b in bb]
+    g.attrs['roiEnd'] = [b.stop for b in bb]
+
+
+QUANTILES = (.1, .25, .5, .75, .9)
+
+
+def _accumulate_faces(values, faces, face_edges, n_edges, with_size):
+    """ Accumulate the values of both voxels of the faces for each edge,
+    in accordance with ndist.accumulateInput: mean, variance, min, quantiles and max,
+    and optionally the number of faces.
+    """
+    # the values of the first and then of the second voxels of the faces along all axes
+    values = np.concatenate([values[bb_u][is_edge] for bb_u, _, is_edge in faces] +
+                            [values[bb_v][is_edge] for _, bb_v, is_edge in faces]).astype('float64')
+    edges = np.concatenate([face_edges, face_edges])
+    counts = np.bincount(edges, minlength=n_edges)
+    mean = np.bincount(edges, weights=values, minlength=n_edges) / counts
+    variance = np.bincount(edges, weights=(values - mean[edges]) ** 2, minlength=n_edges) / counts
+
+    # sort the values by edge, so the values of each edge are consecutive and sorted
+    values = values[np.lexsort((values, edges))]
+    begins = np.cumsum(counts) - counts
+    features = [mean, variance, values[begins]]
+    for quantile in QUANTILES:
+        pos = quantile * (counts - 1)
+        lower = np.floor(pos).astype('int64')
+        upper = np.minimum(lower + 1, counts - 1)
+        frac = pos - lower
+        features.append((1. - frac) * values[begins + lower] + frac * values[begins + upper])
+    features.append(values[begins + counts - 1])
+    if with_size:
+        features.append(counts / 2)
+    return np.stack(features, axis=1).astype('float32')
+
+
+def _accumulate_boundaries(input_, faces, face_edges, n_edges, bb_local):
+    input_ = input_[bb_local]
+    if input_.dtype == np.dtype('uint8'):
+        input_ = input_.astype('float32') / 255.
+    return _accumulate_faces(input_, faces, face_edges, n_edges, True)
+
+
+def _accumulate_filters(input_, faces, face_edges, n_edges, bb_local, filter_bank):
+    # the filter responses are cropped to the labels before they are accumulated,
+    # the number of faces is only added after the last channel of the last response
+    responses = filter_bank(input_, bb_local)
+    channels = [response[..., c] if response.ndim == 4 else response
+                for response in responses
+                for c in range(response.shape[-1] if response.ndim == 4 else 1)]
+    return np.concatenate([_accumulate_faces(channel, faces, face_edges, n_edges,
+                                             channel_id == len(channels) - 1)
+                           for channel_id, channel in enumerate(channels)], axis=1)
+
+
+def _graph_and_features_block(block_id, blocking,
+                              ds_in, ds_labels, f_graph,
+                              out_prefix, filter_bank, halo, ignore_label,
+                              channel_agglomeration):
+    fu.log("start processing block %i" % block_id)
+    profile = fu.BlockProfile()
+
+    # the labels are read once with the halo of one pixel in positive direction
+    # and are used for both the graph extraction and the feature accumulation
+    bb_in, bb, bb_local = _block_bounding_boxes(block_id, blocking, ds_labels.shape, halo)
+    labels = profile.read(ds_labels, bb)
+
+    with profile.phase('compute'):
+        nodes, edges, faces, face_edges = _extract_sub_graph(labels, ignore_label)
+    block_key = 's0/sub_graphs/block_%i' % block_id
+    with profile.phase('write'):
+        _write_sub_graph(f_graph, block_key, nodes, edges, bb, ignore_label)
+    profile.bytes_written += nodes.nbytes + edges.nbytes
+
+    if len(edges) == 0:
+        fu.log("block %i has no edges" % block_id)
+        fu.log_block_success(block_id, profile)
+        return
+
+    # the features are accumulated over the faces found in the graph extraction,
+    # whose edge ids are given by the order of the sorted edges
+    n_edges = len(edges)
+    if filter_bank is None:
+        input_ = profile.read(ds_in, bb_in)
+        with profile.phase('compute'):
+            edge_features = _accumulate_boundaries(input_, faces, face_edges, n_edges, bb_local)
+    else:
+        input_ = _load_input(ds_in, bb_in, channel_agglomeration, profile)
+        with profile.phase('compute'):
+            edge_features = _accumulate_filters(input_, faces, face_edges, n_edges, bb_local,
+                                                filter_bank)
+
+    _write_features(edge_features, out_prefix, block_id, profile)
+    fu.log_block_success(block_id, profile)
+
+
+def graph_and_features(job_id, config_path):
+
+    fu.log("start processing job %i" % job_id)
+    fu.log("reading config from %s" % config_path)
+
+    # get the config
+    with open(config_path) as f:
+        config = json.load(f)
+    input_path = config['input_path']
+    input_key = config['input_key']
+    labels_path = config['labels_path']
+    labels_key = config['labels_key']
+    graph_path = config['graph_path']
+    output_path = config['output_path']
+    block_shape = config['block_shape']
+    ignore_label = config.get('ignore_label', True)
+
+    filters = config.get('filters', None)
+    sigmas = config.get('sigmas', None)
+    # affinity maps with offsets are accumulated by nifty from file,
+    # so without filters we only support boundary maps
+    if filters is None:
+        assert len(vu.get_shape(input_path, input_key)) == 3,\
+            "Need filters for multi-channel input"
+        filter_bank = None
+    else:
+        assert sigmas is not None, "Need sigma values"
+        filter_bank = FilterBank(filters, sigmas, config.get('apply_in_2d', False),
+                                 config.get('threads_per_job', 1))
+    halo = config.get('halo', [0, 0, 0])
+    channel_agglomeration = config.get('channel_agglomeration', 'mean')
+    assert channel_agglomeration in ('mean', 'max', 'min', None)
+    cache_size = config.get('chunk_cache_size', 0)
+
+    shape = vu.get_shape(labels_path, labels_key)
+    blocking = nt.blocking(roiBegin=[0, 0, 0],
+                           roiEnd=list(shape),
+                           blockShape=list(block_shape))
+
+    out_prefix = os.path.join(output_path, 'blocks', 'block_')
+
+    # the input is read with a halo and the labels with an overlap of one pixel,
+    # so we cache the chunks of both
+    with vu.file_reader(input_path, 'r', cache_size=cache_size) as f,\
+            vu.file_reader(labels_path, 'r', cache_size=cache_size) as f_l,\
+            z5py.File(graph_path) as f_graph:
+        ds_in = f[input_key]
+        ds_labels = f_l[labels_key]
+        for block_id in fu.iterate_blocks(config):
+            _graph_and_features_block(block_id, blocking,
+                                      ds_in, ds_labels, f_graph,
+                                      out_prefix, filter_bank, halo, ignore_label,
+                                      channel_agglomeration)
+        if cache_size > 0:
+            fu.log(f.cache.summary())
+            fu.log(f_l.cache.summary())
+
+    fu.log_job_success(job_id)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    assert os.path.exists(path), path
+    job_id = int(os.path.split(path)[1].split('.')[0].split('_')[-1])
+    graph_and_features(job_id, path)
@@ -6,6 +6,8 @@ from ..cluster_tasks import WorkflowBase
 from . import initial_sub_graphs as initial_tasks
 from . import merge_sub_graphs as merge_tasks
 from . import map_edge_ids as map_tasks
+from . import graph_and_features as graph_feat_tasks
+from ..features import merge_edge_features as merge_feat_tasks
 
 
 class GraphWorkflow(WorkflowBase):
@@ -77,3 +79,82 @@ class GraphWorkflow(WorkflowBase):
                         'merge_sub_graphs': merge_tasks.MergeSubGraphsLocal.default_task_config(),
                         'map_edge_ids': map_tasks.MapEdgeIdsLocal.default_task_config()})
         return configs
+
+
+class GraphAndFeaturesWorkflow(WorkflowBase):
+    """ Compute the graph and the edge features in one pass over the label blocks.
+
+    Gives the same result as GraphWorkflow with n_scales=1 followed by EdgeFeaturesWorkflow.
+    """
+    input_path = luigi.Parameter()
+    input_key = luigi.Parameter()
+    labels_path = luigi.Parameter()
+    labels_key = luigi.Parameter()
+    graph_path = luigi.Parameter()
+    graph_key = luigi.Parameter()
+    output_path = luigi.Parameter()
+    output_key = luigi.Parameter()
+    max_jobs_merge = luigi.IntParameter(default=1)
+
+    # for now we only support n5 / zarr input labels
+    @staticmethod
+    def _check_input(path):
+        ending = path.split('.')[-1]
+        assert ending.lower() in ('zr', 'zarr', 'n5'),\
+            "Only support n5 and zarr files, not %s" % ending
+
+    def requires(self):
+        self._check_input(self.input_path)
+        self._check_input(self.labels_path)
+
+        graph_feat_task = getattr(graph_feat_tasks,
+                                  self._get_task_name('GraphAndFeatures'))
+        dep = graph_feat_task(tmp_folder=self.tmp_folder,
+                              max_jobs=self.max_jobs,
+                              config_dir=self.config_dir,
+                              input_path=self.input_path,
+                              input_key=self.input_key,
+                              labels_path=self.labels_path,
+                              labels_key=self.labels_key,
+                              graph_path=self.graph_path,
+                              output_path=self.output_path,
+                              dependency=self.dependency)
+        merge_task = getattr(merge_tasks,
+                             self._get_task_name('MergeSubGraphs'))
+        dep = merge_task(tmp_folder=self.tmp_folder,
+                         max_jobs=self.max_jobs,
+                         config_dir=self.config_dir,
+                         graph_path=self.graph_path,
+                         output_key=self.graph_key,
+                         scale=0,
+                         merge_complete_graph=True,
+                         dependency=dep)
+        map_task = getattr(map_tasks,
+                           self._get_task_name('MapEdgeIds'))
+        dep = map_task(tmp_folder=self.tmp_folder,
+                       max_jobs=self.max_jobs,
+                       config_dir=self.config_dir,
+                       graph_path=self.graph_path,
+                       input_key=self.graph_key,
+                       scale=0,
+                       dependency=dep)
+        merge_feat_task = getattr(merge_feat_tasks,
+                                  self._get_task_name('MergeEdgeFeatures'))
+        dep = merge_feat_task(tmp_folder=self.tmp_folder,
+                              max_jobs=self.max_jobs_merge,
+                              config_dir=self.config_dir,
+                              graph_path=self.graph_path,
+                              graph_key=self.graph_key,
+                              output_path=self.output_path,
+                              output_key=self.output_key,
+                              dependency=dep)
+        return dep
+
+    @staticmethod
+    def get_config():
+        configs = super(GraphAndFeaturesWorkflow, GraphAndFeaturesWorkflow).get_config()
+        configs.update({'graph_and_features': graph_feat_tasks.GraphAndFeaturesLocal.default_task_config(),
+                        'merge_sub_graphs': merge_tasks.MergeSubGraphsLocal.default_task_config(),
+                        'map_edge_ids': map_tasks.MapEdgeIdsLocal.default_task_config(),
+                        'merge_edge_features': merge_feat_tasks.MergeEdgeFeaturesLocal.default_task_config()})
+        return configs
@@ -3,7 +3,9 @@
 import os
 import sys
 import json
+from concurrent import futures
 
+import numpy as np
 import luigi
 import nifty.tools as nt
 import nifty.distributed as ndist
@@ -91,6 +93,58 @@ class MapEdgeIdsLSF(MapEdgeIdsBase, LSFTask):
 #
 
 
+# marks blocks without edges in the edge block index
+EMPTY_RANGE = [np.iinfo('uint64').max, 0]
+
+
+def edge_block_index_key(scale):
+    return 's%i/edge_block_index' % scale
+
+
+def _edge_id_range(f, block_key):
+    group = f[block_key]
+    if 'edgeIds' not in group:
+        return EMPTY_RANGE
+    edge_ids = group['edgeIds'][:]
+    if len(edge_ids) == 0:
+        return EMPTY_RANGE
+    return [edge_ids.min(), edge_ids.max()]
+
+
+def _write_edge_block_index(graph_path, block_prefix, scale, block_list, n_threads):
+    """ Write the index of the global edge ids contained in the sub-graph blocks.
+
+    The index stores the block id and the min and max edge id for each block,
+    so that tasks that process a range of edge ids only need to load the blocks
+    that overlap with it, see `blocks_in_edge_range`.
+    """
+    with vu.file_reader(graph_path) as f:
+        with futures.ThreadPoolExecutor(n_threads) as tp:
+            tasks = [tp.submit(_edge_id_range, f, block_prefix + str(block_id))
+                     for block_id in block_list]
+            ranges = [t.result() for t in tasks]
+        index = np.concatenate([np.array(block_list, dtype='uint64')[:, None],
+                                np.array(ranges, dtype='uint64').reshape((-1, 2))], axis=1)
+        ds = f.require_dataset(edge_block_index_key(scale), shape=index.shape,
+                               chunks=index.shape, dtype='uint64', compression='gzip')
+        ds[:] = index
+
+
+def blocks_in_edge_range(graph_path, scale, block_ids, edge_begin, edge_end):
+    """ Get the blocks in `block_ids` that contain edges in the range [edge_begin, edge_end).
+
+    Returns all block ids if the graph does not have an edge block index.
+    """
+    key = edge_block_index_key(scale)
+    with vu.file_reader(graph_path, 'r') as f:
+        if key not in f:
+            fu.log("graph does not have an edge block index")
+            return block_ids
+        index = f[key][:]
+    in_range = np.logical_and(index[:, 1] < edge_end, index[:, 2] >= edge_begin)
+    return np.intersect1d(index[in_range, 0], np.array(block_ids, dtype='uint64')).tolist()
+
+
 def map_edge_ids(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -110,6 +164,7 @@ def map_edge_ids(job_id, config_path):
                      blockPrefix=block_prefix,
                      blockIds=block_list,
                      numberOfThreads=n_threads)
+    _write_edge_block_index(graph_path, block_prefix, scale, block_list, n_threads)
     fu.log_job_success(job_id)
 
 
@@ -150,9 +150,9 @@ class InferenceSlurm(InferenceBase, SlurmTask):
 
         # get file paths
         trgt_file = os.path.join(self.tmp_folder, self.task_name + '.py')
-        config_tmpl = self._config_path('$1', job_prefix)
+        config_tmpl = self._config_path('$SLURM_ARRAY_TASK_ID', job_prefix)
+        ledger_env = self._ledger_env('$SLURM_ARRAY_TASK_ID', job_prefix)
         job_name = self.task_name if job_prefix is None else '%s_%s' % (self.task_name, job_prefix)
-        # TODO set the job-name so that we can parse the squeue output properly
         slurm_template = ("#!/bin/bash\n"
                           "#SBATCH -A %s\n"
                           "#SBATCH -N 1\n"
@@ -162,10 +162,10 @@ class InferenceSlurm(InferenceBase, SlurmTask):
                           '#SBATCH -p gpu\n'
                           '#SBATCH -C gpu=%s\n'
                           '#SBATCH --gres=gpu:1\n'
-                          "%s %s") % (groupname, n_threads,
-                                      mem_limit, time_limit,
-                                      gpu_type,
-                                      trgt_file, config_tmpl)
+                          "%s %s %s") % (groupname, n_threads,
+                                         mem_limit, time_limit,
+                                         gpu_type, ledger_env,
+                                         trgt_file, config_tmpl)
         script_path = os.path.join(self.tmp_folder, 'slurm_%s.sh' % job_name)
         with open(script_path, 'w') as f:
             f.write(slurm_template)
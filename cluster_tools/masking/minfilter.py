@@ -35,7 +35,7 @@ class MinfilterBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'filter_shape': (10, 100, 100)})
+        config.update({'filter_shape': (10, 100, 100), 'chunk_cache_size': 0})
         return config
 
     def clean_up_for_retry(self, block_list):
@@ -76,7 +76,7 @@ class MinfilterBase(luigi.Task):
 
         n_jobs = min(len(block_list), self.max_jobs)
         # prime and run the jobs
-        self.prepare_jobs(n_jobs, block_list, ws_config)
+        self.prepare_jobs(n_jobs, block_list, config)
         self.submit_jobs(n_jobs)
 
         # wait till jobs finish and check for job success
@@ -134,9 +134,13 @@ def minfilter(job_id, config_path):
 
     # blocks and task config
     block_list = config['block_list']
+    block_shape = config['block_shape']
     filter_shape = config['filter_shape']
+    # the blocks are read with a halo, so we cache the chunks of the input
+    cache_size = config.get('chunk_cache_size', 0)
 
-    with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
+    with vu.file_reader(input_path, 'r', cache_size=cache_size) as f_in,\
+            vu.file_reader(output_path) as f_out:
         ds_in = f_in[input_key]
         ds_out = f_out[output_key]
         shape = ds_in.shape
@@ -149,6 +153,8 @@ def minfilter(job_id, config_path):
         halo = list(fshape // 2 for fshape in filter_shape)
         [_minfilter_block(block_id, blocking, halo, ds_in,
                            ds_out, filter_shape) for block_id in block_list]
+        if cache_size > 0:
+            fu.log(f_in.cache.summary())
     # log success
     fu.log_job_success(job_id)
 
@@ -157,4 +163,4 @@ if __name__ == '__main__':
     path = sys.argv[1]
     assert os.path.exists(path), path
     job_id = int(os.path.split(path)[1].split('.')[0].split('_')[-1])
-    watershed(job_id, path)
+    minfilter(job_id, path)
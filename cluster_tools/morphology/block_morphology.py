@@ -35,15 +35,22 @@ class BlockMorphologyBase(luigi.Task):
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        config.update({'skip_empty_blocks': False})
+        return config
+
     def clean_up_for_retry(self, block_list):
         super().clean_up_for_retry(block_list)
         # TODO remove any output of failed blocks because it might be corrupted
 
-    def run_impl(self):
-        # get the global config and init configs
-        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
-        self.init(shebang)
+    def stage_config(self, block_shape):
+        """ Get the job config and create the output dataset.
 
+        Returns the config and the shape of the volume that is processed blockwise.
+        """
         # load the task config
         config = self.get_task_config()
 
@@ -63,10 +70,22 @@ class BlockMorphologyBase(luigi.Task):
                               dtype='float64',
                               chunks=tuple(block_shape),
                               compression='gzip')
+        return config, shape
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        config, shape = self.stage_config(block_shape)
 
         if self.n_retries == 0:
+            # don't schedule the blocks that are empty in the segmentation
+            occupancy = vu.load_occupancy(self.input_path, self.input_key)\
+                if config.get('skip_empty_blocks', False) else None
             block_list = vu.blocks_in_volume(shape, block_shape,
-                                             roi_begin, roi_end)
+                                             roi_begin, roi_end,
+                                             occupancy=occupancy)
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list)
@@ -131,6 +150,18 @@ def _morphology_for_block(block_id, blocking, ds_in,
     fu.log_block_success(block_id)
 
 
+def fused_stage(job_id, config, store):
+    """ Block function for fused jobs, see fusion.FusedBlocks.
+    """
+    ds_in = store.dataset(config['input_path'], config['input_key'])
+    output_path, output_key = config['output_path'], config['output_key']
+
+    def _stage(block_id, blocking):
+        _morphology_for_block(block_id, blocking, ds_in,
+                              output_path, output_key)
+    return _stage
+
+
 def block_morphology(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+import queue
 
 import luigi
 import numpy as np
@@ -12,6 +13,7 @@ import vigra
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.segmentation_utils as su
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -58,8 +60,8 @@ class MwsBlocksBase(luigi.Task):
         n_channels = shape[0]
         shape = shape[1:]
 
-        # TODO make optional which channels to choose
-        assert len(self.offsets) == n_channels,\
+        # we only read the channels corresponding to the offsets
+        assert len(self.offsets) <= n_channels,\
             "%i, %i" % (len(self.offsets), n_channels)
         assert all(len(off) == 3 for off in self.offsets)
 
@@ -131,28 +133,58 @@ def _get_bbs(blocking, block_id, halo):
     return in_bb, out_bb, local_bb
 
 
-def _mws_block(block_id, blocking,
-               ds_in, ds_out,
-               mask, offsets,
-               strides, randomize_strides,
-               halo, noise_level):
-    fu.log("start processing block %i" % block_id)
+class _AffinityBuffers(object):
+    """ Preallocated float32 buffers for the affinities of a block with halo.
 
-    in_bb, out_bb, local_bb = _get_bbs(blocking, block_id, halo)
+    Taking a buffer blocks until one is free, which bounds the number of blocks in flight.
+    """
+    def __init__(self, n_buffers, n_channels, blocking, halo):
+        max_shape = list(blocking.blockShape)
+        if halo is not None:
+            max_shape = [sh + 2 * ha for sh, ha in zip(max_shape, halo)]
+        self.size = n_channels * int(np.prod(max_shape))
+        self.buffers = queue.Queue()
+        for _ in range(n_buffers):
+            self.buffers.put(np.empty(self.size, dtype='float32'))
+
+    def get(self, shape):
+        buf = self.buffers.get()
+        # we use the beginning of the flat buffer, so that the affinities are C-contiguous
+        return buf[:int(np.prod(shape))].reshape(shape)
+
+    def put(self, affs):
+        # the base of the affinity view is the flat buffer
+        self.buffers.put(affs.base)
+
+
+def _read_mws_block(block_id, blocking, ds_in, mask, n_channels, halo, buffers):
+    in_bb, _, _ = _get_bbs(blocking, block_id, halo)
     if mask is None:
         bb_mask = None
     else:
         bb_mask = mask[in_bb].astype('bool')
         if np.sum(bb_mask) == 0:
-            fu.log_block_success(block_id)
-            return
+            return None
 
-    aff_bb = (slice(None),) + in_bb
-    affs = vu.normalize(ds_in[aff_bb])
+    aff_bb = (slice(0, n_channels),) + in_bb
+    shape = (n_channels,) + tuple(b.stop - b.start for b in in_bb)
+    affs = buffers.get(shape)
+    affs[:] = ds_in[aff_bb]
+    return affs, bb_mask
 
-    seg = su.mutex_watershed(affs, offsets, strides=strides, mask=bb_mask,
-                             randomize_strides=randomize_strides,
-                             noise_level=noise_level)
+
+def _mws_block(block_id, blocking,
+               affs, bb_mask,
+               offsets, strides, randomize_strides,
+               halo, noise_level, buffers):
+    _, _, local_bb = _get_bbs(blocking, block_id, halo)
+    try:
+        vu.normalize(affs, out=affs)
+        seg = su.mutex_watershed(affs, offsets, strides=strides, mask=bb_mask,
+                                 randomize_strides=randomize_strides,
+                                 noise_level=noise_level)
+    finally:
+        buffers.put(affs)
     seg = seg[local_bb]
 
     # FIXME once vigra supports uint64 or we implement our own ...
@@ -161,10 +193,12 @@ def _mws_block(block_id, blocking,
     # offset with lowest block coordinate
     offset_id = block_id * np.prod(blocking.blockShape)
     vigra.analysis.relabelConsecutive(seg, start_label=offset_id, keep_zeros=True, out=seg)
-    ds_out[out_bb] = seg
+    return seg
+
 
-    # log block success
-    fu.log_block_success(block_id)
+def _write_mws_block(block_id, blocking, ds_out, halo, seg):
+    _, out_bb, _ = _get_bbs(blocking, block_id, halo)
+    ds_out[out_bb] = seg
 
 
 def mws_blocks(job_id, config_path):
@@ -179,8 +213,8 @@ def mws_blocks(job_id, config_path):
     output_path = config['output_path']
     output_key = config['output_key']
     block_shape = config['block_shape']
-    block_list = config['block_list']
     offsets = config['offsets']
+    n_threads = config.get('threads_per_job', 1)
 
     strides = config['strides']
     assert len(strides) == 3
@@ -207,11 +241,20 @@ def mws_blocks(job_id, config_path):
         else:
             mask = None
 
-        [_mws_block(block_id, blocking,
-                    ds_in, ds_out,
-                    mask, offsets,
-                    strides, randomize_strides,
-                    halo, noise_level) for block_id in block_list]
+        # one affinity buffer for each block that is computed and one for the block that is read,
+        # the memory of the affinities is the limiting factor, so we don't read further ahead
+        n_channels = len(offsets)
+        n_prefetch = 1
+        buffers = _AffinityBuffers(n_threads + n_prefetch, n_channels, blocking, halo)
+        pipeline = BlockPipeline(lambda block_id: _read_mws_block(block_id, blocking, ds_in, mask,
+                                                                  n_channels, halo, buffers),
+                                 lambda block_id, data: _mws_block(block_id, blocking, *data,
+                                                                   offsets, strides, randomize_strides,
+                                                                   halo, noise_level, buffers),
+                                 lambda block_id, seg: _write_mws_block(block_id, blocking,
+                                                                        ds_out, halo, seg),
+                                 n_threads=n_threads, n_prefetch=n_prefetch)
+        pipeline.run(fu.iterate_blocks(config))
     fu.log_job_success(job_id)
 
 
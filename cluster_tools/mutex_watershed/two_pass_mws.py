@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+import shutil
 
 import luigi
 import numpy as np
@@ -42,7 +43,8 @@ class TwoPassMwsBase(luigi.Task):
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
         config.update({'strides': [1, 1, 1], 'randomize_strides': False,
-                       'size_filter': 25, 'noise_level': 0.})
+                       'size_filter': 25, 'noise_level': 0.,
+                       'dependency_scheduling': False, 'dependency_timeout': None})
         return config
 
     def requires(self):
@@ -96,6 +98,16 @@ class TwoPassMwsBase(luigi.Task):
             f.require_dataset(self.output_key,  shape=shape, dtype='uint64',
                               compression=compression, chunks=chunks)
 
+        # make the datasets for the segmentation states of the first pass,
+        # the state of a block is stored as variable length chunk
+        state_path = _state_path(self.tmp_folder)
+        if os.path.exists(state_path) and self.n_retries == 0:
+            shutil.rmtree(state_path)
+        with vu.file_reader(state_path) as f:
+            for key, dtype in STATE_DATASETS.items():
+                f.require_dataset(key, shape=shape, chunks=tuple(block_shape),
+                                  compression='gzip', dtype=dtype)
+
         blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
         block_lists = vu.make_checkerboard_block_lists(blocking, roi_begin, roi_end)
 
@@ -103,6 +115,17 @@ class TwoPassMwsBase(luigi.Task):
         max_block_id = max([max(bl) for bl in block_lists])
         config.update({'max_block_id': max_block_id})
 
+        # with dependency scheduling, the jobs process the blocks of both passes and
+        # start a block of the second pass once the neighboring blocks are done
+        if config.get('dependency_scheduling', False):
+            done_dir = os.path.join(self.tmp_folder, '%s_done' % self.task_name)
+            if os.path.exists(done_dir):
+                shutil.rmtree(done_dir)
+            os.makedirs(done_dir)
+            config.update({'done_dir': done_dir, 'roi_begin': roi_begin, 'roi_end': roi_end})
+            self._mws_pass(block_lists[0] + block_lists[1], config, 'dependencies')
+            return
+
         for pass_id, block_list in enumerate(block_lists):
             config['pass'] = pass_id
             self._mws_pass(block_list, config, 'pass_%i' % pass_id)
@@ -133,12 +156,80 @@ def _write_nlabels(ds_out, seg):
     ds_out.attrs['maxId'] = int(seg.max())
 
 
+# the datasets of the segmentation state:
+# edges (flattened) sorted by their first node, edge weights and attractive edge mask,
+# and the first nodes with the offsets of their edges, which are used as index
+STATE_DATASETS = {'edges': 'uint64', 'weights': 'float32',
+                  'attractive_edge_mask': 'uint8',
+                  'nodes': 'uint64', 'node_offsets': 'uint64'}
+
+
+def _state_path(tmp_folder):
+    return os.path.join(tmp_folder, 'mws_seg_state.n5')
+
+
+def _state_chunk_id(blocking, block_id):
+    block = blocking.getBlock(block_id)
+    return tuple(beg // sh for beg, sh in zip(block.begin, blocking.blockShape))
+
+
+def _write_state(f_state, blocking, block_id, uvs, weights, attractive):
+    if len(uvs) == 0:
+        return
+    # sort the edges by their first node and store the edge offsets of the nodes
+    edge_order = np.argsort(uvs[:, 0], kind='stable')
+    uvs = uvs[edge_order].astype('uint64')
+    nodes, node_offsets = np.unique(uvs[:, 0], return_index=True)
+    node_offsets = np.concatenate([node_offsets, [len(uvs)]]).astype('uint64')
+
+    chunk_id = _state_chunk_id(blocking, block_id)
+    f_state['edges'].write_chunk(chunk_id, uvs.ravel(), True)
+    f_state['weights'].write_chunk(chunk_id, weights[edge_order].astype('float32'), True)
+    f_state['attractive_edge_mask'].write_chunk(chunk_id,
+                                                attractive[edge_order].astype('uint8'), True)
+    f_state['nodes'].write_chunk(chunk_id, nodes, True)
+    f_state['node_offsets'].write_chunk(chunk_id, node_offsets, True)
+
+
+def _in_sorted(values, sorted_ids):
+    pos = np.clip(np.searchsorted(sorted_ids, values), 0, len(sorted_ids) - 1)
+    return sorted_ids[pos] == values
+
+
+def _read_state(f_state, blocking, block_id, seed_ids):
+    """ Read the edges of the segmentation state of a block between the (sorted) seed ids.
+    """
+    chunk_id = _state_chunk_id(blocking, block_id)
+    nodes = f_state['nodes'].read_chunk(chunk_id)
+    if nodes is None:
+        return None
+
+    # find the edges of the nodes that are seeds via the node index,
+    # and only read the edges if there are any
+    seed_nodes = _in_sorted(nodes, seed_ids)
+    if seed_nodes.sum() == 0:
+        return None
+    node_offsets = f_state['node_offsets'].read_chunk(chunk_id).astype('int64')
+    edge_mask = np.repeat(seed_nodes, np.diff(node_offsets))
+
+    edges = f_state['edges'].read_chunk(chunk_id).reshape((-1, 2))[edge_mask]
+    # both nodes of the edges need to be seeds
+    seed_edges = _in_sorted(edges[:, 1], seed_ids)
+    if seed_edges.sum() == 0:
+        return None
+    edge_mask[edge_mask] = seed_edges
+    edges = edges[seed_edges]
+    weights = f_state['weights'].read_chunk(chunk_id)[edge_mask]
+    attractive = f_state['attractive_edge_mask'].read_chunk(chunk_id)[edge_mask].astype('bool')
+    return edges, weights, attractive
+
+
 def _mws_block_pass1(block_id, blocking,
                      ds_in, ds_out,
                      mask, offsets,
                      strides, randomize_strides,
                      halo, noise_level, max_block_id,
-                     tmp_folder):
+                     tmp_folder, f_state):
     fu.log("(Pass1) start processing block %i" % block_id)
 
     block = blocking.getBlockWithHalo(block_id, halo)
@@ -179,11 +270,7 @@ def _mws_block_pass1(block_id, blocking,
                                                                                            n_attractive_channels=3,
                                                                                            ignore_label=True)
     # serialize the states
-    save_path = os.path.join(tmp_folder, 'seg_state_block%i.h5' % block_id)
-    with vu.file_reader(save_path) as f:
-        f.create_dataset('edges', data=state_uvs)
-        f.create_dataset('weights', data=state_weights)
-        f.create_dataset('attractive_edge_mask', data=state_attractive)
+    _write_state(f_state, blocking, block_id, state_uvs, state_weights, state_attractive)
 
     # write max-id for the last block
     if block_id == max_block_id:
@@ -197,7 +284,7 @@ def _mws_block_pass2(block_id, blocking,
                      mask, offsets,
                      strides, randomize_strides,
                      halo, noise_level, max_block_id,
-                     tmp_folder):
+                     tmp_folder, f_state):
     fu.log("(Pass2) start processing block %i" % block_id)
 
     block = blocking.getBlockWithHalo(block_id, halo)
@@ -238,28 +325,18 @@ def _mws_block_pass2(block_id, blocking,
     for axis in range(3):
         for to_lower in (False, True):
             ngb_id = blocking.getNeighborId(block_id, axis, to_lower)
-
-            # get path to state serialization and check if it exists
-            save_path = os.path.join(tmp_folder, 'seg_state_block%i.h5' % ngb_id)
-            if not os.path.exists(save_path):
+            if ngb_id == -1:
                 continue
 
-            with vu.file_reader(save_path) as f:
-                # first, load the edges and see if they have overlap with our seed ids
-                ngb_edges = f['edges'][:]
-                ngb_edge_mask = np.in1d(ngb_edges, seed_ids).reshape(ngb_edges.shape)
-                ngb_edge_mask = ngb_edge_mask.all(axis=1)
-
-                # if we have edges, load the corresponding weights
-                # and attractive / repulsive state
-                if ngb_edge_mask.sum() > 0:
-                    ngb_edges = ngb_edges[ngb_edge_mask]
-                    ngb_weights = f['weights'][:][ngb_edge_mask]
-                    ngb_attractive_edges = f['attractive_edge_mask'][:][ngb_edge_mask]
-
-                    seed_edges.append(ngb_edges)
-                    seed_edge_weights.append(ngb_weights)
-                    attractive_mask.append(ngb_attractive_edges)
+            # load the edges between our seed ids and the corresponding weights
+            # and attractive / repulsive state
+            ngb_state = _read_state(f_state, blocking, ngb_id, seed_ids)
+            if ngb_state is None:
+                continue
+            ngb_edges, ngb_weights, ngb_attractive_edges = ngb_state
+            seed_edges.append(ngb_edges)
+            seed_edge_weights.append(ngb_weights)
+            attractive_mask.append(ngb_attractive_edges)
 
     seed_edges = np.concatenate(seed_edges, axis=0)
     seed_edge_weights = np.concatenate(seed_edge_weights)
@@ -332,11 +409,11 @@ def two_pass_mws(job_id, config_path):
 
     mask_path = config.get('mask_path', '')
     mask_key = config.get('mask_key', '')
-    pass_id = config['pass']
     tmp_folder = config['tmp_folder']
     max_block_id = config['max_block_id']
 
-    with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
+    with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out,\
+            vu.file_reader(_state_path(tmp_folder)) as f_state:
 
         ds_in = f_in[input_key]
         ds_out = f_out[output_key]
@@ -349,15 +426,28 @@ def two_pass_mws(job_id, config_path):
         else:
             mask = None
 
-        mws_fu = _mws_block_pass1 if pass_id == 0 else _mws_block_pass2
-
-        [mws_fu(block_id, blocking,
-                ds_in, ds_out,
-                mask, offsets,
-                strides, randomize_strides,
-                halo,  noise_level, max_block_id,
-                tmp_folder)
-         for block_id in block_list]
+        def _mws_pass(mws_fu):
+            return lambda block_id: mws_fu(block_id, blocking,
+                                           ds_in, ds_out,
+                                           mask, offsets,
+                                           strides, randomize_strides,
+                                           halo, noise_level, max_block_id,
+                                           tmp_folder, f_state)
+
+        if config.get('dependency_scheduling', False):
+            # the blocks of the second pass depend on the neighboring blocks of the first pass
+            blocks_a, blocks_b = vu.make_checkerboard_block_lists(blocking, config['roi_begin'],
+                                                                  config['roi_end'])
+            blocks_b = set(blocks_b)
+            job_blocks_b = [block_id for block_id in block_list if block_id in blocks_b]
+            dependencies = vu.checkerboard_dependencies(blocking, blocks_a, job_blocks_b, halo)
+            fu.run_with_dependencies(block_list, dependencies, config['done_dir'],
+                                     _mws_pass(_mws_block_pass1), _mws_pass(_mws_block_pass2),
+                                     timeout=fu.dependency_timeout(config))
+        else:
+            mws_fu = _mws_pass(_mws_block_pass1 if config['pass'] == 0 else _mws_block_pass2)
+            for block_id in block_list:
+                mws_fu(block_id)
 
     fu.log_job_success(job_id)
 
@@ -42,11 +42,11 @@ class BlockNodeLabelsBase(luigi.Task):
         super().clean_up_for_retry(block_list)
         # TODO remove any output of failed blocks because it might be corrupted
 
-    def run_impl(self):
-        # get the global config and init configs
-        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
-        self.init(shebang)
+    def stage_config(self, block_shape):
+        """ Get the job config and create the output dataset.
 
+        Returns the config and the shape of the volume that is processed blockwise.
+        """
         # load the task config
         config = self.get_task_config()
 
@@ -68,6 +68,14 @@ class BlockNodeLabelsBase(luigi.Task):
                               dtype='uint64',
                               chunks=chunks,
                               compression='gzip')
+        return config, shape
+
+    def run_impl(self):
+        # get the global config and init configs
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        config, shape = self.stage_config(block_shape)
 
         if self.n_retries == 0:
             block_list = vu.blocks_in_volume(shape, block_shape,
@@ -142,6 +150,51 @@ def _labels_for_block(block_id, blocking,
     fu.log_block_success(block_id)
 
 
+def _get_labels(ds_labels, shape):
+    lab_shape = ds_labels.shape
+    # label shape is smaller than ws shape
+    # -> interpolated
+    if all(lsh < sh for lsh, sh in zip(lab_shape, shape)):
+        labels = vu.InterpolatedVolume(ds_labels, shape, spline_order=0)
+    else:
+        assert lab_shape == shape
+        labels = ds_labels
+    return labels
+
+
+def _serialize_max_id(ws_path, ws_key, output_path, output_key):
+    with vu.file_reader(ws_path, 'r') as f:
+        try:
+            max_id = f[ws_key].attrs['maxId']
+        except KeyError:
+            raise KeyError("Dataset %s:%s does not have attribute maxId" % (ws_path, ws_key))
+    with vu.file_reader(output_path) as f:
+        ds_out = f[output_key]
+        ds_out.attrs['maxId'] = max_id
+
+
+def fused_stage(job_id, config, store):
+    """ Block function for fused jobs, see fusion.FusedBlocks.
+    """
+    ws_path, ws_key = config['ws_path'], config['ws_key']
+    ds_ws = store.dataset(ws_path, ws_key)
+    labels = _get_labels(store.dataset(config['input_path'], config['input_key']),
+                         vu.get_shape(ws_path, ws_key))
+    out_path = os.path.join(config['output_path'], config['output_key'])
+    ignore_label = config['ignore_label']
+
+    # need to serialize the label max-id here for
+    # the merge_node_labels task
+    if job_id == 0:
+        _serialize_max_id(ws_path, ws_key, config['output_path'], config['output_key'])
+
+    def _stage(block_id, blocking):
+        _labels_for_block(block_id, blocking,
+                          ds_ws, out_path, labels,
+                          ignore_label)
+    return _stage
+
+
 def block_node_labels(job_id, config_path):
 
     fu.log("start processing job %i" % job_id)
@@ -171,15 +224,7 @@ def block_node_labels(job_id, config_path):
 
     # labels can either be interpolated or full volume
     f_lab = vu.file_reader(input_path, 'r')
-    ds_labels = f_lab[input_key]
-    lab_shape = ds_labels.shape
-    # label shape is smaller than ws shape
-    # -> interpolated
-    if all(lsh < sh for lsh, sh in zip(lab_shape, shape)):
-        labels = vu.InterpolatedVolume(ds_labels, shape, spline_order=0)
-    else:
-        assert lab_shape == shape
-        labels = ds_labels
+    labels = _get_labels(f_lab[input_key], shape)
 
     if ignore_label is None:
         fu.log("accumulating labels without ignore label")
@@ -197,15 +242,7 @@ def block_node_labels(job_id, config_path):
     # need to serialize the label max-id here for
     # the merge_node_labels task
     if job_id == 0:
-        with vu.file_reader(ws_path, 'r'):
-            try:
-                max_id = ds_ws.attrs['maxId']
-            except KeyError:
-                raise KeyError("Dataset %s:%s does not have attribute maxId" % (ws_path, ws_key))
-
-        with vu.file_reader(output_path) as f:
-            ds_out = f[output_key]
-            ds_out.attrs['maxId'] = max_id
+        _serialize_max_id(ws_path, ws_key, output_path, output_key)
 
     f_lab.close()
     fu.log_job_success(job_id)
@@ -32,6 +32,13 @@ class FillingSizeFilterBase(luigi.Task):
     def requires(self):
         return self.dependency
 
+    @staticmethod
+    def default_task_config():
+        # we use this to get also get the common default config
+        config = LocalTask.default_task_config()
+        config.update({'skip_empty_blocks': False})
+        return config
+
     def _parse_log(self, log_path):
         log_path = self.input().path
         lines = fu.tail(log_path, 3)
@@ -53,7 +60,11 @@ class FillingSizeFilterBase(luigi.Task):
         shape = vu.get_shape(self.input_path, self.input_key)
 
         if self.n_retries == 0:
-            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+            # don't schedule the blocks that are empty in the segmentation
+            occupancy = vu.load_occupancy(self.input_path, self.input_key)\
+                if self.get_task_config().get('skip_empty_blocks', False) else None
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
+                                             occupancy=occupancy)
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list)
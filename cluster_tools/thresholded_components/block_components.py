@@ -12,6 +12,7 @@ from skimage.morphology import label
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -134,59 +135,20 @@ class BlockComponentsLSF(BlockComponentsBase, LSFTask):
     pass
 
 
-def _cc_block(block_id, blocking,
-              ds_in, ds_out, threshold,
-              threshold_mode, channel):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-
-    bb = vu.block_to_bb(block)
-    if channel is None:
-        input_ = input_[bb]
-    else:
-        block_shape = tuple(b.stop - b.start for b in bb)
-        input_ = np.zeros(block_shape, dtype=ds_in.dtype)
-        channel_ = [channel] if isinstance(channel, int) else channel
-        for chan in channel_:
-            bb_inp = (slice(chan, chan + 1),) + bb
-            input_ += ds_in[bb_inp].squeeze()
-
-    if threshold_mode == 'greater':
-        input_ = input_ > threshold
-    elif threshold_mode == 'less':
-        input_ = input_ < threshold
-    elif threshold_mode == 'equal':
-        input_ = input_ == threshold
-    else:
-        raise RuntimeError("Thresholding Mode %s not supported" % threshold_mode)
-
-    if np.sum(input_) == 0:
-        fu.log_block_success(block_id)
-        return 0
-
-    components = label(input_)
-    ds_out[bb] = components
-    fu.log_block_success(block_id)
-    return int(components.max()) + 1
-
-
-def _cc_block_with_mask(block_id, blocking,
-                        ds_in, ds_out, threshold,
-                        threshold_mode, mask,
-                        channel):
-    fu.log("start processing block %i" % block_id)
+def _read_cc_block(block_id, blocking, ds_in, mask, channel):
     block = blocking.getBlock(block_id)
     bb = vu.block_to_bb(block)
 
     # get the mask and check if we have any pixels
-    in_mask = mask[bb].astype('bool')
-    if np.sum(in_mask) == 0:
-        fu.log_block_success(block_id)
-        return 0
+    if mask is None:
+        in_mask = None
+    else:
+        in_mask = mask[bb].astype('bool')
+        if np.sum(in_mask) == 0:
+            return None
 
-    bb = vu.block_to_bb(block)
     if channel is None:
-        input_ = input_[bb]
+        input_ = ds_in[bb]
     else:
         block_shape = tuple(b.stop - b.start for b in bb)
         input_ = np.zeros(block_shape, dtype=ds_in.dtype)
@@ -194,7 +156,11 @@ def _cc_block_with_mask(block_id, blocking,
         for chan in channel_:
             bb_inp = (slice(chan, chan + 1),) + bb
             input_ += ds_in[bb_inp].squeeze()
+    return input_, in_mask
+
 
+def _cc_block(block_id, input_, in_mask,
+              threshold, threshold_mode, offsets):
     if threshold_mode == 'greater':
         input_ = input_ > threshold
     elif threshold_mode == 'less':
@@ -204,15 +170,19 @@ def _cc_block_with_mask(block_id, blocking,
     else:
         raise RuntimeError("Thresholding Mode %s not supported" % threshold_mode)
 
-    input_[np.logical_not(in_mask)] = 0
+    if in_mask is not None:
+        input_[np.logical_not(in_mask)] = 0
     if np.sum(input_) == 0:
-        fu.log_block_success(block_id)
-        return 0
+        return None
 
     components = label(input_)
+    offsets[block_id] = int(components.max()) + 1
+    return components
+
+
+def _write_cc_block(block_id, blocking, ds_out, components):
+    bb = vu.block_to_bb(blocking.getBlock(block_id))
     ds_out[bb] = components
-    fu.log_block_success(block_id)
-    return int(components.max()) + 1
 
 
 def block_components(job_id, config_path):
@@ -257,16 +227,21 @@ def block_components(job_id, config_path):
             # in memory (and we interpolate to get to the full volume)
             # if this does not hold need to change this code!
             mask = vu.load_mask(mask_path, mask_key, shape)
-            offsets = [_cc_block_with_mask(block_id, blocking,
-                                           ds_in, ds_out, threshold,
-                                           threshold_mode, mask, channel) for block_id in block_list]
-
         else:
-            offsets = [_cc_block(block_id, blocking,
-                                 ds_in, ds_out, threshold,
-                                 threshold_mode, channel) for block_id in block_list]
-
-    offset_dict = {block_id: off for block_id, off in zip(block_list, offsets)}
+            mask = None
+
+        # empty blocks have an offset of 0
+        offsets = {block_id: 0 for block_id in block_list}
+        pipeline = BlockPipeline(lambda block_id: _read_cc_block(block_id, blocking, ds_in,
+                                                                 mask, channel),
+                                 lambda block_id, data: _cc_block(block_id, data[0], data[1],
+                                                                  threshold, threshold_mode,
+                                                                  offsets),
+                                 lambda block_id, components: _write_cc_block(block_id, blocking,
+                                                                               ds_out, components))
+        pipeline.run(block_list)
+
+    offset_dict = {block_id: offsets[block_id] for block_id in block_list}
     save_path = os.path.join(tmp_folder,
                              'connected_components_offsets_%i.json' % job_id)
     with open(save_path, 'w') as f:
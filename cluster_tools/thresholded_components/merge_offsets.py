@@ -4,6 +4,7 @@ import os
 import sys
 import json
 import pickle
+import shutil
 
 import luigi
 import numpy as np
@@ -93,13 +94,19 @@ def merge_offsets(job_id, config_path):
     n_blocks = config['n_blocks']
     save_prefix = config['save_prefix']
 
-    offsets = {}
-    for block_job_id in range(n_jobs):
-        path = os.path.join(tmp_folder,
-                            '%s_%i.json' % (save_prefix, block_job_id))
-        with open(path, 'r') as f:
-            offsets.update(json.load(f))
-        os.remove(path)
+    # the offsets are saved per job, or per block in a folder with the prefix as name
+    block_folder = os.path.join(tmp_folder, save_prefix)
+    if os.path.isdir(block_folder):
+        offsets = fu.load_block_results(block_folder)
+        shutil.rmtree(block_folder)
+    else:
+        offsets = {}
+        for block_job_id in range(n_jobs):
+            path = os.path.join(tmp_folder,
+                                '%s_%i.json' % (save_prefix, block_job_id))
+            with open(path, 'r') as f:
+                offsets.update(json.load(f))
+            os.remove(path)
 
     # NOTE: the block-id keys in 'offsets' are stored as str, so we can't just use
     # 'sorted(offsets.items())' because it would string-sort!
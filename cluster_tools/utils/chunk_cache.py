@@ -0,0 +1,210 @@
+import threading
+from collections import OrderedDict
+from itertools import product
+
+import numpy as np
+
+
+class ChunkCache(object):
+    """ LRU cache for decoded chunks, bounded by the size of the cached chunks in bytes.
+
+    The cache can be shared by threads that process different blocks.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            chunk = self._chunks.get(key, None)
+            if chunk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._chunks.move_to_end(key)
+        return chunk
+
+    def put(self, key, chunk):
+        with self._lock:
+            self._invalidate(key)
+            # chunks that are bigger than the cache are not cached at all
+            if chunk.nbytes > self.max_bytes:
+                return
+            self._chunks[key] = chunk
+            self.n_bytes += chunk.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    def _invalidate(self, key):
+        chunk = self._chunks.pop(key, None)
+        if chunk is not None:
+            self.n_bytes -= chunk.nbytes
+
+    def invalidate(self, key):
+        with self._lock:
+            self._invalidate(key)
+
+    def summary(self):
+        n_requests = self.hits + self.misses
+        hit_rate = self.hits / float(n_requests) if n_requests > 0 else 0.
+        return "chunk cache: %i hits, %i misses (hit rate %.2f), %i MB cached" % (self.hits, self.misses,
+                                                                                   hit_rate,
+                                                                                   self.n_bytes // 1024**2)
+
+
+def _normalize_index(index, shape):
+    if not isinstance(index, tuple):
+        index = (index,)
+    if any(idx is Ellipsis for idx in index):
+        pos = index.index(Ellipsis)
+        index = index[:pos] + (slice(None),) * (len(shape) - len(index) + 1) + index[pos + 1:]
+    index = index + (slice(None),) * (len(shape) - len(index))
+    bb, squeeze = [], []
+    for axis, (idx, sh) in enumerate(zip(index, shape)):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(sh)
+            if step != 1:
+                return None, None
+            bb.append(slice(start, max(start, stop)))
+        else:
+            idx = int(idx)
+            idx = idx + sh if idx < 0 else idx
+            bb.append(slice(idx, idx + 1))
+            squeeze.append(axis)
+    return tuple(bb), tuple(squeeze)
+
+
+class CachedDataset(object):
+    """ Dataset wrapper that reads whole chunks and keeps the decoded chunks in a cache.
+
+    Arbitrary (non-strided) slices are assembled from the cached chunks.
+    Writes go to the dataset and invalidate the affected chunks.
+    All other attributes are forwarded to the dataset, also when they are set,
+    e.g. `ds.n_threads = 4`.
+    """
+    _own_attributes = ('ds', 'cache', 'name', 'shape', 'chunks', 'dtype', 'ndim')
+
+    def __init__(self, ds, cache, name):
+        self.ds = ds
+        self.cache = cache
+        self.name = name
+        self.shape = tuple(ds.shape)
+        self.chunks = tuple(ds.chunks)
+        self.dtype = ds.dtype
+        self.ndim = len(self.shape)
+
+    def __getattr__(self, name):
+        if name == 'ds':
+            raise AttributeError(name)
+        return getattr(self.ds, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own_attributes:
+            super().__setattr__(name, value)
+        else:
+            setattr(self.ds, name, value)
+
+    def _chunk_ids(self, bb):
+        ranges = [range(b.start // ch, (b.stop - 1) // ch + 1) if b.stop > b.start else range(0)
+                  for b, ch in zip(bb, self.chunks)]
+        return product(*ranges)
+
+    def _chunk_bb(self, chunk_id):
+        return tuple(slice(cid * ch, min((cid + 1) * ch, sh))
+                     for cid, ch, sh in zip(chunk_id, self.chunks, self.shape))
+
+    def _read_chunk(self, chunk_id):
+        key = (self.name, chunk_id)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            chunk = self.ds[self._chunk_bb(chunk_id)]
+            self.cache.put(key, chunk)
+        return chunk
+
+    def __getitem__(self, index):
+        bb, squeeze = _normalize_index(index, self.shape)
+        # strided access is not cached
+        if bb is None:
+            return self.ds[index]
+
+        out = np.empty(tuple(b.stop - b.start for b in bb), dtype=self.dtype)
+        for chunk_id in self._chunk_ids(bb):
+            chunk_bb = self._chunk_bb(chunk_id)
+            # the overlap of chunk and request in global coordinates
+            overlap = tuple(slice(max(b.start, cb.start), min(b.stop, cb.stop))
+                            for b, cb in zip(bb, chunk_bb))
+            out_bb = tuple(slice(ov.start - b.start, ov.stop - b.start)
+                           for ov, b in zip(overlap, bb))
+            in_bb = tuple(slice(ov.start - cb.start, ov.stop - cb.start)
+                          for ov, cb in zip(overlap, chunk_bb))
+            out[out_bb] = self._read_chunk(chunk_id)[in_bb]
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+    def __setitem__(self, index, data):
+        self.ds[index] = data
+        bb, _ = _normalize_index(index, self.shape)
+        if bb is None:
+            bb = tuple(slice(0, sh) for sh in self.shape)
+        for chunk_id in self._chunk_ids(bb):
+            self.cache.invalidate((self.name, chunk_id))
+
+
+def _wrap(obj, cache, name):
+    if getattr(obj, 'chunks', None) is not None and hasattr(obj, 'dtype'):
+        return CachedDataset(obj, cache, name)
+    # the datasets of nested groups are cached as well
+    if hasattr(obj, 'keys') and not hasattr(obj, 'dtype'):
+        return CachedGroup(obj, cache, name)
+    return obj
+
+
+class CachedGroup(object):
+    """ Group wrapper that returns chunked datasets as `CachedDataset`
+    and nested groups as `CachedGroup`.
+
+    The datasets are cached by their path in the file, so a dataset that is
+    accessed via different groups uses the same cached chunks.
+    """
+    def __init__(self, group, cache, name):
+        self.group = group
+        self.cache = cache
+        self.name = name
+
+    def __getattr__(self, name):
+        if name == 'group':
+            raise AttributeError(name)
+        return getattr(self.group, name)
+
+    def __getitem__(self, key):
+        name = key if key.startswith('/') else '/'.join((self.name, key))
+        return _wrap(self.group[key], self.cache, name.strip('/'))
+
+    def __contains__(self, key):
+        return key in self.group
+
+
+class CachedFile(CachedGroup):
+    """ File wrapper that returns chunked datasets as `CachedDataset`.
+
+    All datasets of the file share one chunk cache.
+    """
+    def __init__(self, f, cache_size):
+        super().__init__(f, ChunkCache(cache_size), '')
+
+    @property
+    def f(self):
+        return self.group
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.f.close()
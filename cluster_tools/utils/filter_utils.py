@@ -0,0 +1,161 @@
+from concurrent import futures
+
+import numpy as np
+
+from . import volume_utils as vu
+
+
+# the filters that are derived from the gaussian smoothing of the input,
+# all other filters are applied to the input separately
+DERIVED_FILTERS = ('gaussianSmoothing', 'gaussianGradientMagnitude', 'laplacianOfGaussian',
+                   'hessianOfGaussianEigenvalues', 'structureTensorEigenvalues')
+
+
+def _scale_sigma(sigma, factor):
+    if isinstance(sigma, (tuple, list)):
+        return [sig * factor for sig in sigma]
+    return sigma * factor
+
+
+def _eigenvalues(tensor, n_axes):
+    """ Eigenvalues of the symmetric tensor given by its upper triangle,
+    in descending order and with channels last, like the vigra filters.
+
+    The eigenvalues are computed in closed form on the components, so we don't
+    need to build the full matrix of each pixel.
+    """
+    if n_axes == 2:
+        a, b, d = tensor[(0, 0)], tensor[(0, 1)], tensor[(1, 1)]
+        mean = (a + d) / 2
+        radius = np.sqrt(((a - d) / 2) ** 2 + b ** 2)
+        return np.stack([mean + radius, mean - radius], axis=-1)
+
+    # trigonometric solution for symmetric 3x3 matrices
+    a, b, c = tensor[(0, 0)], tensor[(0, 1)], tensor[(0, 2)]
+    d, e, f = tensor[(1, 1)], tensor[(1, 2)], tensor[(2, 2)]
+    q = (a + d + f) / 3
+    a, d, f = a - q, d - q, f - q
+    p = np.sqrt((a ** 2 + d ** 2 + f ** 2 + 2 * (b ** 2 + c ** 2 + e ** 2)) / 6)
+    det = a * (d * f - e ** 2) - b * (b * f - c * e) + c * (b * e - c * d)
+    # the eigenvalues are all equal to q for p = 0, for any angle
+    p_safe = np.where(p > 0, p, 1)
+    phi = np.arccos(np.clip(det / (2 * p_safe ** 3), -1, 1)) / 3
+    ev_max = q + 2 * p * np.cos(phi)
+    ev_min = q + 2 * p * np.cos(phi + 2 * np.pi / 3)
+    return np.stack([ev_max, 3 * q - ev_max - ev_min, ev_min], axis=-1)
+
+
+def _normalize_bb(bb, shape):
+    if not isinstance(bb, tuple):
+        bb = (bb,)
+    bb = bb + (slice(None),) * (len(shape) - len(bb))
+    return tuple(slice(*b.indices(sh)[:2]) for b, sh in zip(bb, shape))
+
+
+def _shifted(padded, bb, pads, shifts):
+    """ The bounding box `bb` of the array before padding, shifted by `shifts` along the axes.
+    """
+    return padded[tuple(slice(b.start + pad + shifts.get(axis, 0), b.stop + pad + shifts.get(axis, 0))
+                        for axis, (b, pad) in enumerate(zip(bb, pads)))]
+
+
+def _derivative(padded, bb, pads, axis):
+    """ First derivative with the central difference stencil.
+    """
+    return (_shifted(padded, bb, pads, {axis: 1}) - _shifted(padded, bb, pads, {axis: -1})) / 2.
+
+
+def _second_derivative(padded, bb, pads, axis_i, axis_j):
+    """ Second derivative with the second difference stencil on the diagonal
+    and the product of the central difference stencils for the mixed derivatives.
+    """
+    if axis_i == axis_j:
+        return _shifted(padded, bb, pads, {axis_i: 1}) - 2 * _shifted(padded, bb, pads, {}) +\
+            _shifted(padded, bb, pads, {axis_i: -1})
+    return (_shifted(padded, bb, pads, {axis_i: 1, axis_j: 1}) -
+            _shifted(padded, bb, pads, {axis_i: 1, axis_j: -1}) -
+            _shifted(padded, bb, pads, {axis_i: -1, axis_j: 1}) +
+            _shifted(padded, bb, pads, {axis_i: -1, axis_j: -1})) / 4.
+
+
+class FilterBank(object):
+    """ Evaluate several filters at several scales on the same input.
+
+    The input is smoothed once per scale; gradient magnitude, laplacian, hessian and
+    structure tensor eigenvalues are derived from the finite differences of the smoothed input.
+    The smoothed input is mirrored at the border by the stencil radius, like the vigra filters
+    treat the border. The responses are only derived within the bounding box `bb`,
+    so that the halo is only used for the convolutions and stencils.
+    The scales are processed in parallel by `n_threads` threads.
+
+    Example:
+        bank = FilterBank(['gaussianSmoothing', 'laplacianOfGaussian'], [1., 2.])
+        responses = bank(input_, bb_local)
+    """
+    def __init__(self, filters, sigmas, apply_in_2d=False, n_threads=1,
+                 outer_scale_factor=.5):
+        self.filters = list(filters)
+        self.sigmas = list(sigmas)
+        self.apply_in_2d = apply_in_2d
+        self.n_threads = max(n_threads, 1)
+        # the outer scale of the structure tensor relative to the inner scale
+        self.outer_scale_factor = outer_scale_factor
+
+    def _apply(self, input_, filter_name, sigma):
+        return vu.apply_filter(input_, filter_name, sigma, apply_in_2d=self.apply_in_2d)
+
+    def _scale_responses(self, input_, sigma, bb):
+        responses = {}
+        for filter_name in self.filters:
+            if filter_name not in DERIVED_FILTERS:
+                responses[filter_name] = self._apply(input_, filter_name, sigma)[bb]
+
+        if not any(filter_name in DERIVED_FILTERS for filter_name in self.filters):
+            return responses
+        smoothed = self._apply(input_, 'gaussianSmoothing', sigma)
+        if 'gaussianSmoothing' in self.filters:
+            responses['gaussianSmoothing'] = smoothed[bb]
+        if not any(filter_name in self.filters for filter_name in DERIVED_FILTERS[1:]):
+            return responses
+
+        # in 2d, we only derive within the slices
+        axes = list(range(1, input_.ndim)) if self.apply_in_2d else list(range(input_.ndim))
+        n_axes = len(axes)
+        pads = [1 if axis in axes else 0 for axis in range(input_.ndim)]
+        padded = np.pad(smoothed, [(pad, pad) for pad in pads], mode='reflect')
+        full_bb = _normalize_bb(slice(None), input_.shape)
+        bb = _normalize_bb(bb, input_.shape)
+
+        if 'structureTensorEigenvalues' in self.filters:
+            # the gradients are smoothed, so we need them in the full input
+            gradients = [_derivative(padded, full_bb, pads, axis) for axis in axes]
+            outer_sigma = _scale_sigma(sigma, self.outer_scale_factor)
+            tensor = {(i, j): self._apply(gradients[i] * gradients[j], 'gaussianSmoothing',
+                                          outer_sigma)[bb]
+                      for i in range(n_axes) for j in range(i, n_axes)}
+            responses['structureTensorEigenvalues'] = _eigenvalues(tensor, n_axes)
+
+        if 'laplacianOfGaussian' in self.filters or 'hessianOfGaussianEigenvalues' in self.filters:
+            # we only need the upper triangle of the hessian
+            hessian = {(i, j): _second_derivative(padded, bb, pads, axes[i], axes[j])
+                       for i in range(n_axes) for j in range(i, n_axes)}
+            if 'laplacianOfGaussian' in self.filters:
+                responses['laplacianOfGaussian'] = sum(hessian[(i, i)] for i in range(n_axes))
+            if 'hessianOfGaussianEigenvalues' in self.filters:
+                responses['hessianOfGaussianEigenvalues'] = _eigenvalues(hessian, n_axes)
+
+        if 'gaussianGradientMagnitude' in self.filters:
+            responses['gaussianGradientMagnitude'] = np.sqrt(sum(_derivative(padded, bb, pads, axis) ** 2
+                                                                 for axis in axes))
+        return responses
+
+    def __call__(self, input_, bb=slice(None)):
+        """ Returns the responses in the order of the filters and then the sigmas.
+        """
+        input_ = input_.astype('float32', copy=False)
+        with futures.ThreadPoolExecutor(self.n_threads) as tp:
+            tasks = [tp.submit(self._scale_responses, input_, sigma, bb)
+                     for sigma in self.sigmas]
+            responses = [t.result() for t in tasks]
+        return [responses[sigma_id][filter_name]
+                for filter_name in self.filters for sigma_id in range(len(self.sigmas))]
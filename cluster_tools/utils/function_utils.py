@@ -1,23 +1,294 @@
+import os
 import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from subprocess import check_output
 
+import numpy as np
+
 # Note that stdout is always piped to file, sowe can use it as logging
 # TODO log-levels
 
+# In addition to the log, jobs append fixed-size records for processed blocks and
+# jobs to a binary ledger, which is used to check for successful jobs and blocks.
+# The ledger path is passed to the job via this environment variable.
+LEDGER_ENV = 'CLUSTER_TOOLS_LEDGER'
+LEDGER_DTYPE = np.dtype([('id', '<i8'), ('status', '<u1'),
+                         ('start', '<f8'), ('end', '<f8'),
+                         ('t_read', '<f4'), ('t_compute', '<f4'), ('t_write', '<f4'),
+                         ('bytes_read', '<u8'), ('bytes_written', '<u8'),
+                         ('peak_rss', '<u8')])
+# status values of the ledger records
+BLOCK_DONE = 1
+JOB_DONE = 2
+
+
+class _Ledger(object):
+    def __init__(self, path):
+        self.path = path
+        # O_APPEND makes appending a single record atomic,
+        # so blocks can be logged from multiple threads
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def append(self, id_, status, profile=None):
+        end = time.time()
+        # if we don't have a profile, we use the time of the last record as start,
+        # which is exact for blocks that are processed serially
+        with self.lock:
+            start = self.last_time if profile is None else profile.start
+            self.last_time = end
+        if profile is None:
+            times, bytes_read, bytes_written = (0., 0., 0.), 0, 0
+        else:
+            times = (profile.times['read'], profile.times['compute'], profile.times['write'])
+            bytes_read, bytes_written = profile.bytes_read, profile.bytes_written
+        # ru_maxrss is given in kilobytes on linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        record = np.array([(id_, status, start, end) + times +
+                           (bytes_read, bytes_written, peak_rss)],
+                          dtype=LEDGER_DTYPE)
+        os.write(self.fd, record.tobytes())
+
+    def close(self):
+        os.close(self.fd)
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def init_ledger():
+    """ (Re-)open the ledger given by the environment for the current job.
+    """
+    global _ledger
+    with _ledger_lock:
+        if _ledger is not None:
+            _ledger.close()
+            _ledger = None
+        path = os.environ.get(LEDGER_ENV, None)
+        if path is not None:
+            _ledger = _Ledger(path)
+
+
+class BlockProfile(object):
+    """ Measure the time for reading, computing and writing a block
+    and the bytes that were read and written.
+
+    Pass the profile to `log_block_success` to store it in the job ledger.
+    The measurements are summarized by the task after all jobs have finished.
+    If `phases_only` is set, the block time is the sum of the phase times
+    instead of the time since the profile was created.
+
+    Example:
+        profile = fu.BlockProfile()
+        data = profile.read(ds_in, bb)
+        with profile.phase('compute'):
+            result = compute(data)
+        profile.write(ds_out, bb, result)
+        fu.log_block_success(block_id, profile)
+    """
+    def __init__(self, phases_only=False):
+        self.phases_only = phases_only
+        self._start = time.time()
+        self.times = {'read': 0., 'compute': 0., 'write': 0.}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @property
+    def start(self):
+        if self.phases_only:
+            return time.time() - sum(self.times.values())
+        return self._start
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] += time.time() - t0
+
+    def read(self, ds, bb):
+        with self.phase('read'):
+            data = ds[bb]
+        self.bytes_read += data.nbytes
+        return data
+
+    def write(self, ds, bb, data):
+        with self.phase('write'):
+            ds[bb] = data
+        self.bytes_written += data.nbytes
+
+
 def log(msg):
     print("%s: %s" % (str(datetime.now()), msg))
 
 
-def log_block_success(block_id):
+# fused jobs run several block functions on the same block, which must only
+# be logged as processed once all of them have finished
+_block_success_muted = False
+
+
+@contextmanager
+def mute_block_success():
+    """ Don't log processed blocks within this context.
+    """
+    global _block_success_muted
+    _block_success_muted = True
+    try:
+        yield
+    finally:
+        _block_success_muted = False
+
+
+def log_block_success(block_id, profile=None):
+    if _block_success_muted:
+        return
     print("%s: processed block %i" % (str(datetime.now()), block_id))
+    if _ledger is not None:
+        _ledger.append(block_id, BLOCK_DONE, profile)
 
 
 def log_job_success(job_id):
     print("%s: processed job %i" % (str(datetime.now()), job_id))
+    if _ledger is not None:
+        _ledger.append(job_id, JOB_DONE)
+
+
+def save_block_result(folder, block_id, result):
+    """ Save the result of a block, e.g. the number of its ids, as json.
+
+    The result is saved before the block is logged as processed, so the results of
+    the processed blocks are kept if the job fails later and these blocks are not retried.
+    """
+    path = os.path.join(folder, 'block_%i.json' % block_id)
+    # write to a temporary file first, so that a failing job can't leave a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmp_path, path)
+
+
+def load_block_results(folder):
+    """ Load the results saved with `save_block_result`, mapping block ids to results.
+    """
+    results = {}
+    for name in os.listdir(folder):
+        if not (name.startswith('block_') and name.endswith('.json')):
+            continue
+        with open(os.path.join(folder, name)) as f:
+            results[int(name[len('block_'):-len('.json')])] = json.load(f)
+    return results
+
+
+# file name of the batches in a block queue
+QUEUE_BATCH = 'batch_%08i.json'
+
+
+def iterate_blocks(config):
+    """ Iterate over the blocks of a job.
+
+    If the task uses a block queue, batches of blocks are claimed from the queue
+    until it is empty, otherwise the block list of the job is used.
+    """
+    queue_dir = config.get('block_queue', None)
+    if queue_dir is None:
+        for block_id in config['block_list']:
+            yield block_id
+        return
+
+    pending_dir = os.path.join(queue_dir, 'pending')
+    claimed_dir = os.path.join(queue_dir, 'claimed')
+    # start with the batches that follow the offset of this job, so that the jobs
+    # process coherent regions and only take batches from other jobs at the end
+    batches = sorted(os.listdir(pending_dir))
+    first_batch = QUEUE_BATCH % config.get('block_queue_offset', 0)
+    batches = [batch for batch in batches if batch >= first_batch] +\
+        [batch for batch in batches if batch < first_batch]
+    for batch in batches:
+        # renaming is atomic, so exactly one job can claim the batch
+        claimed_path = os.path.join(claimed_dir, batch)
+        try:
+            os.rename(os.path.join(pending_dir, batch), claimed_path)
+        except OSError:
+            continue
+        with open(claimed_path) as f:
+            batch_blocks = json.load(f)
+        for block_id in batch_blocks:
+            yield block_id
+
+
+# file name of the markers for done blocks and for failed jobs
+# in the dependency scheduling of two-pass tasks
+DONE_MARKER = 'block_%i.done'
+FAILED_MARKER = 'failed'
+
+
+def dependency_timeout(config):
+    """ Time in seconds a job waits for the blocks of other jobs in the dependency scheduling,
+    given by 'dependency_timeout' in minutes, which defaults to the time limit of the job.
+    """
+    timeout = config.get('dependency_timeout', None)
+    if timeout is None:
+        timeout = config.get('time_limit', 60)
+    return 60 * timeout
+
+
+def run_with_dependencies(block_list, dependencies, done_dir,
+                          first_pass, second_pass, max_wait=5., timeout=None):
+    """ Run the blocks of a two-pass task in a single job.
+
+    The blocks that are not in `dependencies` belong to the first pass and are processed
+    first, then the blocks of the second pass are processed as soon as the first pass blocks
+    they depend on are done, which may be processed by other jobs. All jobs of the task
+    share the `done_dir`, where the done blocks are marked.
+    Jobs that are killed can't mark that they have failed, so we stop waiting
+    if no block becomes ready for `timeout` seconds.
+    """
+    first_blocks = [block_id for block_id in block_list if block_id not in dependencies]
+    second_blocks = [block_id for block_id in block_list if block_id in dependencies]
+
+    try:
+        for block_id in first_blocks:
+            first_pass(block_id)
+            open(os.path.join(done_dir, DONE_MARKER % block_id), 'w').close()
+    except Exception:
+        # let the other jobs know that they can't wait for our blocks
+        open(os.path.join(done_dir, FAILED_MARKER), 'w').close()
+        raise
+
+    wait = .1
+    last_ready = time.time()
+    while second_blocks:
+        if os.path.exists(os.path.join(done_dir, FAILED_MARKER)):
+            raise RuntimeError("A job of the first pass has failed")
+        done = set(os.listdir(done_dir))
+        ready = [block_id for block_id in second_blocks
+                 if all(DONE_MARKER % dep in done for dep in dependencies[block_id])]
+        if not ready:
+            if timeout is not None and time.time() - last_ready > timeout:
+                raise RuntimeError("Blocks of the first pass were not done after %f s" % timeout)
+            time.sleep(wait)
+            wait = min(2 * wait, max_wait)
+            continue
+        wait = .1
+        for block_id in ready:
+            second_pass(block_id)
+        ready = set(ready)
+        second_blocks = [block_id for block_id in second_blocks if block_id not in ready]
+        last_ready = time.time()
 
 
 # woot, there is no native tail in python ???
 def tail(path, n_lines):
     line_str = '-%i' % n_lines
     return check_output(['tail', line_str, path]).decode().split('\n')[:-1]
+
+
+# open the ledger when a job imports this module
+init_ledger()
@@ -1,9 +1,10 @@
 import os
+import re
 import datetime
 from subprocess import CalledProcessError
 
 import numpy as np
-from .function_utils import tail
+from .function_utils import tail, LEDGER_DTYPE, BLOCK_DONE, JOB_DONE
 
 
 ################
@@ -56,7 +57,7 @@ def parse_runtime_task(log_prefix, max_jobs, return_summary=True):
         path = log_prefix + '%i.log' % job_id
         if not os.path.exists(path):
             break
-        runtimes.append(runtime_from_log(path))
+        runtimes.append(parse_runtime(path))
     if return_summary:
         return (np.mean(runtimes), np.std(runtimes), len(runtimes))
     else:
@@ -149,6 +150,104 @@ def parse_blocks_task(log_prefix, max_jobs, complete_job_list=[]):
         # log might not exist, even if this is not the last job
         if not os.path.exists(path):
             continue
-        blocks.extend(parse_blocks(log_file))
+        blocks.extend(parse_blocks(path))
 
     return blocks
+
+
+################
+# Parse ledgers
+################
+
+
+def read_ledger(path):
+    """ Read the records from a job ledger,
+        returns None if the ledger does not exist
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # drop an incomplete record at the end, which is left if the job was killed while writing
+    n_records = len(data) // LEDGER_DTYPE.itemsize
+    return np.frombuffer(data[:n_records * LEDGER_DTYPE.itemsize], dtype=LEDGER_DTYPE)
+
+
+def read_ledgers_task(ledger_prefix, max_jobs):
+    """ Read the ledgers for all jobs of a task,
+        returns None if no ledger exists
+    """
+    ledgers = {job_id: read_ledger(ledger_prefix + '%i.ledger' % job_id)
+               for job_id in range(max_jobs)}
+    ledgers = {job_id: ledger for job_id, ledger in ledgers.items() if ledger is not None}
+    return ledgers if ledgers else None
+
+
+def parse_jobs_ledger(ledgers):
+    """ Return the jobs that were marked as processed in their ledger
+    """
+    return [job_id for job_id, ledger in ledgers.items()
+            if np.any((ledger['status'] == JOB_DONE) & (ledger['id'] == job_id))]
+
+
+def parse_blocks_ledger(ledgers):
+    """ Return the blocks that were marked as processed in any of the ledgers
+    """
+    records = np.concatenate(list(ledgers.values()))
+    return np.unique(records['id'][records['status'] == BLOCK_DONE])
+
+
+def parse_runtimes_ledger(ledger_dir, job_name):
+    """ Return the ids and runtimes of all blocks in the ledgers for
+        the jobs of a task, or None if there are no ledgers
+    """
+    pattern = re.compile(r'^%s_\d+\.ledger$' % re.escape(job_name))
+    if not os.path.exists(ledger_dir):
+        return None
+    paths = [os.path.join(ledger_dir, name) for name in os.listdir(ledger_dir)
+             if pattern.match(name)]
+    ledgers = [read_ledger(path) for path in paths]
+    ledgers = [ledger for ledger in ledgers if ledger is not None]
+    if not ledgers:
+        return None
+    records = np.concatenate(ledgers)
+    records = records[records['status'] == BLOCK_DONE]
+    if records.size == 0:
+        return None
+    # np.unique returns the first occurence, so we revert to get the latest record per block
+    records = records[::-1]
+    block_ids, index = np.unique(records['id'], return_index=True)
+    runtimes = records['end'][index] - records['start'][index]
+    return block_ids, runtimes
+
+
+def profile_summary(ledgers, n_slowest=10):
+    """ Summarize the block profiles from the ledgers of a task:
+        total and percentile block times, the split into read, compute and write,
+        bytes moved, peak memory and the slowest blocks.
+    """
+    records = np.concatenate(list(ledgers.values()))
+    records = records[records['status'] == BLOCK_DONE]
+    if records.size == 0:
+        return None
+    block_times = records['end'] - records['start']
+    percentiles = (50, 90, 99)
+    slowest = np.argsort(block_times)[::-1][:n_slowest]
+    summary = {'n_blocks': int(records.size),
+               'total_block_time': float(block_times.sum()),
+               'block_time_percentiles': {str(perc): float(val) for perc, val in
+                                          zip(percentiles, np.percentile(block_times, percentiles))},
+               'max_block_time': float(block_times.max()),
+               'read_time': float(records['t_read'].sum()),
+               'compute_time': float(records['t_compute'].sum()),
+               'write_time': float(records['t_write'].sum()),
+               'bytes_read': int(records['bytes_read'].sum()),
+               'bytes_written': int(records['bytes_written'].sum()),
+               'peak_rss': int(records['peak_rss'].max()),
+               'slowest_blocks': [[int(records['id'][ii]), float(block_times[ii])]
+                                  for ii in slowest]}
+    # time that was not measured in any of the phases
+    summary['other_time'] = summary['total_block_time'] - summary['read_time'] -\
+        summary['compute_time'] - summary['write_time']
+    return summary
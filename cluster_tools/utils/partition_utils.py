@@ -0,0 +1,83 @@
+import heapq
+import numpy as np
+
+
+def partition_round_robin(block_list, n_jobs):
+    """ Deal out the blocks to the jobs round-robin.
+    """
+    return [block_list[job_id::n_jobs] for job_id in range(n_jobs)]
+
+
+def partition_contiguous(block_list, n_jobs, costs=None):
+    """ Split the blocks into runs of consecutive blocks, one per job.
+
+    Without costs, all jobs get the same number of blocks (up to one).
+    With costs, the runs are chosen such that the jobs have approximately the
+    same total cost. Consecutive block ids are neighbors in the volume,
+    so each job processes a spatially coherent slab of blocks.
+    """
+    n_blocks = len(block_list)
+    assert n_jobs <= n_blocks, "%i, %i" % (n_jobs, n_blocks)
+    if costs is None:
+        blocks_per_job = [n_blocks // n_jobs + int(job_id < n_blocks % n_jobs)
+                          for job_id in range(n_jobs)]
+        splits = np.cumsum(blocks_per_job)[:-1]
+    else:
+        costs = np.asarray(costs, dtype='float64')
+        assert len(costs) == n_blocks, "%i, %i" % (len(costs), n_blocks)
+        cumulative = np.cumsum(costs)
+        targets = cumulative[-1] * np.arange(1, n_jobs) / n_jobs
+        splits = np.searchsorted(cumulative, targets, side='left') + 1
+        # make sure that each job gets at least one block
+        prev_split = 0
+        for ii in range(n_jobs - 1):
+            splits[ii] = min(max(splits[ii], prev_split + 1), n_blocks - (n_jobs - 1 - ii))
+            prev_split = splits[ii]
+    block_list = list(block_list)
+    bounds = [0] + list(splits) + [n_blocks]
+    return [block_list[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])]
+
+
+def partition_lpt(block_list, n_jobs, costs):
+    """ Bin-pack the blocks to jobs with the longest-processing-time-first rule.
+
+    The most expensive block is assigned to the job with the smallest total cost
+    so far, until all blocks are assigned. Ties are broken by the number of blocks,
+    so that zero-cost blocks are distributed as well.
+    The blocks are sorted by id per job, which keeps neighboring blocks together.
+    """
+    costs = np.asarray(costs, dtype='float64')
+    assert len(costs) == len(block_list), "%i, %i" % (len(costs), len(block_list))
+    order = np.argsort(-costs, kind='stable')
+    jobs = [[] for _ in range(n_jobs)]
+    heap = [(0., 0, job_id) for job_id in range(n_jobs)]
+    for block_index in order:
+        cost, n_blocks, job_id = heapq.heappop(heap)
+        jobs[job_id].append(block_list[block_index])
+        heapq.heappush(heap, (cost + costs[block_index], n_blocks + 1, job_id))
+    return [sorted(job) for job in jobs]
+
+
+def partition_blocks(block_list, n_jobs, method='round_robin', costs=None):
+    """ Partition the block list into one list of blocks per job.
+
+    Arguments:
+        block_list [list] - ids of the blocks
+        n_jobs [int] - number of jobs
+        method [str] - partitioning method, one of 'round_robin', 'contiguous', 'balanced', 'lpt'.
+            'contiguous' assigns runs of consecutive blocks of equal size,
+            'balanced' assigns runs of consecutive blocks of equal cost
+            and 'lpt' bin-packs the blocks by cost (default: 'round_robin')
+        costs [listlike] - estimated cost per block, if None all blocks have the same cost (default: None)
+    """
+    if method == 'round_robin':
+        return partition_round_robin(block_list, n_jobs)
+    elif method == 'contiguous':
+        return partition_contiguous(block_list, n_jobs)
+    elif method == 'balanced':
+        return partition_contiguous(block_list, n_jobs, costs)
+    elif method == 'lpt':
+        costs = np.ones(len(block_list)) if costs is None else costs
+        return partition_lpt(block_list, n_jobs, costs)
+    else:
+        raise ValueError("Invalid partitioning method %s" % method)
@@ -0,0 +1,113 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import function_utils as fu
+
+
+def _nbytes(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    elif isinstance(data, (tuple, list)):
+        return sum(_nbytes(d) for d in data)
+    elif isinstance(data, dict):
+        return sum(_nbytes(d) for d in data.values())
+    return 0
+
+
+class BlockPipeline(object):
+    """ Process blocks with read-ahead and write-behind.
+
+    The inputs of the next `n_prefetch` blocks are read on I/O threads while the
+    current blocks are computed on `n_threads` threads, and the results are written
+    on `n_io_threads` I/O threads, with at most `n_prefetch` pending writes.
+
+    The task provides the functions
+        read(block_id) -> data
+        compute(block_id, data) -> result
+        write(block_id, result)
+    If `read` or `compute` return None, the block is done and the following steps are skipped.
+    The pipeline logs the processed blocks with the time spent in the three steps,
+    so these functions should not call `fu.log_block_success`.
+
+    Example:
+        pipeline = BlockPipeline(read, compute, write, n_threads=config.get('threads_per_job', 1))
+        pipeline.run(fu.iterate_blocks(config))
+    """
+    def __init__(self, read, compute, write,
+                 n_threads=1, n_prefetch=2, n_io_threads=1):
+        self.read = read
+        self.compute = compute
+        self.write = write
+        self.n_threads = max(n_threads, 1)
+        self.n_io_threads = max(n_io_threads, 1)
+        # keep all I/O threads busy
+        self.n_prefetch = max(n_prefetch, self.n_io_threads)
+
+    def _read(self, block_id):
+        # the blocks wait in the queues between the steps,
+        # so only the time spent in the steps is counted as block time
+        profile = fu.BlockProfile(phases_only=True)
+        with profile.phase('read'):
+            data = self.read(block_id)
+        profile.bytes_read += _nbytes(data)
+        return data, profile
+
+    def _compute(self, block_id, data, profile):
+        fu.log("start processing block %i" % block_id)
+        with profile.phase('compute'):
+            return self.compute(block_id, data)
+
+    def _write(self, block_id, result, profile):
+        with profile.phase('write'):
+            self.write(block_id, result)
+        profile.bytes_written += _nbytes(result)
+        fu.log_block_success(block_id, profile)
+
+    def run(self, block_ids):
+        # the block ids are only consumed from this thread,
+        # so they can be given by a generator, e.g. fu.iterate_blocks
+        block_ids = iter(block_ids)
+        reads, computes, writes = deque(), deque(), deque()
+
+        with ThreadPoolExecutor(self.n_io_threads) as read_pool,\
+                ThreadPoolExecutor(self.n_threads) as compute_pool,\
+                ThreadPoolExecutor(self.n_io_threads) as write_pool:
+
+            def _prefetch():
+                while len(reads) < self.n_prefetch:
+                    block_id = next(block_ids, None)
+                    if block_id is None:
+                        return
+                    reads.append((block_id, read_pool.submit(self._read, block_id)))
+
+            _prefetch()
+            while reads or computes:
+                # start computing the blocks that have been read
+                while reads and len(computes) < self.n_threads:
+                    block_id, future = reads.popleft()
+                    data, profile = future.result()
+                    _prefetch()
+                    if data is None:
+                        fu.log_block_success(block_id, profile)
+                        continue
+                    computes.append((block_id, profile,
+                                     compute_pool.submit(self._compute, block_id, data, profile)))
+                if not computes:
+                    continue
+
+                block_id, profile, future = computes.popleft()
+                result = future.result()
+                if result is None:
+                    fu.log_block_success(block_id, profile)
+                    continue
+
+                # wait for the oldest write if too many are pending,
+                # this also raises errors that occured during writing
+                while len(writes) >= self.n_prefetch:
+                    writes.popleft().result()
+                writes.append(write_pool.submit(self._write, block_id, result, profile))
+
+            while writes:
+                writes.popleft().result()
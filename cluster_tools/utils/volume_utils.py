@@ -1,5 +1,6 @@
 import os
 import json
+import zlib
 from functools import partial
 from itertools import product
 from math import floor, ceil
@@ -9,9 +10,11 @@ import h5py
 import z5py
 import vigra
 
+from scipy.ndimage import find_objects
 from scipy.ndimage.morphology import binary_erosion
 from nifty.tools import blocking
 from .knossos_wrapper import KnossosFile
+from .chunk_cache import CachedFile
 
 # use vigra filters as fallback if we don't have
 # fastfilters available
@@ -31,17 +34,26 @@ def is_h5(path):
     return ext in ('h5', 'hdf5', 'hdf')
 
 
-def file_reader(path, mode='a'):
+def file_reader(path, mode='a', cache_size=0):
+    """ Open n5, zarr, hdf5 or knossos file.
+
+    If `cache_size` (in MB) is given, the chunks that are read from the datasets
+    of the file are kept in a LRU cache of this size, which avoids decompressing
+    the same chunks repeatedly when reading overlapping blocks.
+    """
     if is_z5(path):
-        return z5py.File(path, mode=mode)
+        f = z5py.File(path, mode=mode)
     elif is_h5(path):
-        return h5py.File(path, mode=mode)
+        f = h5py.File(path, mode=mode)
     else:
         try:
             return KnossosFile(path)
         except RuntimeError:
             ext = os.path.splitext(path)[1][1:].lower()
             raise RuntimeError("Invalid file format %s" % ext)
+    if cache_size > 0:
+        f = CachedFile(f, int(cache_size * 1024**2))
+    return f
 
 
 def get_shape(path, key):
@@ -52,7 +64,11 @@ def get_shape(path, key):
 
 def blocks_in_volume(shape, block_shape,
                      roi_begin=None, roi_end=None,
-                     block_list_path=None):
+                     block_list_path=None, occupancy=None):
+    """ Get the ids of the blocks in the volume, the roi and / or the block list.
+
+    If `occupancy` (see `ChunkOccupancy`) is given, blocks that are empty are dropped.
+    """
     assert len(shape) == len(block_shape), '%i; %i' % (len(shape), len(block_shape))
     assert (roi_begin is None) == (roi_end is None)
     have_roi = roi_begin is not None
@@ -64,9 +80,9 @@ def blocks_in_volume(shape, block_shape,
     blocking_ = blocking([0] * len(shape), list(shape), list(block_shape))
 
     # we don't have a roi and don't have a block_list_path
-    # -> return all block_ids
+    # -> use all block_ids
     if not have_roi and not block_list_path:
-        return list(range(blocking_.numberOfBlocks))
+        block_list = list(range(blocking_.numberOfBlocks))
 
     # if we have a roi load the blocks in roi
     if have_roi:
@@ -86,9 +102,214 @@ def blocks_in_volume(shape, block_shape,
         else:
             block_list = list_from_path
 
+    # drop the empty blocks
+    if occupancy is not None:
+        occupancy.build_index()
+        block_list = [block_id for block_id in block_list
+                      if not occupancy.is_empty(block_to_bb(blocking_.getBlock(block_id)))]
+
     return block_list
 
 
+class ChunkOccupancy(object):
+    """ Index of the chunks of a dataset that exist in the file.
+
+    Chunks that do not exist contain only the fill value (0), so blocks that
+    only overlap missing chunks are empty and do not need to be read.
+    The index is given by the chunk files (n5, zarr) or the chunk table (hdf5),
+    so it is refreshed by every writer that writes chunks; writers should not write empty blocks.
+    For n5 and zarr, a block is checked by looking up its chunk files;
+    `build_index` lists all chunks of the dataset, which is faster for checking many blocks.
+
+    The blocks are given in spatial coordinates, which are multiplied by `scale_factor`
+    to get the dataset coordinates; i.e. the scale factor can be used to check blocks
+    of a downscaled volume. For datasets with channels, all channels are checked.
+    """
+    def __init__(self, path, key, scale_factor=1):
+        self.path = path
+        self.key = key
+        with file_reader(path, 'r') as f:
+            ds = f[key]
+            self.shape = tuple(ds.shape)
+            self.chunks = tuple(ds.chunks)
+            self.fill_value = getattr(ds, 'fillvalue', 0)
+            self._occupied = self._read_chunk_table(ds) if is_h5(path) else None
+
+        ndim = len(self.shape)
+        self.n_channel_axes = 1 if ndim == 4 else 0
+        n_spatial = ndim - self.n_channel_axes
+        self.scale_factor = [scale_factor] * n_spatial if isinstance(scale_factor, int) else list(scale_factor)
+
+        self.ds_path = os.path.join(path, key)
+        self.nested = True
+        self.reverse = is_z5(path) and os.path.splitext(path)[1][1:].lower() == 'n5'
+        # for zarr, the chunk layout and fill value are given by the metadata
+        if is_z5(path) and not self.reverse:
+            with open(os.path.join(self.ds_path, '.zarray')) as f:
+                attrs = json.load(f)
+            self.nested = attrs.get('dimension_separator', '.') == '/'
+            self.fill_value = attrs.get('fill_value', 0)
+
+    @staticmethod
+    def is_supported(path, key):
+        """ Check if empty chunks can be determined for this dataset.
+        """
+        if not (is_z5(path) or is_h5(path)):
+            return False
+        with file_reader(path, 'r') as f:
+            ds = f[key]
+            if getattr(ds, 'chunks', None) is None:
+                return False
+            # the chunk table is only available for newer h5py versions
+            if is_h5(path) and not hasattr(ds.id, 'get_chunk_info'):
+                return False
+        return True
+
+    def _grid_shape(self):
+        return tuple(sh // ch + int(sh % ch != 0) for sh, ch in zip(self.shape, self.chunks))
+
+    @property
+    def grid_shape(self):
+        """ Number of chunks along each axis.
+        """
+        return self._grid_shape()
+
+    def _read_chunk_table(self, ds):
+        occupied = np.zeros(self._grid_shape(), dtype='bool')
+        for chunk_index in range(ds.id.get_num_chunks()):
+            offset = ds.id.get_chunk_info(chunk_index).chunk_offset
+            occupied[tuple(off // ch for off, ch in zip(offset, self.chunks))] = True
+        return occupied
+
+    def _parse_chunk_file(self, parts):
+        if len(parts) != len(self.shape) or not all(part.isdigit() for part in parts):
+            return None
+        chunk_id = tuple(int(part) for part in parts)
+        return chunk_id[::-1] if self.reverse else chunk_id
+
+    def _chunk_file(self, chunk_id):
+        parts = [str(cid) for cid in (chunk_id[::-1] if self.reverse else chunk_id)]
+        if self.nested:
+            return os.path.join(self.ds_path, *parts)
+        return os.path.join(self.ds_path, '.'.join(parts))
+
+    def build_index(self):
+        """ List all chunks of the dataset.
+        """
+        if self._occupied is not None:
+            return
+        occupied = np.zeros(self._grid_shape(), dtype='bool')
+        for root, _, files in os.walk(self.ds_path):
+            rel = os.path.relpath(root, self.ds_path)
+            parts = [] if rel == '.' else rel.split(os.sep)
+            for name in files:
+                chunk_id = self._parse_chunk_file(parts + [name] if self.nested else name.split('.'))
+                if chunk_id is not None:
+                    occupied[chunk_id] = True
+        self._occupied = occupied
+
+    def _chunk_ranges(self, bb):
+        ranges = [range(self._grid_shape()[0])] if self.n_channel_axes else []
+        spatial_shape = self.shape[self.n_channel_axes:]
+        spatial_chunks = self.chunks[self.n_channel_axes:]
+        for b, sf, sh, ch in zip(bb, self.scale_factor, spatial_shape, spatial_chunks):
+            start = int(floor(b.start * sf))
+            stop = min(int(ceil(b.stop * sf)), sh)
+            ranges.append(range(start // ch, (stop - 1) // ch + 1) if stop > start else range(0))
+        return ranges
+
+    def is_empty(self, bb):
+        """ Check if the block given by its (spatial) bounding box is empty.
+
+        Blocks that overlap existing chunks are not empty, even if the chunk data is 0.
+        """
+        if self.fill_value != 0:
+            return False
+        ranges = self._chunk_ranges(bb)
+        if self._occupied is not None:
+            return not self._occupied[tuple(slice(r.start, r.stop) for r in ranges)].any()
+        return not any(os.path.exists(self._chunk_file(chunk_id)) for chunk_id in product(*ranges))
+
+    def checksums(self):
+        """ Compute the crc32 checksums of the encoded chunks, without decoding them.
+
+        Returns a dict that maps the ids of the existing chunks, joined by '_', to their checksums.
+        """
+        checksums = {}
+        if is_h5(self.path):
+            with file_reader(self.path, 'r') as f:
+                ds = f[self.key]
+                for chunk_index in range(ds.id.get_num_chunks()):
+                    offset = ds.id.get_chunk_info(chunk_index).chunk_offset
+                    chunk_id = tuple(off // ch for off, ch in zip(offset, self.chunks))
+                    _, data = ds.id.read_direct_chunk(offset)
+                    checksums['_'.join(map(str, chunk_id))] = zlib.crc32(data)
+            return checksums
+
+        self.build_index()
+        for chunk_id in zip(*np.where(self._occupied)):
+            with open(self._chunk_file(chunk_id), 'rb') as f:
+                checksums['_'.join(map(str, chunk_id))] = zlib.crc32(f.read())
+        return checksums
+
+
+def load_occupancy(path, key, scale_factor=1):
+    """ Get the `ChunkOccupancy` of the dataset or None if it is not supported.
+    """
+    if not ChunkOccupancy.is_supported(path, key):
+        return None
+    return ChunkOccupancy(path, key, scale_factor)
+
+
+def blocks_with_changed_chunks(occupancy, checksums, prev_checksums, blocking, block_list, halo=None):
+    """ Find the blocks whose chunks (including the halo) have changed,
+    given the chunk checksums of `ChunkOccupancy.checksums` before and after the change.
+    """
+    changed_chunks = set(checksums) ^ set(prev_checksums)
+    changed_chunks.update(key for key in set(checksums) & set(prev_checksums)
+                          if checksums[key] != prev_checksums[key])
+    # all channels of a spatial chunk are combined
+    n_spatial = len(occupancy.shape) - occupancy.n_channel_axes
+    changed = np.zeros(occupancy._grid_shape()[-n_spatial:], dtype='bool')
+    for key in changed_chunks:
+        changed[tuple(int(cid) for cid in key.split('_'))[-n_spatial:]] = True
+
+    changed_blocks = []
+    for block_id in block_list:
+        if halo is None or sum(halo) == 0:
+            block = blocking.getBlock(block_id)
+        else:
+            block = blocking.getBlockWithHalo(block_id, list(halo)).outerBlock
+        ranges = occupancy._chunk_ranges(block_to_bb(block))[occupancy.n_channel_axes:]
+        if changed[tuple(slice(r.start, r.stop) for r in ranges)].any():
+            changed_blocks.append(block_id)
+    return changed_blocks
+
+
+def write_checksums(path, key, checksums, grid_shape):
+    """ Store the checksums of `ChunkOccupancy.checksums` in a dataset with the shape of the chunk grid,
+    so that their size is not limited like the size of attributes. Missing chunks are stored as 0.
+    """
+    grid = np.zeros(tuple(grid_shape), dtype='uint64')
+    for chunk_key, checksum in checksums.items():
+        grid[tuple(int(cid) for cid in chunk_key.split('_'))] = checksum + 1
+    with file_reader(path) as f:
+        ds = f.require_dataset(key, shape=grid.shape, dtype='uint64', compression='gzip',
+                               chunks=tuple(min(sh, 64) for sh in grid.shape))
+        ds[:] = grid
+
+
+def read_checksums(path, key):
+    """ Load the checksums stored by `write_checksums` or None if they don't exist.
+    """
+    with file_reader(path, 'r') as f:
+        if key not in f:
+            return None
+        grid = f[key][:]
+    return {'_'.join(map(str, chunk_id)): int(grid[chunk_id]) - 1
+            for chunk_id in zip(*np.nonzero(grid))}
+
+
 def block_to_bb(block):
     return tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
 
@@ -111,8 +332,16 @@ def apply_filter(input_, filter_name, sigma, apply_in_2d=False):
 
 
 # TODO enable channel-wise normalisation
-def normalize(input_, min_val=None, max_val=None):
-    input_ = input_.astype('float32')
+def normalize(input_, min_val=None, max_val=None, out=None):
+    # if out is given, the input is normalized into it, so the input can be
+    # normalized in-place if it is float32 already
+    if out is None:
+        input_ = input_.astype('float32')
+    else:
+        assert out.dtype == np.dtype('float32')
+        if out is not input_:
+            out[:] = input_
+        input_ = out
     min_val = input_.min() if min_val is None else min_val
     input_ -= min_val
     max_val = input_.max() if max_val is None else max_val
@@ -129,81 +358,112 @@ def watershed(input_, seeds, size_filter=0, exclude=None):
     return ws, max_id
 
 
-def apply_size_filter(segmentation, input_, size_filter, exclude=None):
-    ids, sizes = np.unique(segmentation, return_counts=True)
-    filter_ids = ids[sizes < size_filter]
+def _size_filter_mask(segmentation, size_filter, exclude=None):
+    max_id = int(segmentation.max())
+    # if the ids are dense, e.g. for consecutive watershed labels, we count the sizes with
+    # bincount and build the mask with a lookup table, otherwise we fall back to unique
+    if max_id < segmentation.size:
+        flat = segmentation.ravel()
+        # bincount does not accept uint64, but the ids are small enough for int64
+        if flat.dtype == np.dtype('uint64'):
+            flat = flat.view('int64')
+        filter_lut = np.bincount(flat, minlength=max_id + 1) < size_filter
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype='int64')
+            filter_lut[exclude[exclude <= max_id]] = False
+        return filter_lut[segmentation]
+
+    ids, inverse, sizes = np.unique(segmentation, return_inverse=True, return_counts=True)
+    filter_lut = sizes < size_filter
     if exclude is not None:
-        filter_ids = filter_ids[np.logical_not(np.in1d(filter_ids, exclude))]
-    filter_mask = np.in1d(segmentation, filter_ids).reshape(segmentation.shape)
+        filter_lut[np.isin(ids, exclude)] = False
+    return filter_lut[inverse].reshape(segmentation.shape)
+
+
+def _refill_region(segmentation, input_, bb, region_mask):
+    seeds = segmentation[bb]
+    # a region without adjacent seeds stays empty
+    if not seeds.any():
+        return
+    ws, _ = vigra.analysis.watershedsNew(np.require(input_[bb], requirements='C'),
+                                         seeds=seeds.copy())
+    seeds[region_mask] = ws[region_mask]
+
+
+def apply_size_filter(segmentation, input_, size_filter, exclude=None, max_regions=64):
+    filter_mask = _size_filter_mask(segmentation, size_filter, exclude)
+    if not filter_mask.any():
+        return segmentation, int(segmentation.max())
     segmentation[filter_mask] = 0
-    _, max_id = vigra.analysis.watershedsNew(input_, seeds=segmentation, out=segmentation)
-    return segmentation, max_id
-
-
-def _make_checkerboard(blocking):
-    blocks_a = [0]
-    blocks_b = []
-    all_blocks = [0]
-
-    def recurse(current_block, insert_list):
-        other_list = blocks_a if insert_list is blocks_b else blocks_b
-        for dim in range(3):
-            ngb_id = blocking.getNeighborId(current_block, dim, False)
-            if ngb_id != -1:
-                if ngb_id not in all_blocks:
-                    insert_list.append(ngb_id)
-                    all_blocks.append(ngb_id)
-                    recurse(ngb_id, other_list)
-
-    recurse(0, blocks_b)
-    all_blocks = blocks_a + blocks_b
-    expected = set(range(blocking.numberOfBlocks))
-    assert len(all_blocks) == len(expected), "%i, %i" % (len(all_blocks), len(expected))
-    assert len(set(all_blocks) - expected) == 0
-    assert len(blocks_a) == len(blocks_b), "%i, %i" % (len(blocks_a), len(blocks_b))
-    return blocks_a, blocks_b
-
-
-def _make_checkerboard_with_roi(blocking, roi_begin, roi_end):
-
-    # find the smallest roi coordinate
-    block0 = blocking.coordinatesToBlockId(roi_begin)
-
-    blocks_a = [block0]
-    blocks_b = []
-    all_blocks = [block0]
-
-    blocks_in_roi = blocking.getBlockIdsOverlappingBoundingBox(roi_begin, roi_end)
-    assert block0 in blocks_in_roi
-
-    def recurse(current_block, insert_list):
-        other_list = blocks_a if insert_list is blocks_b else blocks_b
-        for dim in range(3):
-            ngb_id = blocking.getNeighborId(current_block, dim, False)
-            if ngb_id != -1:
-                #  check if this block is overlapping the roi
-                if ngb_id not in blocks_in_roi:
-                    continue
-                if ngb_id not in all_blocks:
-                    insert_list.append(ngb_id)
-                    all_blocks.append(ngb_id)
-                    recurse(ngb_id, other_list)
 
-    recurse(block0, blocks_b)
-    all_blocks = blocks_a + blocks_b
-    expected = set(blocks_in_roi)
-    assert len(all_blocks) == len(expected), "%i, %i" % (len(all_blocks), len(expected))
-    assert len(set(all_blocks) - expected) == 0
-    assert len(blocks_a) == len(blocks_b), "%i, %i" % (len(blocks_a), len(blocks_b))
-    return blocks_a, blocks_b
+    # refill the filtered segments with a watershed in the bounding boxes of the
+    # connected filtered regions, enlarged by one pixel, so that they contain all the
+    # seeds adjacent to the region. the regions can only be flooded from these seeds,
+    # so this agrees with a full watershed up to the tie-breaking between equal values.
+    regions = vigra.analysis.labelMultiArrayWithBackground(filter_mask.astype('uint8'))
+    bbs = find_objects(regions)
+    shape = segmentation.shape
+
+    def _enlarge(bb):
+        return tuple(slice(max(b.start - 1, 0), min(b.stop + 1, sh)) for b, sh in zip(bb, shape))
+
+    # for many regions, a single watershed in the bounding box of all regions
+    # is faster than a watershed per region
+    if len(bbs) > max_regions:
+        bb = _enlarge(tuple(slice(min(b[axis].start for b in bbs), max(b[axis].stop for b in bbs))
+                            for axis in range(segmentation.ndim)))
+        _refill_region(segmentation, input_, bb, filter_mask[bb])
+    else:
+        for region_id, bb in enumerate(bbs, 1):
+            bb = _enlarge(bb)
+            _refill_region(segmentation, input_, bb, regions[bb] == region_id)
+    return segmentation, int(segmentation.max())
+
+
+def _block_parity(blocking, block_ids):
+    # the parity of the sum of the block grid coordinates,
+    # which differs between face neighbors
+    grid_pos = np.unravel_index(np.array(block_ids, dtype='int64'), blocking.blocksPerAxis)
+    return np.sum(grid_pos, axis=0) % 2
 
 
 def make_checkerboard_block_lists(blocking, roi_begin=None, roi_end=None):
+    """ Split the blocks into two lists, such that the face neighbors of
+    a block are in the other list.
+
+    The first list contains the block 0 or, if a roi is given, the block at the begin of the roi.
+    """
     assert (roi_begin is None) == (roi_end is None)
     if roi_begin is None:
-        return _make_checkerboard(blocking)
+        block_ids = np.arange(blocking.numberOfBlocks)
+        block0 = 0
     else:
-        return _make_checkerboard_with_roi(blocking, roi_begin, roi_end)
+        roi_end = [sh if re is None else re for re, sh in zip(roi_end, blocking.roiEnd)]
+        block_ids = np.array(blocking.getBlockIdsOverlappingBoundingBox(list(roi_begin),
+                                                                        list(roi_end)))
+        block0 = blocking.coordinatesToBlockId(list(roi_begin))
+    parity = _block_parity(blocking, block_ids)
+    in_a = parity == _block_parity(blocking, [block0])[0]
+    return block_ids[in_a].tolist(), block_ids[np.logical_not(in_a)].tolist()
+
+
+def checkerboard_dependencies(blocking, blocks_a, blocks_b, halo):
+    """ Find the blocks of the first checkerboard pass (`blocks_a`) that the blocks
+    of the second pass (`blocks_b`) depend on.
+
+    These are the face neighbors and the blocks that overlap with the block enlarged by the halo.
+    """
+    blocks_a = set(blocks_a)
+    dependencies = {}
+    for block_id in blocks_b:
+        outer_block = blocking.getBlockWithHalo(block_id, list(halo)).outerBlock
+        ngb_ids = blocking.getBlockIdsOverlappingBoundingBox(list(outer_block.begin),
+                                                             list(outer_block.end)).tolist()
+        ngb_ids += [blocking.getNeighborId(block_id, axis, lower)
+                    for axis in range(len(halo)) for lower in (False, True)]
+        dependencies[block_id] = sorted(set(int(ngb_id) for ngb_id in ngb_ids
+                                            if ngb_id in blocks_a))
+    return dependencies
 
 
 class InterpolatedVolume(object):
@@ -308,6 +568,27 @@ def load_mask(mask_path, mask_key, shape):
     return mask
 
 
+def mask_block_costs(mask_path, mask_key, shape, block_shape, block_list, min_cost=.05):
+    """ Estimate the cost of blocks by the fraction of voxels inside of the mask.
+
+    The mask is read at its own resolution, so this is cheap for downsampled masks.
+    Blocks outside of the mask get `min_cost`, because they still need to be checked.
+    """
+    with file_reader(mask_path, 'r') as f:
+        ds = f[mask_key]
+        mask_shape = ds.shape
+        scale = [msh / float(sh) for msh, sh in zip(mask_shape, shape)]
+        blocking_ = blocking([0] * len(shape), list(shape), list(block_shape))
+        costs = []
+        for block_id in block_list:
+            block = blocking_.getBlock(block_id)
+            bb = tuple(slice(int(floor(beg * sc)), max(int(ceil(end * sc)), int(floor(beg * sc)) + 1))
+                       for beg, end, sc in zip(block.begin, block.end, scale))
+            mask = ds[bb]
+            costs.append(np.count_nonzero(mask) / float(mask.size))
+    return np.maximum(np.array(costs, dtype='float64'), min_cost)
+
+
 def get_face(blocking, block_id, ngb_id, axis, halo=[1, 1, 1]):
     # get the two block coordinates
     block_a = blocking.getBlock(block_id)
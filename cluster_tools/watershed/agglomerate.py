@@ -15,6 +15,7 @@ from vigra.analysis import relabelConsecutive
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
 import cluster_tools.utils.segmentation_utils as su
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -126,23 +127,15 @@ class AgglomerateLSF(AgglomerateBase, LSFTask):
 # Implementation
 #
 
-def _agglomerate_block(blocking, block_id, ds_in, ds_out, config):
-    fu.log("start processing block %i" % block_id)
-    have_ignore_label = config['have_ignore_label']
-    use_mala_agglomeration = config.get('use_mala_agglomeration', True)
-    threshold = config.get('threshold', 0.9)
-    size_regularizer = config.get('size_regularizer', .5)
-    invert_inputs = config.get('invert_inputs', False)
+def _read_agglomerate_block(blocking, block_id, ds_in, ds_out, config):
     offsets = config.get('offsets', None)
-
     bb = vu.block_to_bb(blocking.getBlock(block_id))
     # load the segmentation / output
     seg = ds_out[bb]
 
     # check if this block is empty
     if np.sum(seg) == 0:
-        fu.log_block_success(block_id)
-        return
+        return None
 
     # load the input data
     ndim_in = ds_in.ndim
@@ -154,6 +147,16 @@ def _agglomerate_block(blocking, block_id, ds_in, ds_out, config):
     else:
         assert offsets is None
         input_ = vu.normalize(ds_in[bb])
+    return seg, input_
+
+
+def _agglomerate_block(seg, input_, config, n_threads):
+    have_ignore_label = config['have_ignore_label']
+    use_mala_agglomeration = config.get('use_mala_agglomeration', True)
+    threshold = config.get('threshold', 0.9)
+    size_regularizer = config.get('size_regularizer', .5)
+    invert_inputs = config.get('invert_inputs', False)
+    offsets = config.get('offsets', None)
 
     if invert_inputs:
         input_ = 1. - input_
@@ -166,14 +169,14 @@ def _agglomerate_block(blocking, block_id, ds_in, ds_out, config):
 
     # construct rag
     rag = nrag.gridRag(seg, numberOfLabels=max_id + 1,
-                       numberOfThreads=1)
+                       numberOfThreads=n_threads)
 
     # extract edge features
     if offsets is None:
-        edge_features = nrag.accumulateEdgeMeanAndLength(rag, input_, numberOfThreads=1)
+        edge_features = nrag.accumulateEdgeMeanAndLength(rag, input_, numberOfThreads=n_threads)
     else:
         edge_features = nrag.accumulateAffinityStandartFeatures(rag, input_, offsets,
-                                                                numberOfThreads=1)
+                                                                numberOfThreads=n_threads)
     edge_features, edge_sizes = edge_features[:, 0], edge_features[:, -1]
     uv_ids = rag.uvIds()
     # set edges to ignore label to be maximally repulsive
@@ -204,14 +207,16 @@ def _agglomerate_block(blocking, block_id, ds_in, ds_out, config):
     fu.log("reduced number of labels from %i to %i" % (n_nodes, max_id + 1))
 
     # project node labels back to segmentation
-    seg = nrag.projectScalarNodeDataToPixels(rag, node_labels, numberOfThreads=1)
+    seg = nrag.projectScalarNodeDataToPixels(rag, node_labels, numberOfThreads=n_threads)
     seg = seg.astype('uint64')
-    # add offset back to segmentation
-    seg[seg != 0] += id_offset
+    # add offset back to segmentation, so that the ids are in the id range of the input
+    seg[seg != 0] += id_offset - 1
+    return seg
+
 
+def _write_agglomerate_block(blocking, block_id, ds_out, seg):
+    bb = vu.block_to_bb(blocking.getBlock(block_id))
     ds_out[bb] = seg
-    # log block success
-    fu.log_block_success(block_id)
 
 
 def agglomerate(job_id, config_path):
@@ -228,7 +233,6 @@ def agglomerate(job_id, config_path):
         shape = shape[1:]
 
     block_shape = list(config['block_shape'])
-    block_list = config['block_list']
 
     # read the output config
     output_path = config['output_path']
@@ -236,6 +240,7 @@ def agglomerate(job_id, config_path):
 
     # get the blocking
     blocking = nt.blocking([0, 0, 0], shape, block_shape)
+    n_threads = config.get('threads_per_job', 1)
 
     # submit blocks
     with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
@@ -243,8 +248,16 @@ def agglomerate(job_id, config_path):
         assert ds_in.ndim in (3, 4)
         ds_out = f_out[output_key]
         assert ds_out.ndim == 3
-        for block_id in block_list:
-            _agglomerate_block(blocking, block_id, ds_in, ds_out, config)
+
+        # the rag and features of a block are computed with all threads,
+        # while the next blocks are read and the previous results are written
+        pipeline = BlockPipeline(lambda block_id: _read_agglomerate_block(blocking, block_id,
+                                                                          ds_in, ds_out, config),
+                                 lambda block_id, data: _agglomerate_block(data[0], data[1],
+                                                                           config, n_threads),
+                                 lambda block_id, seg: _write_agglomerate_block(blocking, block_id,
+                                                                                ds_out, seg))
+        pipeline.run(fu.iterate_blocks(config))
 
     # log success
     fu.log_job_success(job_id)
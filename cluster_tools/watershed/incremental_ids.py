@@ -0,0 +1,165 @@
+#! /bin/python
+
+import os
+import sys
+import json
+import shutil
+
+import luigi
+import numpy as np
+import nifty.tools as nt
+
+import cluster_tools.utils.volume_utils as vu
+import cluster_tools.utils.function_utils as fu
+from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
+
+
+def checksums_key(output_key):
+    """ Key of the dataset with the input checksums of the last incremental watershed run.
+    """
+    return '%s_input_checksums' % output_key
+
+
+def max_ids_folder(tmp_folder):
+    """ Folder with the number of new ids of each block recomputed by an incremental watershed.
+    """
+    return os.path.join(tmp_folder, 'watershed_max_ids')
+
+
+#
+# Incremental Ids Tasks
+#
+
+class IncrementalIdsBase(luigi.Task):
+    """ IncrementalIds base class
+
+    Makes the ids of the blocks recomputed by an incremental watershed unique.
+    The new ids of each block are consecutive above the max id of the previous run,
+    so they are offset by the number of new ids in the preceding blocks.
+    Afterwards, the max id and the input checksums of this run are stored for the next run.
+    """
+
+    task_name = 'incremental_ids'
+    src_file = os.path.abspath(__file__)
+    allow_retry = False
+
+    output_path = luigi.Parameter()
+    output_key = luigi.Parameter()
+    # task that is required before running this task
+    dependency = luigi.TaskParameter()
+
+    def requires(self):
+        return self.dependency
+
+    def _finish(self, max_id):
+        with vu.file_reader(self.output_path) as f:
+            f[self.output_key].attrs['maxId'] = max_id
+        checksums_path = os.path.join(self.tmp_folder, 'watershed_input_checksums.json')
+        if os.path.exists(checksums_path):
+            with open(checksums_path) as f:
+                checksums = json.load(f)
+            vu.write_checksums(self.output_path, checksums_key(self.output_key),
+                               checksums['checksums'], checksums['grid_shape'])
+        shutil.rmtree(max_ids_folder(self.tmp_folder))
+
+    def run_impl(self):
+        shebang, block_shape, roi_begin, roi_end = self.global_config_values()
+        self.init(shebang)
+
+        with vu.file_reader(self.output_path, 'r') as f:
+            id_offset = int(f[self.output_key].attrs.get('maxId', 0))
+
+        # the offset of a block is the number of new ids in the blocks before it
+        # the max ids are saved per block, so they include the blocks of failed jobs
+        # that were logged as processed and not retried
+        max_ids = fu.load_block_results(max_ids_folder(self.tmp_folder))
+        block_ids = sorted(max_ids)
+        n_ids = np.array([max_ids[block_id] for block_id in block_ids], dtype='uint64')
+        offsets = np.cumsum(n_ids) - n_ids
+        # blocks without new ids or without offset don't need to be rewritten
+        offsets = {block_id: int(offset) for block_id, offset, n in zip(block_ids, offsets, n_ids)
+                   if offset > 0 and n > 0}
+        offsets_path = os.path.join(self.tmp_folder, 'incremental_id_offsets.json')
+        with open(offsets_path, 'w') as f:
+            json.dump(offsets, f)
+        max_id = id_offset + int(n_ids.sum())
+        self._write_log("adding %i new ids to the max id %i" % (max_id - id_offset, id_offset))
+
+        config = self.get_task_config()
+        config.update({'output_path': self.output_path, 'output_key': self.output_key,
+                       'block_shape': block_shape, 'id_offset': id_offset,
+                       'offsets_path': offsets_path})
+
+        block_list = list(offsets.keys())
+        n_jobs = min(len(block_list), self.max_jobs)
+        if n_jobs > 0:
+            # prime and run the jobs
+            self.prepare_jobs(n_jobs, block_list, config)
+            self.submit_jobs(n_jobs)
+
+            # wait till jobs finish and check for job success
+            self.wait_for_jobs()
+            self.check_jobs(n_jobs)
+        self._finish(max_id)
+
+
+class IncrementalIdsLocal(IncrementalIdsBase, LocalTask):
+    """
+    IncrementalIds on local machine
+    """
+    pass
+
+
+class IncrementalIdsSlurm(IncrementalIdsBase, SlurmTask):
+    """
+    IncrementalIds on slurm cluster
+    """
+    pass
+
+
+class IncrementalIdsLSF(IncrementalIdsBase, LSFTask):
+    """
+    IncrementalIds on lsf cluster
+    """
+    pass
+
+
+def _offset_block(blocking, block_id, ds, id_offset, offset):
+    fu.log("start processing block %i" % block_id)
+    profile = fu.BlockProfile()
+    bb = vu.block_to_bb(blocking.getBlock(block_id))
+    seg = profile.read(ds, bb)
+    # only the new ids are offset, the ids of the previous run are kept
+    with profile.phase('compute'):
+        seg[seg > id_offset] += np.uint64(offset)
+    profile.write(ds, bb, seg)
+    fu.log_block_success(block_id, profile)
+
+
+def incremental_ids(job_id, config_path):
+    fu.log("start processing job %i" % job_id)
+    fu.log("reading config from %s" % config_path)
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    output_path = config['output_path']
+    output_key = config['output_key']
+    block_shape = config['block_shape']
+    id_offset = config['id_offset']
+
+    with open(config['offsets_path']) as f:
+        offsets = json.load(f)
+
+    with vu.file_reader(output_path) as f:
+        ds = f[output_key]
+        blocking = nt.blocking([0, 0, 0], list(ds.shape), list(block_shape))
+        for block_id in fu.iterate_blocks(config):
+            _offset_block(blocking, block_id, ds, id_offset, offsets[str(block_id)])
+
+    fu.log_job_success(job_id)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    assert os.path.exists(path), path
+    job_id = int(os.path.split(path)[1].split('.')[0].split('_')[-1])
+    incremental_ids(job_id, path)
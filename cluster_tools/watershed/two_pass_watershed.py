@@ -3,16 +3,17 @@
 import os
 import sys
 import json
+import shutil
 
 import luigi
 import numpy as np
-import vigra
 import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
-from cluster_tools.watershed.watershed import _ws_block, _get_bbs, _read_data, _apply_dt, _make_seeds, _make_hmap
+from cluster_tools.watershed.watershed import (_ws_block, _get_bbs, _read_data, _apply_dt,
+                                               _apply_watershed_with_seeds)
 
 
 #
@@ -45,7 +46,8 @@ class TwoPassWatershedBase(luigi.Task):
                        'sigma_weights': 2., 'halo': [0, 0, 0],
                        'channel_begin': 0, 'channel_end': None,
                        'agglomerate_channels': 'mean', 'alpha': 0.8,
-                       'invert_inputs': False, 'non_maximum_suppression': True})
+                       'invert_inputs': False, 'non_maximum_suppression': True,
+                       'dependency_scheduling': False, 'dependency_timeout': None})
         return config
 
     def _ws_pass(self, block_list, config, prefix):
@@ -88,6 +90,18 @@ class TwoPassWatershedBase(luigi.Task):
 
         blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
         block_lists = vu.make_checkerboard_block_lists(blocking, roi_begin, roi_end)
+
+        # with dependency scheduling, the jobs process the blocks of both passes and
+        # start a block of the second pass once the neighboring blocks are done
+        if ws_config.get('dependency_scheduling', False):
+            done_dir = os.path.join(self.tmp_folder, '%s_done' % self.task_name)
+            if os.path.exists(done_dir):
+                shutil.rmtree(done_dir)
+            os.makedirs(done_dir)
+            ws_config.update({'done_dir': done_dir, 'roi_begin': roi_begin, 'roi_end': roi_end})
+            self._ws_pass(block_lists[0] + block_lists[1], ws_config, 'dependencies')
+            return
+
         for pass_id, block_list in enumerate(block_lists):
             ws_config['pass'] = pass_id
             self._ws_pass(block_list, ws_config, 'pass_%i' % pass_id)
@@ -119,94 +133,6 @@ class TwoPassWatershedLSF(TwoPassWatershedBase, LSFTask):
 #
 
 
-def _apply_watershed_with_seeds(input_, dt, initial_seeds, config, mask, offset):
-    apply_2d = config.get('apply_ws_2d', True)
-    size_filter = config.get('size_filter', 25)
-    sigma_weights = config.get('sigma_weights', 2.)
-    alpha = config.get('alpha', 0.8)
-
-    # apply the watersheds in 2d
-    if apply_2d:
-        ws = np.zeros_like(input_, dtype='uint64')
-        for z in range(ws.shape[0]):
-
-            dtz = dt[z]
-            # get the initial seeds for this slice
-            # and a mask for the inital seeds
-            initial_seeds_z = initial_seeds[z]
-            initial_seed_mask = initial_seeds_z != 0
-            # don't place maxima at initial seeds
-            dtz[initial_seed_mask] = 0
-
-            seeds = _make_seeds(dtz, config)
-            # remove seeds in mask
-            if mask is not None:
-                seeds[mask[z]] = 0
-
-            # add offset to seeds
-            seeds[seeds != 0] += offset
-            # add initial seeds
-            seeds[initial_seed_mask] = initial_seeds_z[initial_seed_mask]
-
-            # we need to remap the seeds consecutively, because vigra
-            # watersheds can only handle uint32 seeds, and we WILL overflow uint32
-            seeds, _, old_to_new = vigra.analysis.relabelConsecutive(seeds,
-                                                                     start_label=1,
-                                                                     keep_zeros=True)
-            new_to_old = {new: old for old, new in old_to_new.items()}
-
-            # run watershed
-            hmap = _make_hmap(input_[z], dtz, alpha, sigma_weights)
-            wsz, max_id = vu.watershed(hmap, seeds=seeds, size_filter=size_filter,
-                                       exclude=initial_seeds_z)
-            wsz = wsz.astype('uint64')
-            # mask the result if we have a mask
-            if mask is not None:
-                wsz[mask[z]] = 0
-                inv_mask = np.logical_not(mask[z])
-                # NOTE we might not have any pixels in mask for 2d slice
-                max_id = int(wsz[inv_mask].max()) if inv_mask.sum() > 0 else 0
-
-            # increase the offset
-            offset += max_id
-            # map back to original ids
-            wsz = nt.takeDict(new_to_old, wsz)
-            ws[z] = wsz
-        #
-        return ws
-
-    # apply the watersheds in 3d
-    else:
-        # find seeds
-        seeds = _make_seeds(dt, config)
-        # remove seeds in mask
-        if mask is not None:
-            seeds[mask] = 0
-        seeds[seeds != 0] += offset
-
-        # add the initial seeds
-        initial_seed_mask = initial_seeds != 0
-        seeds[initial_seed_mask] = initial_seeds[initial_seed_mask]
-
-        # we need to remap the seeds consecutively, because vigra
-        # watersheds can only handle uint32 seeds, and we WILL overflow uint32
-        seeds, _, old_to_new = vigra.analysis.relabelConsecutive(seeds,
-                                                                 start_label=1,
-                                                                 keep_zeros=True)
-        new_to_old = {new: old for old, new in old_to_new.items()}
-
-        # run watershed
-        initial_seed_ids = np.unique(initial_seeds[initial_seed_mask])
-        hmap = _make_hmap(input_, dt, alpha, sigma_weights)
-        ws, max_id = vu.watershed(hmap, seeds=seeds, size_filter=size_filter,
-                                  exclude=initial_seed_ids)
-        ws = ws.astype('uint64')
-        ws = nt.takeDict(new_to_old, ws)
-        if mask is not None:
-            ws[mask] = 0
-        return ws
-
-
 def _ws_pass2(blocking, block_id, ds_in, ds_out, mask, config):
     fu.log("start processing block %i" % block_id)
 
@@ -243,7 +169,7 @@ def _ws_pass2(blocking, block_id, ds_in, ds_out, mask, config):
 
     # get offset to make new seeds unique between blocks
     # (we need to relabel later to make processing efficient !)
-    offset = block_id * np.prod(blocking.blockShape)
+    offset = int(block_id * np.prod(blocking.blockShape))
 
     # run watershed with initial seeds
     ws = _apply_watershed_with_seeds(input_, dt, initial_seeds, config, inv_mask, offset)
@@ -269,7 +195,6 @@ def two_pass_watershed(job_id, config_path):
         shape = shape[1:]
 
     block_shape = list(config['block_shape'])
-    block_list = config['block_list']
 
     # read the output config
     output_path = config['output_path']
@@ -277,7 +202,6 @@ def two_pass_watershed(job_id, config_path):
 
     # get the blocking
     blocking = nt.blocking([0, 0, 0], shape, block_shape)
-    pass_id = config['pass']
 
     # submit blocks
     with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
@@ -293,9 +217,25 @@ def two_pass_watershed(job_id, config_path):
         else:
             mask = None
 
-        ws_fu = _ws_block if pass_id == 0 else _ws_pass2
-        for block_id in block_list:
-            ws_fu(blocking, block_id, ds_in, ds_out, mask, config)
+        if config.get('dependency_scheduling', False):
+            # the blocks of the second pass depend on the neighboring blocks of the first pass
+            blocks_a, blocks_b = vu.make_checkerboard_block_lists(blocking, config['roi_begin'],
+                                                                  config['roi_end'])
+            blocks_b = set(blocks_b)
+            job_blocks_b = [block_id for block_id in config['block_list'] if block_id in blocks_b]
+            dependencies = vu.checkerboard_dependencies(blocking, blocks_a, job_blocks_b,
+                                                        config.get('halo', [0, 0, 0]))
+            fu.run_with_dependencies(config['block_list'], dependencies, config['done_dir'],
+                                     lambda block_id: _ws_block(blocking, block_id, ds_in,
+                                                                ds_out, mask, config),
+                                     lambda block_id: _ws_pass2(blocking, block_id, ds_in,
+                                                                ds_out, mask, config),
+                                     timeout=fu.dependency_timeout(config))
+        else:
+            pass_id = config['pass']
+            ws_fu = _ws_block if pass_id == 0 else _ws_pass2
+            for block_id in fu.iterate_blocks(config):
+                ws_fu(blocking, block_id, ds_in, ds_out, mask, config)
 
     # log success
     fu.log_job_success(job_id)
@@ -3,6 +3,8 @@
 import os
 import sys
 import json
+import shutil
+from concurrent import futures
 
 import luigi
 import numpy as np
@@ -19,6 +21,8 @@ except ImportError:
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
+from cluster_tools.watershed.incremental_ids import checksums_key, max_ids_folder
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
 
@@ -40,6 +44,13 @@ class WatershedBase(luigi.Task):
     output_key = luigi.Parameter()
     mask_path = luigi.Parameter(default='')
     mask_key = luigi.Parameter(default='')
+    # write consecutive ids per block and save the max id of each block,
+    # so that the blocks can be merged with `MergeOffsets` instead of a full relabeling
+    compact_ids = luigi.BoolParameter(default=False)
+    # only recompute the blocks whose input chunks have changed since the last run,
+    # using the labels of the other blocks as seeds; the new ids of each block are consecutive
+    # above the max id of the previous run and are made unique with `IncrementalIds`
+    incremental = luigi.BoolParameter(default=False)
 
     @staticmethod
     def default_task_config():
@@ -51,13 +62,38 @@ class WatershedBase(luigi.Task):
                        'sigma_weights': 2., 'halo': [0, 0, 0],
                        'channel_begin': 0, 'channel_end': None,
                        'agglomerate_channels': 'mean', 'alpha': 0.8,
-                       'invert_inputs': False, 'non_maximum_suppression': False})
+                       'invert_inputs': False, 'non_maximum_suppression': False,
+                       'chunk_cache_size': 0})
         return config
 
     def clean_up_for_retry(self, block_list):
         super().clean_up_for_retry(block_list)
         # TODO remove any output of failed blocks because it might be corrupted
 
+    def get_block_costs(self, block_list, job_prefix=None):
+        costs = super().get_block_costs(block_list, job_prefix)
+        # if we don't have runtimes from a previous run, estimate the costs from the mask
+        if costs is None and self.mask_path != '':
+            shape = vu.get_shape(self.input_path, self.input_key)
+            if len(shape) == 4:
+                shape = shape[1:]
+            block_shape = self.get_global_config()['block_shape']
+            costs = vu.mask_block_costs(self.mask_path, self.mask_key, shape,
+                                        block_shape, block_list)
+        return costs
+
+    @property
+    def changed_blocks_path(self):
+        """ Path to the list of blocks that were recomputed by an incremental run.
+        """
+        return os.path.join(self.tmp_folder, 'watershed_changed_blocks.json')
+
+    @property
+    def checksums_path(self):
+        """ Path to the input checksums of an incremental run, which are stored by `IncrementalIds`.
+        """
+        return os.path.join(self.tmp_folder, 'watershed_input_checksums.json')
+
     def run_impl(self):
         # get the global config and init configs
         shebang, block_shape, roi_begin, roi_end, block_list_path = self.global_config_values(True)
@@ -86,23 +122,62 @@ class WatershedBase(luigi.Task):
         if self.mask_path != '':
             assert self.mask_key != ''
             ws_config.update({'mask_path': self.mask_path, 'mask_key': self.mask_key})
+        if self.compact_ids:
+            # the merged offsets are given by the position of the block in the block list,
+            # which is only the block id if we process all blocks
+            assert block_list_path is None, "Compact ids are not supported for a block list"
+            assert roi_begin is None and roi_end is None, "Compact ids are not supported for a roi"
+            ws_config.update({'compact_ids': True,
+                              'max_ids_folder': os.path.join(self.tmp_folder, 'watershed_offsets')})
+        if self.incremental:
+            assert not self.compact_ids, "Compact ids are not supported for incremental watershed"
+            # the labels of the unchanged blocks are only used as seeds within the halo
+            assert sum(ws_config['halo']) > 0, "Incremental watershed needs a halo"
+            # the checksums of the input chunks of the previous run are stored next to the output;
+            # if the input chunks can't be checksummed, all blocks are recomputed
+            occupancy = vu.load_occupancy(self.input_path, self.input_key)
+            checksums = None if occupancy is None else occupancy.checksums()
+            prev_checksums = vu.read_checksums(self.output_path, checksums_key(self.output_key))
+            with vu.file_reader(self.output_path, 'r') as f:
+                # the new segments get ids above the max id of the previous run
+                id_offset = int(f[self.output_key].attrs.get('maxId', 0))
+            ws_config.update({'incremental': True, 'id_offset': id_offset,
+                              'changed_blocks_path': self.changed_blocks_path,
+                              'max_ids_folder': max_ids_folder(self.tmp_folder)})
 
         if self.n_retries == 0:
             block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
                                              block_list_path=block_list_path)
+            if self.incremental:
+                if checksums is not None and prev_checksums is not None:
+                    blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+                    block_list = vu.blocks_with_changed_chunks(occupancy, checksums, prev_checksums,
+                                                               blocking, block_list, ws_config['halo'])
+                # the changed blocks can be used as block list by the downstream tasks
+                with open(self.changed_blocks_path, 'w') as f:
+                    json.dump(block_list, f)
+                if checksums is not None:
+                    with open(self.checksums_path, 'w') as f:
+                        json.dump({'checksums': checksums,
+                                   'grid_shape': occupancy.grid_shape}, f)
+            if 'max_ids_folder' in ws_config:
+                # the max ids of a previous run that was not finished are removed
+                shutil.rmtree(ws_config['max_ids_folder'], ignore_errors=True)
+                os.makedirs(ws_config['max_ids_folder'])
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list)
         self._write_log('scheduling %i blocks to be processed' % len(block_list))
         n_jobs = min(len(block_list), self.max_jobs)
 
-        # prime and run the jobs
-        self.prepare_jobs(n_jobs, block_list, ws_config)
-        self.submit_jobs(n_jobs)
+        if n_jobs > 0:
+            # prime and run the jobs
+            self.prepare_jobs(n_jobs, block_list, ws_config)
+            self.submit_jobs(n_jobs)
 
-        # wait till jobs finish and check for job success
-        self.wait_for_jobs()
-        self.check_jobs(n_jobs)
+            # wait till jobs finish and check for job success
+            self.wait_for_jobs()
+            self.check_jobs(n_jobs)
 
 
 class WatershedLocal(WatershedBase, LocalTask):
@@ -130,6 +205,21 @@ class WatershedLSF(WatershedBase, LSFTask):
 # Implementation
 #
 
+def _distance_transform_2d(threshd):
+    """ Distance transform of the individual slices in one call.
+
+    The 3d distance transform is computed with a pitch along z that is larger than
+    any in-plane distance, so the nearest in-plane pixel is always closer than pixels
+    in other slices. This does not hold for slices without foreground, which are
+    transformed separately.
+    """
+    pitch_z = float(np.sqrt(threshd.shape[1] ** 2 + threshd.shape[2] ** 2)) + 1.
+    dt = vigra.filters.distanceTransform(threshd, pixel_pitch=(pitch_z, 1., 1.))
+    for z in np.where(threshd.reshape((threshd.shape[0], -1)).max(axis=1) == 0)[0]:
+        dt[z] = vigra.filters.distanceTransform(threshd[z])
+    return dt
+
+
 # apply the distance transform to the input
 def _apply_dt(input_, config):
     # threshold the input before distance transform
@@ -144,9 +234,7 @@ def _apply_dt(input_, config):
     apply_2d = config.get('apply_dt_2d', True)
     if apply_2d:
         assert pixel_pitch is None
-        dt = np.zeros_like(threshd, dtype='float32')
-        for z in range(dt.shape[0]):
-            dt[z] = vigra.filters.distanceTransform(threshd[z])
+        dt = _distance_transform_2d(threshd)
 
     else:
         dt = vigra.filters.distanceTransform(threshd) if pixel_pitch is None else\
@@ -202,8 +290,60 @@ def _make_seeds(dt, config):
     return seeds
 
 
+def _ws_slice(input_z, dt_z, seeds_z, mask_z, config):
+    sigma_weights = config.get('sigma_weights', 2.)
+    size_filter = config.get('size_filter', 25)
+    alpha = config.get('alpha', 0.8)
+
+    hmap = _make_hmap(input_z, dt_z, alpha, sigma_weights)
+    ws_z, max_id = vu.watershed(hmap, seeds=seeds_z, size_filter=size_filter)
+
+    # mask seeds if we have a mask
+    if mask_z is not None:
+        ws_z[np.logical_not(mask_z)] = 0
+        # NOTE we might have no pixels in the mask for this slice
+        max_id = int(ws_z[mask_z].max()) if mask_z.sum() > 0 else 0
+    return ws_z, max_id
+
+
+def _make_seeds_2d(dt, config):
+    """ Seeds for the individual slices, computed for all slices in one call.
+
+    Gives the same seeds as `_make_seeds` applied to each slice.
+    """
+    sigma_seeds = config.get('sigma_seeds', 2.)
+    apply_nonmax_suppression = config.get('non_maximum_suppression', True)
+    # non-maximum suppression is only available per slice
+    if apply_nonmax_suppression and nonMaximumDistanceSuppression is not None:
+        return np.concatenate([_make_seeds(dt_z, config)[None] for dt_z in dt], axis=0)
+
+    if sigma_seeds:
+        dt = vu.apply_filter(dt, 'gaussianSmoothing', sigma_seeds, apply_in_2d=True)
+
+    # find the local maxima of all slices in 3d, separating the slices with
+    # a value below the minimum, so the maxima and plateaus don't extend across slices;
+    # the 26-neighborhood restricted to a slice is the 8-neighborhood used by localMaxima in 2d
+    n_slices = dt.shape[0]
+    stacked = np.full((2 * n_slices - 1,) + dt.shape[1:], dt.min() - 1, dtype='float32')
+    stacked[::2] = dt
+    seeds = vigra.analysis.localMaxima3D(stacked, marker=np.nan, neighborhood=26,
+                                         allowAtBorder=True, allowPlateaus=True)
+    seeds = np.isnan(seeds)
+
+    # label the maxima in 3d, the separating slices are background
+    seeds = vigra.analysis.labelMultiArrayWithBackground(seeds.view('uint8'))[::2]
+
+    # the labels are assigned in scan order, so the labels of each slice are
+    # consecutive and we get the labels of the single slices by subtracting
+    # the max label of the previous slices
+    max_ids = seeds.reshape((n_slices, -1)).max(axis=1)
+    offsets = np.concatenate([[0], np.maximum.accumulate(max_ids)[:-1]]).astype(seeds.dtype)
+    seeds = np.where(seeds > 0, seeds - offsets[:, None, None], 0).astype('uint32')
+    return seeds
+
+
 # apply watershed
-def _apply_watershed(input_, dt, config, mask=None):
+def _apply_watershed(input_, dt, config, mask=None, pool=None):
     apply_2d = config.get('apply_ws_2d', True)
     sigma_weights = config.get('sigma_weights', 2.)
     size_filter = config.get('size_filter', 25)
@@ -211,26 +351,26 @@ def _apply_watershed(input_, dt, config, mask=None):
 
     # apply the watersheds in 2d
     if apply_2d:
+        # the slices are independent, so we can run them in parallel if we have a pool
+        masks = [None] * input_.shape[0] if mask is None else mask
+        seeds = _make_seeds_2d(dt, config)
+        if pool is None:
+            results = [_ws_slice(input_[z], dt[z], seeds[z], masks[z], config)
+                       for z in range(input_.shape[0])]
+        else:
+            tasks = [pool.submit(_ws_slice, input_[z], dt[z], seeds[z], masks[z], config)
+                     for z in range(input_.shape[0])]
+            results = [t.result() for t in tasks]
+
+        # offset the slices in order, so the ids don't depend on the number of threads
         ws = np.zeros_like(input_, dtype='uint32')
         offset = 0
-        for z in range(ws.shape[0]):
-            # run watershed for this slice
-            dtz = dt[z]
-            seeds = _make_seeds(dtz, config)
-            hmap = _make_hmap(input_[z], dtz, alpha, sigma_weights)
-            wsz, max_id = vu.watershed(hmap, seeds=seeds, size_filter=size_filter)
-
-            # mask seeds if we have a mask
+        for z, (ws_z, max_id) in enumerate(results):
             if mask is None:
-                wsz += offset
+                ws_z += offset
             else:
-                maskz = mask[z]
-                wsz[np.logical_not(maskz)] = 0
-                # NOTE we might have no pixels in the mask for this slice
-                max_id = int(wsz[maskz].max()) if maskz.sum() > 0 else 0
-                wsz[maskz] += offset
-
-            ws[z] = wsz
+                ws_z[masks[z]] += offset
+            ws[z] = ws_z
             offset += max_id
 
     # apply the watersheds in 3d
@@ -244,6 +384,95 @@ def _apply_watershed(input_, dt, config, mask=None):
     return ws
 
 
+def _to_consecutive(seeds):
+    """ Map the seeds to consecutive ids, because vigra watersheds can
+    only handle uint32 seeds and the seed ids WILL overflow uint32.
+
+    Returns the consecutive seeds and the sorted seed ids, which map the
+    consecutive ids back to the seed ids.
+    """
+    ids = np.unique(seeds)
+    # make sure that 0 is mapped to 0
+    if ids[0] != 0:
+        ids = np.concatenate([np.zeros(1, dtype=ids.dtype), ids])
+    return np.searchsorted(ids, seeds).astype('uint32'), ids
+
+
+def _seeded_watershed(hmap, seeds, initial_seed_ids, size_filter):
+    seeds, ids = _to_consecutive(seeds)
+    # the initial seeds must not be filtered by size
+    exclude = np.searchsorted(ids, initial_seed_ids)
+    ws, _ = vu.watershed(hmap, seeds=seeds, size_filter=size_filter, exclude=exclude)
+    # map back to the original ids
+    return ids[ws]
+
+
+def _apply_watershed_with_seeds(input_, dt, initial_seeds, config, mask, offset):
+    apply_2d = config.get('apply_ws_2d', True)
+    size_filter = config.get('size_filter', 25)
+    sigma_weights = config.get('sigma_weights', 2.)
+    alpha = config.get('alpha', 0.8)
+
+    # apply the watersheds in 2d
+    if apply_2d:
+        ws = np.zeros_like(input_, dtype='uint64')
+        for z in range(ws.shape[0]):
+
+            dtz = dt[z]
+            # get the initial seeds for this slice
+            # and a mask for the inital seeds
+            initial_seeds_z = initial_seeds[z]
+            initial_seed_mask = initial_seeds_z != 0
+            # don't place maxima at initial seeds
+            dtz[initial_seed_mask] = 0
+
+            seeds = _make_seeds(dtz, config).astype('uint64')
+            # remove seeds in mask
+            if mask is not None:
+                seeds[mask[z]] = 0
+            n_seeds = int(seeds.max())
+
+            # add offset to seeds
+            seeds[seeds != 0] += offset
+            # add initial seeds
+            seeds[initial_seed_mask] = initial_seeds_z[initial_seed_mask]
+
+            # run watershed
+            hmap = _make_hmap(input_[z], dtz, alpha, sigma_weights)
+            wsz = _seeded_watershed(hmap, seeds, np.unique(initial_seeds_z[initial_seed_mask]),
+                                    size_filter)
+            # mask the result if we have a mask
+            if mask is not None:
+                wsz[mask[z]] = 0
+
+            # increase the offset
+            offset += n_seeds
+            ws[z] = wsz
+        #
+        return ws
+
+    # apply the watersheds in 3d
+    else:
+        # find seeds
+        seeds = _make_seeds(dt, config).astype('uint64')
+        # remove seeds in mask
+        if mask is not None:
+            seeds[mask] = 0
+        seeds[seeds != 0] += offset
+
+        # add the initial seeds
+        initial_seed_mask = initial_seeds != 0
+        seeds[initial_seed_mask] = initial_seeds[initial_seed_mask]
+
+        # run watershed
+        initial_seed_ids = np.unique(initial_seeds[initial_seed_mask])
+        hmap = _make_hmap(input_, dt, alpha, sigma_weights)
+        ws = _seeded_watershed(hmap, seeds, initial_seed_ids, size_filter)
+        if mask is not None:
+            ws[mask] = 0
+        return ws
+
+
 def _get_bbs(blocking, block_id, config):
     # read the input config
     halo = list(config.get('halo', [0, 0, 0]))
@@ -277,22 +506,23 @@ def _read_data(ds_in, input_bb, config):
     return input_
 
 
-def _ws_block(blocking, block_id, ds_in, ds_out, mask, config):
-    fu.log("start processing block %i" % block_id)
-    input_bb, inner_bb, output_bb = _get_bbs(blocking, block_id,
-                                             config)
+def _read_ws_block(blocking, block_id, ds_in, mask, config):
+    input_bb, inner_bb, _ = _get_bbs(blocking, block_id, config)
     # get the mask and check if we have any pixels
     if mask is None:
         in_mask = None
     else:
         in_mask = mask[input_bb].astype('bool')
-        out_mask = in_mask[inner_bb]
-        if np.sum(out_mask) == 0:
-            fu.log_block_success(block_id)
-            return
-
+        if np.sum(in_mask[inner_bb]) == 0:
+            return None
     # read the input
     input_ = _read_data(ds_in, input_bb, config)
+    return input_, in_mask
+
+
+def _compute_ws_block(blocking, block_id, input_, in_mask, config, pool=None):
+    input_bb, inner_bb, output_bb = _get_bbs(blocking, block_id,
+                                             config)
     if in_mask is not None:
         # mask the input
         input_[np.logical_not(in_mask)] = 1
@@ -301,17 +531,24 @@ def _ws_block(blocking, block_id, ds_in, ds_out, mask, config):
     dt = _apply_dt(input_, config)
     # check if input was valid
     if dt is None:
-        fu.log_block_success(block_id)
-        return
+        return None
 
     # -> apply ws and write the results to the inner volume
-    ws = _apply_watershed(input_, dt, config, in_mask)
+    ws = _apply_watershed(input_, dt, config, in_mask, pool)
 
     # if we have a halo, we need to run connected components
     if output_bb != input_bb:
         ws = ws[inner_bb]
         ws = vigra.analysis.labelVolumeWithBackground(ws)
-        in_mask = in_mask[inner_bb]
+        if in_mask is not None:
+            in_mask = in_mask[inner_bb]
+
+    # make the ids consecutive in this block and save the max id,
+    # the block offsets are added after all blocks are done
+    if config.get('compact_ids', False):
+        ws, max_id, _ = vigra.analysis.relabelConsecutive(ws, start_label=1, keep_zeros=True)
+        fu.save_block_result(config['max_ids_folder'], block_id, int(max_id))
+        return ws.astype('uint64')
     ws = ws.astype('uint64')
 
     # get offset to make new seeds unique between blocks
@@ -321,10 +558,134 @@ def _ws_block(blocking, block_id, ds_in, ds_out, mask, config):
         ws += offset
     else:
         ws[in_mask] += offset
+    return ws
 
-    # write result and log block success
+
+def _read_initial_seeds(blocking, block_id, ds_out, changed_blocks, config):
+    # the labels of the blocks that are not recomputed are used as initial seeds;
+    # the recomputed blocks are not read, because they are written concurrently
+    input_bb, _, _ = _get_bbs(blocking, block_id, config)
+    initial_seeds = np.zeros(tuple(b.stop - b.start for b in input_bb), dtype='uint64')
+    ngb_ids = blocking.getBlockIdsOverlappingBoundingBox([b.start for b in input_bb],
+                                                         [b.stop for b in input_bb])
+    for ngb_id in ngb_ids:
+        if ngb_id in changed_blocks:
+            continue
+        ngb_bb = vu.block_to_bb(blocking.getBlock(ngb_id))
+        overlap = tuple(slice(max(b.start, nb.start), min(b.stop, nb.stop))
+                        for b, nb in zip(input_bb, ngb_bb))
+        if any(ov.stop <= ov.start for ov in overlap):
+            continue
+        local_bb = tuple(slice(ov.start - b.start, ov.stop - b.start)
+                         for ov, b in zip(overlap, input_bb))
+        initial_seeds[local_bb] = ds_out[overlap]
+    return initial_seeds
+
+
+def _compute_ws_block_incremental(blocking, block_id, input_, in_mask, initial_seeds, config):
+    _, inner_bb, _ = _get_bbs(blocking, block_id, config)
+    if in_mask is None:
+        inv_mask = None
+    else:
+        # mask the input
+        inv_mask = np.logical_not(in_mask)
+        input_[inv_mask] = 1
+
+    # apply distance transform
+    dt = _apply_dt(input_, config)
+    # check if input was valid
+    if dt is None:
+        return None
+
+    # the new seeds get ids above the max id of the previous run
+    id_offset = config['id_offset']
+    ws = _apply_watershed_with_seeds(input_, dt, initial_seeds, config, inv_mask, id_offset)
+    ws = ws[inner_bb]
+
+    # make the new ids consecutive in this block and record their number,
+    # the block offsets are added by `IncrementalIds` after all blocks are done
+    new_mask = ws > id_offset
+    new_ids, new_labels = np.unique(ws[new_mask], return_inverse=True)
+    ws[new_mask] = new_labels + id_offset + 1
+    fu.save_block_result(config['max_ids_folder'], block_id, len(new_ids))
+    return ws
+
+
+def _write_ws_block(blocking, block_id, ds_out, ws, config):
+    _, _, output_bb = _get_bbs(blocking, block_id, config)
     ds_out[output_bb] = ws
-    fu.log_block_success(block_id)
+
+
+def _ws_block(blocking, block_id, ds_in, ds_out, mask, config):
+    fu.log("start processing block %i" % block_id)
+    profile = fu.BlockProfile()
+    with profile.phase('read'):
+        data = _read_ws_block(blocking, block_id, ds_in, mask, config)
+    if data is None:
+        fu.log_block_success(block_id, profile)
+        return
+    profile.bytes_read += data[0].nbytes
+
+    with profile.phase('compute'):
+        ws = _compute_ws_block(blocking, block_id, data[0], data[1], config)
+    if ws is None:
+        fu.log_block_success(block_id, profile)
+        return
+
+    # write result and log block success
+    with profile.phase('write'):
+        _write_ws_block(blocking, block_id, ds_out, ws, config)
+    profile.bytes_written += ws.nbytes
+    fu.log_block_success(block_id, profile)
+
+
+def _iterate_blocks(config):
+    # blocks that are not computed have a max id of 0
+    folder = config.get('max_ids_folder', None)
+    for block_id in fu.iterate_blocks(config):
+        if folder is not None:
+            fu.save_block_result(folder, block_id, 0)
+        yield block_id
+
+
+def _ws(blocking, ds_in, ds_out, mask, config):
+    # the blocks are processed in parallel and the 2d watersheds of the slices
+    # are distributed to a pool shared by all blocks
+    n_threads = config.get('threads_per_job', 1)
+    slice_pool = futures.ThreadPoolExecutor(n_threads) if n_threads > 1 and\
+        config.get('apply_ws_2d', True) else None
+
+    # read the next blocks and write the results while computing the watersheds
+    pipeline = BlockPipeline(lambda block_id: _read_ws_block(blocking, block_id,
+                                                             ds_in, mask, config),
+                             lambda block_id, data: _compute_ws_block(blocking, block_id,
+                                                                      data[0], data[1], config,
+                                                                      slice_pool),
+                             lambda block_id, ws: _write_ws_block(blocking, block_id,
+                                                                  ds_out, ws, config),
+                             n_threads=n_threads)
+    pipeline.run(_iterate_blocks(config))
+    if slice_pool is not None:
+        slice_pool.shutdown()
+
+
+def _ws_incremental(blocking, ds_in, ds_out, mask, config):
+    with open(config['changed_blocks_path']) as f:
+        changed_blocks = set(json.load(f))
+
+    def _read(block_id):
+        data = _read_ws_block(blocking, block_id, ds_in, mask, config)
+        if data is None:
+            return None
+        return data + (_read_initial_seeds(blocking, block_id, ds_out, changed_blocks, config),)
+
+    pipeline = BlockPipeline(_read,
+                             lambda block_id, data: _compute_ws_block_incremental(blocking, block_id,
+                                                                                  *data, config),
+                             lambda block_id, ws: _write_ws_block(blocking, block_id,
+                                                                  ds_out, ws, config),
+                             n_threads=config.get('threads_per_job', 1))
+    pipeline.run(_iterate_blocks(config))
 
 
 def watershed(job_id, config_path):
@@ -341,7 +702,6 @@ def watershed(job_id, config_path):
         shape = shape[1:]
 
     block_shape = list(config['block_shape'])
-    block_list = config['block_list']
 
     # read the output config
     output_path = config['output_path']
@@ -350,8 +710,12 @@ def watershed(job_id, config_path):
     # get the blocking
     blocking = nt.blocking([0, 0, 0], shape, block_shape)
 
+    # if the blocks are read with a halo, we cache the chunks of the input
+    cache_size = config.get('chunk_cache_size', 0) if sum(config.get('halo', [0, 0, 0])) > 0 else 0
+
     # submit blocks
-    with vu.file_reader(input_path, 'r') as f_in, vu.file_reader(output_path) as f_out:
+    with vu.file_reader(input_path, 'r', cache_size=cache_size) as f_in,\
+            vu.file_reader(output_path) as f_out:
         ds_in = f_in[input_key]
         assert ds_in.ndim in (3, 4)
         ds_out = f_out[output_key]
@@ -363,8 +727,14 @@ def watershed(job_id, config_path):
             mask = vu.load_mask(mask_path, mask_key, shape)
         else:
             mask = None
-        for block_id in block_list:
-            _ws_block(blocking, block_id, ds_in, ds_out, mask, config)
+        # in incremental mode, the changed blocks are recomputed with seeds from the other blocks
+        if config.get('incremental', False):
+            _ws_incremental(blocking, ds_in, ds_out, mask, config)
+        else:
+            _ws(blocking, ds_in, ds_out, mask, config)
+
+        if cache_size > 0:
+            fu.log(f_in.cache.summary())
 
     # log success
     fu.log_job_success(job_id)
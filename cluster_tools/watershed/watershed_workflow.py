@@ -1,10 +1,15 @@
+import os
 import luigi
 
 from ..cluster_tasks import WorkflowBase
+from ..utils.volume_utils import get_shape
 from . import watershed as watershed_tasks
 from . import two_pass_watershed as two_pass_tasks
 from . import agglomerate as agglomerate_tasks
+from . import incremental_ids as incremental_ids_tasks
 from ..relabel import RelabelWorkflow
+from ..thresholded_components import merge_offsets as offset_tasks
+from .. import write as write_tasks
 
 
 class WatershedWorkflow(WorkflowBase):
@@ -16,14 +21,55 @@ class WatershedWorkflow(WorkflowBase):
     mask_key = luigi.Parameter(default='')
     two_pass = luigi.BoolParameter(default=False)
     agglomeration = luigi.BoolParameter(default=False)
+    # make the ids consecutive by merging the max ids of the blocks
+    # instead of relabeling the full volume (not supported for two-pass watershed,
+    # agglomeration or a roi)
+    compact_ids = luigi.BoolParameter(default=False)
+    # only recompute the watershed for the blocks whose input has changed since the last run;
+    # the other blocks keep their ids and the recomputed blocks get consecutive ids above
+    # the previous max id; the recomputed blocks are listed in 'watershed_changed_blocks.json'
+    # in the tmp folder; needs a halo, because the labels of the unchanged blocks are used as
+    # seeds within the halo
+    incremental = luigi.BoolParameter(default=False)
+
+    def _compact_ids(self, dep):
+        offset_task = getattr(offset_tasks,
+                              self._get_task_name('MergeOffsets'))
+        write_task = getattr(write_tasks,
+                             self._get_task_name('Write'))
+        shape = get_shape(self.input_path, self.input_key)
+        if len(shape) == 4:
+            shape = shape[1:]
+        offset_path = os.path.join(self.tmp_folder, 'watershed_offsets.json')
+        dep = offset_task(tmp_folder=self.tmp_folder,
+                          config_dir=self.config_dir,
+                          max_jobs=self.max_jobs,
+                          shape=shape, save_path=offset_path,
+                          save_prefix='watershed_offsets',
+                          dependency=dep)
+        # we only add the offsets in-place
+        dep = write_task(tmp_folder=self.tmp_folder,
+                         config_dir=self.config_dir,
+                         max_jobs=self.max_jobs,
+                         input_path=self.output_path, input_key=self.output_key,
+                         output_path=self.output_path, output_key=self.output_key,
+                         identifier='compact_watershed', offset_path=offset_path,
+                         dependency=dep)
+        return dep
 
     def requires(self):
+        # the agglomeration merges ids, so the max ids of the watershed blocks would leave gaps
+        assert not (self.compact_ids and self.agglomeration),\
+            "Compact ids are not supported for agglomeration"
         if self.two_pass:
+            assert not self.compact_ids, "Compact ids are not supported for two-pass watershed"
             ws_task = getattr(two_pass_tasks,
                               self._get_task_name('TwoPassWatershed'))
+            ws_kwargs = {}
         else:
             ws_task = getattr(watershed_tasks,
                               self._get_task_name('Watershed'))
+            ws_kwargs = {'compact_ids': self.compact_ids, 'incremental': self.incremental}
         dep = ws_task(tmp_folder=self.tmp_folder,
                       max_jobs=self.max_jobs,
                       config_dir=self.config_dir,
@@ -32,7 +78,21 @@ class WatershedWorkflow(WorkflowBase):
                       output_path=self.output_path,
                       output_key=self.output_key,
                       mask_path=self.mask_path,
-                      mask_key=self.mask_key)
+                      mask_key=self.mask_key,
+                      **ws_kwargs)
+
+        if self.incremental:
+            assert not self.two_pass and not self.agglomeration,\
+                "Incremental watershed is not supported for two-pass watershed or agglomeration"
+            ids_task = getattr(incremental_ids_tasks,
+                               self._get_task_name('IncrementalIds'))
+            dep = ids_task(tmp_folder=self.tmp_folder,
+                           max_jobs=self.max_jobs,
+                           config_dir=self.config_dir,
+                           output_path=self.output_path,
+                           output_key=self.output_key,
+                           dependency=dep)
+            return dep
 
         # run post-ws agglomeration if specified
         if self.agglomeration:
@@ -48,6 +108,9 @@ class WatershedWorkflow(WorkflowBase):
                                    output_key=self.output_key,
                                    have_ignore_label=self.mask_path != '')
 
+        if self.compact_ids:
+            return self._compact_ids(dep)
+
         dep = RelabelWorkflow(tmp_folder=self.tmp_folder,
                               max_jobs=self.max_jobs,
                               config_dir=self.config_dir,
@@ -65,5 +128,7 @@ class WatershedWorkflow(WorkflowBase):
         configs.update({'watershed': watershed_tasks.WatershedLocal.default_task_config(),
                         'two_pass_watershed': two_pass_tasks.TwoPassWatershedLocal.default_task_config(),
                         'agglomerate': agglomerate_tasks.AgglomerateLocal.default_task_config(),
+                        'merge_offsets': offset_tasks.MergeOffsetsLocal.default_task_config(),
+                        'incremental_ids': incremental_ids_tasks.IncrementalIdsLocal.default_task_config(),
                         **RelabelWorkflow.get_config()})
         return configs
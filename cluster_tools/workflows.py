@@ -3,7 +3,7 @@ import luigi
 
 from .cluster_tasks import WorkflowBase
 from .watershed import WatershedWorkflow
-from .graph import GraphWorkflow
+from .graph import GraphWorkflow, GraphAndFeaturesWorkflow
 
 # TODO more features and options to choose which features to choose
 from .features import EdgeFeaturesWorkflow
@@ -42,13 +42,31 @@ class ProblemWorkflow(WorkflowBase):
     compute_costs = luigi.BoolParameter(default=True)
     # do we run sanity checks ?
     sanity_checks = luigi.BoolParameter(default=False)
+    # do we extract the graph and the edge features in one pass over the watershed ?
+    single_pass = luigi.BoolParameter(default=False)
 
     # hard-coded keys
     graph_key = 's0/graph'
     features_key = 'features'
     costs_key = 's0/costs'
 
-    def requires(self):
+    def _graph_and_features(self):
+        if self.single_pass:
+            return GraphAndFeaturesWorkflow(tmp_folder=self.tmp_folder,
+                                            max_jobs=self.max_jobs,
+                                            config_dir=self.config_dir,
+                                            target=self.target,
+                                            dependency=self.dependency,
+                                            input_path=self.input_path,
+                                            input_key=self.input_key,
+                                            labels_path=self.ws_path,
+                                            labels_key=self.ws_key,
+                                            graph_path=self.problem_path,
+                                            graph_key=self.graph_key,
+                                            output_path=self.problem_path,
+                                            output_key=self.features_key,
+                                            max_jobs_merge=self.max_jobs_merge)
+
         dep = GraphWorkflow(tmp_folder=self.tmp_folder,
                             max_jobs=self.max_jobs,
                             config_dir=self.config_dir,
@@ -85,6 +103,10 @@ class ProblemWorkflow(WorkflowBase):
                                    output_path=self.problem_path,
                                    output_key=self.features_key,
                                    max_jobs_merge=self.max_jobs_merge)
+        return dep
+
+    def requires(self):
+        dep = self._graph_and_features()
         if self.compute_costs:
             dep = EdgeCostsWorkflow(tmp_folder=self.tmp_folder,
                                     max_jobs=self.max_jobs,
@@ -103,6 +125,7 @@ class ProblemWorkflow(WorkflowBase):
     def get_config():
         config = {**GraphWorkflow.get_config(),
                   **EdgeFeaturesWorkflow.get_config(),
+                  **GraphAndFeaturesWorkflow.get_config(),
                   **EdgeCostsWorkflow.get_config()}
         return config
 
@@ -139,6 +162,8 @@ class SegmentationWorkflowBase(WorkflowBase):
     two_pass_ws = luigi.BoolParameter(default=False)
     # run some sanity checks for intermediate results
     sanity_checks = luigi.BoolParameter(default=False)
+    # extract graph and edge features in one pass
+    single_pass_problem = luigi.BoolParameter(default=False)
 
     # hard-coded keys
     graph_key = 's0/graph'
@@ -174,7 +199,8 @@ class SegmentationWorkflowBase(WorkflowBase):
                               problem_path=self.problem_path, rf_path=self.rf_path,
                               node_label_dict=self.node_label_dict,
                               max_jobs_merge=self.max_jobs_merge,
-                              compute_costs=compute_costs, sanity_checks=self.sanity_checks)
+                              compute_costs=compute_costs, sanity_checks=self.sanity_checks,
+                              single_pass=self.single_pass_problem)
         return dep
 
     def _write_tasks(self, dep, identifier):
@@ -4,7 +4,6 @@ import os
 import sys
 import json
 import pickle
-from concurrent import futures
 
 import luigi
 import numpy as np
@@ -12,6 +11,7 @@ import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
+from cluster_tools.utils.pipeline_utils import BlockPipeline
 from cluster_tools.utils.task_utils import DummyTask
 from cluster_tools.cluster_tasks import SlurmTask, LocalTask, LSFTask
 
@@ -36,7 +36,8 @@ class WriteBase(luigi.Task):
     # the key is optional, because the assignment can either be a
     # dense assignment table stored as n5 dataset
     # or a sparse table stored as pickled python map
-    assignment_path = luigi.Parameter()
+    # if no assignments are given, only the offsets are applied
+    assignment_path = luigi.Parameter(default='')
     assignment_key = luigi.Parameter(default=None)
     # the task we depend on
     dependency = luigi.TaskParameter(default=DummyTask())
@@ -52,7 +53,7 @@ class WriteBase(luigi.Task):
     def default_task_config():
         # we use this to get also get the common default config
         config = LocalTask.default_task_config()
-        config.update({'chunks': None})
+        config.update({'chunks': None, 'skip_empty_blocks': False})
         return config
 
     def clean_up_for_retry(self, block_list, prefix):
@@ -85,7 +86,9 @@ class WriteBase(luigi.Task):
         # check if input and output datasets are identical
         in_place = (self.input_path == self.output_path) and (self.input_key == self.output_key)
 
-        if self.assignment_key is None:
+        if self.assignment_path == '':
+            assert self.offset_path != '', "Need either assignments or offsets"
+        elif self.assignment_key is None:
             assert os.path.splitext(self.assignment_path)[-1] == '.pkl',\
                 "Assignments need to be pickled map if no key is given"
 
@@ -101,7 +104,11 @@ class WriteBase(luigi.Task):
 
         # get block list and jobs
         if self.n_retries == 0:
-            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end)
+            # don't schedule the blocks that are empty in the input
+            occupancy = vu.load_occupancy(self.input_path, self.input_key)\
+                if config.pop('skip_empty_blocks', False) else None
+            block_list = vu.blocks_in_volume(shape, block_shape, roi_begin, roi_end,
+                                             occupancy=occupancy)
         else:
             block_list = self.block_list
             self.clean_up_for_retry(block_list, self.identifier)
@@ -146,6 +153,8 @@ class WriteLSF(WriteBase, LSFTask):
 
 
 def _apply_node_labels(seg, node_labels):
+    if node_labels is None:
+        return seg
     # choose the appropriate mapping:
     # - 1d np.array -> just apply it
     # - 2d np.array -> extract the local dict and apply
@@ -166,24 +175,23 @@ def _apply_node_labels(seg, node_labels):
     return seg
 
 
-def _write_block_with_offsets(ds_in, ds_out, blocking, block_id,
-                              node_labels, offsets):
-    fu.log("start processing block %i" % block_id)
-    off = offsets[block_id]
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
+def _read_block(ds_in, blocking, block_id):
+    bb = vu.block_to_bb(blocking.getBlock(block_id))
     seg = ds_in[bb]
-
     # check if this block is empty and don't write if it is
-    mask = seg != 0
-    if np.sum(mask) == 0:
-        fu.log_block_success(block_id)
-        return
+    if np.sum(seg != 0) == 0:
+        return None
+    return seg
+
 
-    seg[mask] += off
-    seg = _apply_node_labels(seg, node_labels)
+def _write_block(ds_out, blocking, block_id, seg):
+    bb = vu.block_to_bb(blocking.getBlock(block_id))
     ds_out[bb] = seg
-    fu.log_block_success(block_id)
+
+
+def _apply_offset(seg, off):
+    seg[seg != 0] += off
+    return seg
 
 
 def _write_with_offsets(ds_in, ds_out, blocking, block_list,
@@ -195,35 +203,22 @@ def _write_with_offsets(ds_in, ds_out, blocking, block_list,
         offsets = offset_config['offsets']
         empty_blocks = offset_config['empty_blocks']
 
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        tasks = [tp.submit(_write_block_with_offsets, ds_in, ds_out,
-                           blocking, block_id, node_labels, offsets)
-                 for block_id in block_list if block_id not in empty_blocks]
-        [t.result() for t in tasks]
-
-
-def _write_block(ds_in, ds_out, blocking, block_id, node_labels):
-    fu.log("start processing block %i" % block_id)
-    block = blocking.getBlock(block_id)
-    bb = vu.block_to_bb(block)
-    seg = ds_in[bb]
-    # check if this block is empty and don't write if it is
-    if np.sum(seg != 0) == 0:
-        fu.log_block_success(block_id)
-        return
-
-    seg = _apply_node_labels(seg, node_labels)
-    ds_out[bb] = seg
-    fu.log_block_success(block_id)
+    block_list = [block_id for block_id in block_list if block_id not in empty_blocks]
+    pipeline = BlockPipeline(lambda block_id: _read_block(ds_in, blocking, block_id),
+                             lambda block_id, seg: _apply_node_labels(_apply_offset(seg, offsets[block_id]),
+                                                                      node_labels),
+                             lambda block_id, seg: _write_block(ds_out, blocking, block_id, seg),
+                             n_threads=n_threads, n_io_threads=n_threads)
+    pipeline.run(block_list)
 
 
 def _write(ds_in, ds_out, blocking, block_list,
            n_threads, node_labels):
-    with futures.ThreadPoolExecutor(n_threads) as tp:
-        tasks = [tp.submit(_write_block, ds_in, ds_out,
-                           blocking, block_id, node_labels)
-                 for block_id in block_list]
-        [t.result() for t in tasks]
+    pipeline = BlockPipeline(lambda block_id: _read_block(ds_in, blocking, block_id),
+                             lambda block_id, seg: _apply_node_labels(seg, node_labels),
+                             lambda block_id, seg: _write_block(ds_out, blocking, block_id, seg),
+                             n_threads=n_threads, n_io_threads=n_threads)
+    pipeline.run(block_list)
 
 
 def _load_assignments(path, key, n_threads):
@@ -258,8 +253,11 @@ def _load_assignments(path, key, n_threads):
     return node_labels
 
 
-def _write_maxlabel(output_path, output_key, node_labels):
-    if isinstance(node_labels, np.ndarray):
+def _write_maxlabel(output_path, output_key, node_labels, offset_path):
+    if node_labels is None:
+        with open(offset_path) as f:
+            max_id = int(json.load(f)['n_labels']) - 1
+    elif isinstance(node_labels, np.ndarray):
         max_id = int(node_labels.max())
     elif isinstance(node_labels, dict):
         max_id = int(np.max(list(node_labels.values())))
@@ -294,8 +292,11 @@ def write(job_id, config_path):
     # read node assignments
     assignment_path = config['assignment_path']
     assignment_key = config.get('assignment_key', None)
-    fu.log("loading node labels from %s" % assignment_path)
-    node_labels = _load_assignments(assignment_path, assignment_key, n_threads)
+    if assignment_path == '':
+        node_labels = None
+    else:
+        fu.log("loading node labels from %s" % assignment_path)
+        node_labels = _load_assignments(assignment_path, assignment_key, n_threads)
 
     offset_path = config.get('offset_path', None)
 
@@ -316,7 +317,7 @@ def write(job_id, config_path):
         # write the max-label
         # for job 0
         if job_id == 0:
-            _write_maxlabel(input_path, input_key, node_labels)
+            _write_maxlabel(input_path, input_key, node_labels, offset_path)
 
     else:
         # even if we do not write in-place, we might still write to the same output_file,
@@ -351,7 +352,7 @@ def write(job_id, config_path):
         # write the max-label
         # for job 0
         if job_id == 0:
-            _write_maxlabel(output_path, output_key, node_labels)
+            _write_maxlabel(output_path, output_key, node_labels, offset_path)
 
     fu.log_job_success(job_id)
 
@@ -146,6 +146,34 @@ class TestEdgeFeatures(unittest.TestCase):
         self._check_subresults()
         self._check_fullresults()
 
+    def test_filter_features_threaded(self):
+        from cluster_tools.features.block_edge_features import _accumulate_with_filters
+        from cluster_tools.utils.filter_utils import FilterBank
+        graph_block_prefix = os.path.join(self.input_path, 's0', 'sub_graphs', 'block_')
+        with z5py.File(self.input_path) as f:
+            shape = f[self.ws_key].shape
+        block_list = list(range(nt.blocking([0, 0, 0], list(shape), self.block_shape).numberOfBlocks))
+        filter_bank = FilterBank(['gaussianSmoothing', 'hessianOfGaussianEigenvalues'], [1., 2.])
+
+        # the threaded accumulation must give the same features as the serial one
+        results = []
+        for n_threads in (1, 4):
+            output_path = os.path.join(self.tmp_folder, 'features_%i.n5' % n_threads)
+            with z5py.File(output_path) as f:
+                f.require_group('blocks')
+            _accumulate_with_filters(self.input_path, self.input_key,
+                                     self.input_path, self.ws_key,
+                                     output_path, graph_block_prefix,
+                                     block_list, self.block_shape,
+                                     filter_bank, [2, 4, 4], 'mean',
+                                     n_threads=n_threads)
+            with z5py.File(output_path) as f:
+                g = f['blocks']
+                results.append({key: g[key][:] for key in g.keys()})
+        self.assertEqual(set(results[0].keys()), set(results[1].keys()))
+        for key, feats in results[0].items():
+            self.assertTrue(np.allclose(feats, results[1][key]))
+
 
 if __name__ == '__main__':
     unittest.main()
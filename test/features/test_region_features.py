@@ -80,9 +80,12 @@ class TestEdgeFeatures(unittest.TestCase):
         blocking = nt.blocking([0, 0, 0], dsi.shape, self.block_shape)
 
         f_feat = z5py.File(os.path.join(self.tmp_folder, 'region_features_tmp.n5'))
-        ds_feat = f_feat['block_feats']
+        ds_feat = f_feat['bucket_feats']
+        bucket_size = ds_feat.attrs['bucket_size']
+        n_buckets = ds_feat.shape[1]
 
         n_blocks = blocking.numberOfBlocks
+        self.assertEqual(ds_feat.shape[0], n_blocks)
         for block_id in range(n_blocks):
             # print("Checking block", block_id, "/", n_blocks)
             block = blocking.getBlock(block_id)
@@ -90,10 +93,16 @@ class TestEdgeFeatures(unittest.TestCase):
             inp = dsi[bb]
             seg = dsl[bb].astype('uint32')
 
-            # load the sub-result
-            chunk_id = tuple(beg // bs for beg, bs in zip(block.begin, self.block_shape))
-            res = ds_feat.read_chunk(chunk_id)
-            self.assertFalse(res is None)
+            # load the sub-results of all buckets
+            res = []
+            for bucket_id in range(n_buckets):
+                bucket_res = ds_feat.read_chunk((block_id, bucket_id))
+                if bucket_res is None:
+                    continue
+                bucket_res[::3] += bucket_id * bucket_size
+                res.append(bucket_res)
+            self.assertGreater(len(res), 0)
+            res = np.concatenate(res)
 
             # check that ids are correct
             ids = res[::3].astype('uint32')
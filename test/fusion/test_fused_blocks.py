@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import unittest
+import numpy as np
+from shutil import rmtree
+
+import luigi
+import z5py
+
+try:
+    from cluster_tools.fusion import FusedBlocksLocal
+except ImportError:
+    sys.path.append('../..')
+    from cluster_tools.fusion import FusedBlocksLocal
+
+
+class TestFusedBlocks(unittest.TestCase):
+    input_path = '/g/kreshuk/pape/Work/data/cluster_tools_test_data/test_data.n5'
+    input_key = 'volumes/groundtruth'
+
+    output_path = './tmp/fused.n5'
+
+    tmp_folder = './tmp'
+    config_folder = './tmp/configs'
+    target = 'local'
+
+    @staticmethod
+    def _mkdir(dir_):
+        try:
+            os.mkdir(dir_)
+        except OSError:
+            pass
+
+    def setUp(self):
+        self._mkdir(self.tmp_folder)
+        self._mkdir(self.config_folder)
+        global_config = FusedBlocksLocal.default_global_config()
+        global_config['shebang'] = '#! /g/kreshuk/pape/Work/software/conda/miniconda3/envs/cluster_env/bin/python'
+        global_config['block_shape'] = [10, 256, 256]
+        with open(os.path.join(self.config_folder, 'global.config'), 'w') as f:
+            json.dump(global_config, f)
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def test_block_store(self):
+        from cluster_tools.fusion.fused_blocks import BlockStore
+        path = os.path.join(self.tmp_folder, 'store.n5')
+        data = np.random.rand(32, 32, 32).astype('float32')
+        with z5py.File(path) as f:
+            f.create_dataset('data', data=data, chunks=(16, 16, 16))
+
+        store = BlockStore(data.shape, [[path, 'intermediate']])
+        ds = store.dataset(path, 'data')
+        inter = store.dataset(path, 'intermediate', mode='a')
+
+        bb = np.s_[0:16, 0:16, 0:20]
+        self.assertTrue(np.allclose(ds[bb], data[bb]))
+        n_bytes = store.profile.bytes_read
+        # reading a sub-region must not touch the file again
+        sub_bb = np.s_[2:10, 4:16, 3:5]
+        self.assertTrue(np.allclose(ds[sub_bb], data[sub_bb]))
+        self.assertEqual(store.profile.bytes_read, n_bytes)
+
+        # intermediates are only kept in memory
+        inter[bb] = 2 * data[bb]
+        self.assertTrue(np.allclose(inter[sub_bb], 2 * data[sub_bb]))
+        with z5py.File(path) as f:
+            self.assertFalse('intermediate' in f)
+        with self.assertRaises(RuntimeError):
+            inter[np.s_[0:20, 0:16, 0:20]]
+
+        # the next block starts with an empty store
+        store.next_block()
+        with self.assertRaises(RuntimeError):
+            inter[sub_bb]
+        store.close()
+
+    def _check_morphology(self, morpho_key):
+        from cluster_tools.morphology.merge_morphology import MergeMorphologyLocal
+        from cluster_tools.utils.task_utils import DummyTask
+        with z5py.File(self.input_path) as f:
+            seg = f[self.input_key][:]
+        ids, counts = np.unique(seg, return_counts=True)
+
+        task = MergeMorphologyLocal(tmp_folder=self.tmp_folder, config_dir=self.config_folder,
+                                    max_jobs=1, dependency=DummyTask(),
+                                    input_path=self.output_path, input_key=morpho_key,
+                                    output_path=self.output_path, output_key='morphology',
+                                    number_of_labels=int(ids[-1]) + 1, prefix='test')
+        ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+
+        with z5py.File(self.output_path) as f:
+            res = f['morphology'][:]
+        self.assertEqual(len(res), len(ids))
+        self.assertTrue(np.allclose(ids, res[:, 0]))
+        self.assertTrue(np.allclose(counts, res[:, 1]))
+
+    def test_fused_morphology_and_node_labels(self):
+        from cluster_tools.utils.task_utils import DummyTask
+        morpho_key = 'morphology_blocks'
+        stages = [{'task_name': 'block_morphology',
+                   'input_path': self.input_path, 'input_key': self.input_key,
+                   'output_path': self.output_path, 'output_key': morpho_key},
+                  {'task_name': 'block_node_labels',
+                   'ws_path': self.input_path, 'ws_key': self.input_key,
+                   'input_path': self.input_path, 'input_key': self.input_key,
+                   'output_path': self.output_path, 'output_key': 'label_overlaps'}]
+        task = FusedBlocksLocal(tmp_folder=self.tmp_folder, config_dir=self.config_folder,
+                                max_jobs=4, dependency=DummyTask(), stages=stages)
+        ret = luigi.build([task], local_scheduler=True)
+        self.assertTrue(ret)
+        self._check_morphology(morpho_key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,10 +13,10 @@ import nifty.graph.rag as nrag
 import nifty.distributed as ndist
 
 try:
-    from cluster_tools.graph import GraphWorkflow
+    from cluster_tools.graph import GraphWorkflow, GraphAndFeaturesWorkflow
 except ImportError:
     sys.path.append('../..')
-    from cluster_tools.graph import GraphWorkflow
+    from cluster_tools.graph import GraphWorkflow, GraphAndFeaturesWorkflow
 
 
 class TestGraph(unittest.TestCase):
@@ -125,6 +125,26 @@ class TestGraph(unittest.TestCase):
         self.assertEqual(rag.numberOfEdges, graph.numberOfEdges)
         self.assertTrue(np.allclose(rag.uvIds(), graph.uvIds()))
 
+    def _check_edge_block_index(self):
+        from cluster_tools.graph.map_edge_ids import blocks_in_edge_range
+        with z5py.File(self.output_path) as f:
+            index = f['s0/edge_block_index'][:]
+            # blocks without edges have an empty edge range
+            index = index[index[:, 1] <= index[:, 2]]
+            n_edges = f['graph'].attrs['numberOfEdges']
+            for block_id, min_edge, max_edge in index:
+                edge_ids = f['s0/sub_graphs/block_%i/edgeIds' % block_id][:]
+                self.assertEqual(edge_ids.min(), min_edge)
+                self.assertEqual(edge_ids.max(), max_edge)
+
+        # all edges in a range must be contained in the blocks of this range
+        block_ids = index[:, 0].tolist()
+        edge_begin, edge_end = n_edges // 4, n_edges // 2
+        blocks = blocks_in_edge_range(self.output_path, 0, block_ids, edge_begin, edge_end)
+        with z5py.File(self.output_path) as f:
+            edges = np.concatenate([f['s0/sub_graphs/block_%i/edgeIds' % block_id][:]
+                                    for block_id in blocks])
+        self.assertTrue(np.isin(np.arange(edge_begin, edge_end), edges).all())
 
     def test_graph(self):
         max_jobs = 8
@@ -139,6 +159,44 @@ class TestGraph(unittest.TestCase):
         self.assertTrue(ret)
         self._check_subresults()
         self._check_result()
+        self._check_edge_block_index()
+
+    def test_graph_and_features(self):
+        boundary_key = 'volumes/boundaries_float32'
+        features_path = './tmp/features.n5'
+        task_config = GraphAndFeaturesWorkflow.get_config()['graph_and_features']
+        task_config['ignore_label'] = False
+        with open(os.path.join(self.config_folder, 'graph_and_features.config'), 'w') as f:
+            json.dump(task_config, f)
+
+        ret = luigi.build([GraphAndFeaturesWorkflow(input_path=self.input_path,
+                                                    input_key=boundary_key,
+                                                    labels_path=self.input_path,
+                                                    labels_key=self.input_key,
+                                                    graph_path=self.output_path,
+                                                    graph_key='graph',
+                                                    output_path=features_path,
+                                                    output_key='features',
+                                                    config_dir=self.config_folder,
+                                                    tmp_folder=self.tmp_folder,
+                                                    target=self.target,
+                                                    max_jobs=8)], local_scheduler=True)
+        self.assertTrue(ret)
+        self._check_subresults()
+        self._check_result()
+
+        # check the features against nifty for the edges of the full graph
+        with z5py.File(self.input_path) as f:
+            seg = f[self.input_key][:]
+            inp = f[boundary_key][:]
+        rag = nrag.gridRag(seg, numberOfLabels=int(seg.max()) + 1)
+        expected = nrag.accumulateEdgeStandartFeatures(rag, inp, 0., 1.)
+        with z5py.File(features_path) as f:
+            features = f['features'][:]
+        self.assertEqual(features.shape, (rag.numberOfEdges, expected.shape[1] + 1))
+        # mean, min and max are merged exactly
+        for feat_id in (0, 2, 8):
+            self.assertTrue(np.allclose(features[:, feat_id], expected[:, feat_id]))
 
 
 if __name__ == '__main__':
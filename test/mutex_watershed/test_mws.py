@@ -130,6 +130,37 @@ class TestMws(unittest.TestCase):
         self.assertTrue(ret)
         self._check_result(with_mask=True)
 
+    def test_seg_state(self):
+        import nifty.tools as nt
+        from cluster_tools.mutex_watershed.two_pass_mws import (STATE_DATASETS, _state_path,
+                                                                _read_state, _write_state)
+        shape = (20, 64, 64)
+        block_shape = (10, 32, 32)
+        blocking = nt.blocking([0, 0, 0], list(shape), list(block_shape))
+        with z5py.File(_state_path(self.tmp_folder)) as f:
+            for key, dtype in STATE_DATASETS.items():
+                f.create_dataset(key, shape=shape, chunks=block_shape, dtype=dtype)
+
+            n_edges = 500
+            uvs = np.random.randint(1, 50, size=(n_edges, 2)).astype('uint64')
+            weights = np.random.rand(n_edges).astype('float32')
+            attractive = np.random.rand(n_edges) > .5
+            _write_state(f, blocking, 3, uvs, weights, attractive)
+
+            # we must get the same edges as with a search over all edges
+            seed_ids = np.unique(np.random.randint(1, 50, size=20)).astype('uint64')
+            edges, edge_weights, edge_attractive = _read_state(f, blocking, 3, seed_ids)
+            edge_mask = np.isin(uvs, seed_ids).all(axis=1)
+            expected = sorted(zip(map(tuple, uvs[edge_mask].tolist()),
+                                  weights[edge_mask].tolist(), attractive[edge_mask].tolist()))
+            res = sorted(zip(map(tuple, edges.tolist()),
+                             edge_weights.tolist(), edge_attractive.tolist()))
+            self.assertEqual(res, expected)
+
+            # blocks without state or without seed edges don't return anything
+            self.assertIsNone(_read_state(f, blocking, 2, seed_ids))
+            self.assertIsNone(_read_state(f, blocking, 3, np.array([100], dtype='uint64')))
+
 
 def add_full_offsets():
     from z5py.converter import convert_from_h5
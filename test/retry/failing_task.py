@@ -3,13 +3,14 @@
 import os
 import sys
 import json
+import time
 
 import luigi
 import nifty.tools as nt
 
 import cluster_tools.utils.volume_utils as vu
 import cluster_tools.utils.function_utils as fu
-from cluster_tools.cluster_tasks import LocalTask
+from cluster_tools.cluster_tasks import LocalTask, SlurmTask
 
 
 #
@@ -26,6 +27,8 @@ class FailingTaskBase(luigi.Task):
     output_path = luigi.Parameter()
     output_key = luigi.Parameter()
     shape = luigi.ListParameter()
+    # fail in a block that was claimed from the block queue partition of another job
+    fail_in_queue = luigi.BoolParameter(default=False)
 
     def clean_up_for_retry(self, block_list):
         # TODO does this work with the mixin pattern?
@@ -46,7 +49,7 @@ class FailingTaskBase(luigi.Task):
                               dtype='uint8')
 
         config.update({'output_path': self.output_path, 'output_key': self.output_key,
-                       'n_retries': self.n_retries,
+                       'n_retries': self.n_retries, 'fail_in_queue': self.fail_in_queue,
                        'block_shape': block_shape})
 
         if self.n_retries == 0:
@@ -71,9 +74,14 @@ class FailingTaskLocal(FailingTaskBase, LocalTask):
     pass
 
 
-def _failing_block(block_id, blocking, ds, n_retries):
-    # fail for odd block ids if we are in the first try
-    if n_retries == 0 and block_id % 2 == 1:
+class FailingTaskSlurm(FailingTaskBase, SlurmTask):
+    """ FailingTask on slurm cluster
+    """
+    pass
+
+
+def _failing_block(block_id, blocking, ds, fail):
+    if fail:
         raise RuntimeError("Fail")
     bb = vu.block_to_bb(blocking.getBlock(block_id))
     ds[bb] = 1
@@ -96,10 +104,24 @@ def failing_task(job_id, config_path):
                            roiEnd=list(shape),
                            blockShape=list(block_shape))
 
+    first_try = n_retries == 0
+    fail_in_queue = config.get('fail_in_queue', False)
+    # the other jobs start late, so that the first job claims batches from their partitions
+    if fail_in_queue and first_try and job_id > 0:
+        time.sleep(2)
+
+    n_claimed = 0
     with vu.file_reader(output_path) as f:
         ds = f[output_key]
-        for block_id in block_list:
-            _failing_block(block_id, blocking, ds, n_retries)
+        for block_id in fu.iterate_blocks(config):
+            # fail in the middle of the first batch claimed from another job in the first try
+            # or for odd block ids in the first try
+            if fail_in_queue:
+                n_claimed += block_id not in block_list
+                fail = first_try and job_id == 0 and n_claimed == 2
+            else:
+                fail = first_try and block_id % 2 == 1
+            _failing_block(block_id, blocking, ds, fail)
     fu.log_job_success(job_id)
 
 
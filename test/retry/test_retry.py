@@ -2,13 +2,14 @@ import os
 import sys
 import json
 import unittest
+from unittest import mock
 import numpy as np
 from shutil import rmtree
 
 import luigi
 import z5py
 
-from failing_task import FailingTaskLocal
+from failing_task import FailingTaskLocal, FailingTaskSlurm
 
 
 class TestRetry(unittest.TestCase):
@@ -41,18 +42,46 @@ class TestRetry(unittest.TestCase):
         except OSError:
             pass
 
-    def test_ws_2d(self):
-        max_jobs = 8
-        ret = luigi.build([FailingTaskLocal(output_path=self.output_path, output_key=self.output_key,
-                                            shape=self.shape,
-                                            config_dir=self.config_folder,
-                                            tmp_folder=self.tmp_folder,
-                                            max_jobs=max_jobs)], local_scheduler=True)
+    def _update_global_config(self, **kwargs):
+        config_path = os.path.join(self.config_folder, 'global.config')
+        with open(config_path) as f:
+            global_config = json.load(f)
+        global_config.update(kwargs)
+        with open(config_path, 'w') as f:
+            json.dump(global_config, f)
+
+    def test_ws_2d(self, task_cls=FailingTaskLocal, max_jobs=8, fail_in_queue=False):
+        ret = luigi.build([task_cls(output_path=self.output_path, output_key=self.output_key,
+                                    shape=self.shape,
+                                    config_dir=self.config_folder,
+                                    tmp_folder=self.tmp_folder,
+                                    max_jobs=max_jobs,
+                                    fail_in_queue=fail_in_queue)], local_scheduler=True)
         self.assertTrue(ret)
         with z5py.File(self.output_path) as f:
             data = f[self.output_key][:]
         self.assertTrue(np.allclose(data, 1))
 
+    def test_retry_inprocess(self):
+        self._update_global_config(local_executor='inprocess')
+        self.test_ws_2d()
+
+    # a job fails in a batch claimed from the partition of another job, which passes;
+    # the unprocessed blocks of the batch must still be retried
+    def test_retry_block_queue(self):
+        self._update_global_config(block_queue=True, block_queue_batch_size=4)
+        self.test_ws_2d(max_jobs=4, fail_in_queue=True)
+
+    # run with the fake sbatch and squeue from test/slurm_shim
+    def test_retry_slurm(self):
+        shim_dir = os.path.abspath(os.path.join(os.path.split(__file__)[0], '..', 'slurm_shim'))
+        # the environment is restored afterwards, so the fake commands don't leak into other tests
+        env = {'PATH': shim_dir + os.pathsep + os.environ['PATH'],
+               'FAKE_SLURM_DIR': os.path.abspath(os.path.join(self.tmp_folder, 'fake_slurm'))}
+        self._update_global_config(poll_interval=1, max_poll_interval=4)
+        with mock.patch.dict(os.environ, env):
+            self.test_ws_2d(FailingTaskSlurm)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import unittest
+from shutil import rmtree
+
+import numpy as np
+import h5py
+
+try:
+    import cluster_tools
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools
+
+
+class TestChunkCache(unittest.TestCase):
+    tmp_folder = './tmp'
+    path = './tmp/data.h5'
+    shape = (32, 64, 64)
+    chunks = (8, 16, 16)
+
+    def setUp(self):
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        self.data = np.random.rand(*self.shape).astype('float32')
+        with h5py.File(self.path, 'w') as f:
+            f.create_dataset('data', data=self.data, chunks=self.chunks)
+
+    def tearDown(self):
+        try:
+            rmtree(self.tmp_folder)
+        except OSError:
+            pass
+
+    def test_read(self):
+        from cluster_tools.utils.chunk_cache import CachedFile
+        with CachedFile(h5py.File(self.path, 'r'), 1024**2) as f:
+            ds = f['data']
+            bbs = [np.s_[:], np.s_[3:17, 5:40, 60:64], np.s_[7, 10:20, :],
+                   np.s_[..., 3], np.s_[-5:, :-3, 1:2], np.s_[4:4, :, :]]
+            for bb in bbs:
+                self.assertTrue(np.array_equal(ds[bb], self.data[bb]))
+            # strided access is forwarded to the dataset
+            self.assertTrue(np.array_equal(ds[::2, 1:7:3], self.data[::2, 1:7:3]))
+
+    def test_hits(self):
+        from cluster_tools.utils.chunk_cache import CachedFile
+        with CachedFile(h5py.File(self.path, 'r'), 1024**2) as f:
+            ds = f['data']
+            # two overlapping blocks: the second one only reads the chunks
+            # that are not covered by the first one
+            ds[0:8, 0:16, 0:20]
+            self.assertEqual(f.cache.misses, 2)
+            self.assertEqual(f.cache.hits, 0)
+            ds[0:8, 0:16, 12:32]
+            self.assertEqual(f.cache.misses, 2)
+            self.assertEqual(f.cache.hits, 2)
+
+    def test_eviction(self):
+        from cluster_tools.utils.chunk_cache import CachedFile
+        chunk_bytes = int(np.prod(self.chunks)) * 4
+        with CachedFile(h5py.File(self.path, 'r'), 2 * chunk_bytes) as f:
+            ds = f['data']
+            ds[0:8, 0:16, 0:48]
+            self.assertEqual(f.cache.n_bytes, 2 * chunk_bytes)
+            # the first chunk was evicted, the last one is still cached
+            ds[0:8, 0:16, 32:48]
+            self.assertEqual(f.cache.hits, 1)
+            ds[0:8, 0:16, 0:16]
+            self.assertEqual(f.cache.misses, 4)
+
+    def test_write(self):
+        from cluster_tools.utils.chunk_cache import CachedFile
+        with CachedFile(h5py.File(self.path, 'a'), 1024**2) as f:
+            ds = f['data']
+            ds[0:8, 0:16, 0:16]
+            ds[2:4, 2:4, 2:4] = 0
+            self.data[2:4, 2:4, 2:4] = 0
+            self.assertTrue(np.array_equal(ds[0:8, 0:16, 0:16], self.data[0:8, 0:16, 0:16]))
+
+    def test_nested_group(self):
+        from cluster_tools.utils.chunk_cache import CachedFile, CachedDataset
+        with h5py.File(self.path, 'a') as f:
+            f.create_dataset('a/b/data', data=self.data, chunks=self.chunks)
+        with CachedFile(h5py.File(self.path, 'r'), 1024**2) as f:
+            ds = f['a']['b']['data']
+            self.assertIsInstance(ds, CachedDataset)
+            self.assertTrue(np.array_equal(ds[3:17, 5:40], self.data[3:17, 5:40]))
+            # the dataset uses the same cached chunks when accessed by its path
+            misses = f.cache.misses
+            f['a/b/data'][3:17, 5:40]
+            self.assertEqual(f.cache.misses, misses)
+
+    def test_set_attribute(self):
+        from cluster_tools.utils.chunk_cache import CachedFile
+        with CachedFile(h5py.File(self.path, 'r'), 1024**2) as f:
+            ds = f['data']
+            # attributes that are not the wrapper's own are set on the dataset
+            ds.n_threads = 4
+            self.assertEqual(ds.ds.n_threads, 4)
+            self.assertNotIn('n_threads', vars(ds))
+
+
+if __name__ == '__main__':
+    unittest.main()
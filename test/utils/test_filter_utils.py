@@ -0,0 +1,85 @@
+import sys
+import unittest
+
+import numpy as np
+import vigra
+
+try:
+    import cluster_tools
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools
+
+
+class TestFilterUtils(unittest.TestCase):
+    filters = ['gaussianSmoothing', 'gaussianGradientMagnitude', 'laplacianOfGaussian',
+               'hessianOfGaussianEigenvalues', 'structureTensorEigenvalues']
+    sigmas = [1.6, 3.5]
+
+    def _input(self):
+        shape = (32, 64, 64)
+        return vigra.filters.gaussianSmoothing(np.random.rand(*shape).astype('float32'), 2.)
+
+    def test_filter_bank(self):
+        from cluster_tools.utils.filter_utils import FilterBank
+        input_ = self._input()
+        bank = FilterBank(self.filters, self.sigmas)
+        responses = bank(input_)
+        self.assertEqual(len(responses), len(self.filters) * len(self.sigmas))
+
+        response_id = 0
+        for filter_name in self.filters:
+            for sigma in self.sigmas:
+                response = responses[response_id]
+                response_id += 1
+                if filter_name == 'structureTensorEigenvalues':
+                    expected = vigra.filters.structureTensorEigenvalues(input_, sigma, .5 * sigma)
+                else:
+                    expected = getattr(vigra.filters, filter_name)(input_, sigma)
+                self.assertEqual(response.shape, expected.shape)
+                # the derived filters use finite differences instead of derivatives of gaussians,
+                # so they only agree approximately with the vigra filters
+                if filter_name == 'gaussianSmoothing':
+                    self.assertTrue(np.allclose(response, expected))
+                else:
+                    corr = np.corrcoef(response.ravel(), expected.ravel())[0, 1]
+                    self.assertGreater(corr, .9)
+
+    def test_second_derivatives(self):
+        from cluster_tools.utils.filter_utils import FilterBank
+        # the smoothing doesn't change the second derivatives of a quadratic function
+        _, y, x = np.meshgrid(np.arange(4), np.arange(48), np.arange(48), indexing='ij')
+        input_ = (y ** 2 + 3 * x ** 2 + x * y).astype('float32')
+        bank = FilterBank(['laplacianOfGaussian', 'hessianOfGaussianEigenvalues'], [1.],
+                          apply_in_2d=True)
+        laplacian, hessian_ev = bank(input_, np.s_[:, 8:40, 8:40])
+        self.assertTrue(np.allclose(laplacian, 8., atol=.05))
+        expected = np.linalg.eigvalsh(np.array([[2., 1.], [1., 6.]]))[::-1]
+        self.assertTrue(np.allclose(hessian_ev, expected, atol=.05))
+
+    def test_eigenvalues(self):
+        from cluster_tools.utils.filter_utils import _eigenvalues
+        for n_axes in (2, 3):
+            matrices = np.random.rand(256, n_axes, n_axes).astype('float32')
+            matrices = matrices + matrices.transpose((0, 2, 1))
+            # degenerate matrices with equal eigenvalues
+            matrices[:16] = 2 * np.eye(n_axes)
+            tensor = {(i, j): matrices[:, i, j] for i in range(n_axes) for j in range(i, n_axes)}
+            expected = np.linalg.eigvalsh(matrices)[:, ::-1]
+            self.assertTrue(np.allclose(_eigenvalues(tensor, n_axes), expected, atol=1e-4))
+
+    def test_filter_bank_crop(self):
+        from cluster_tools.utils.filter_utils import FilterBank
+        input_ = self._input()
+        bb = np.s_[4:28, 8:56, 8:57]
+        for apply_in_2d in (False, True):
+            expected = FilterBank(self.filters, self.sigmas, apply_in_2d=apply_in_2d)(input_)
+            # the cropped and threaded responses must agree with the full responses
+            responses = FilterBank(self.filters, self.sigmas, apply_in_2d=apply_in_2d,
+                                   n_threads=4)(input_, bb)
+            for res, exp in zip(responses, expected):
+                self.assertTrue(np.allclose(res, exp[bb]))
+
+
+if __name__ == '__main__':
+    unittest.main()
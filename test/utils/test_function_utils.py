@@ -3,6 +3,8 @@ import os
 import unittest
 from shutil import rmtree
 
+import numpy as np
+
 try:
     import cluster_tools
 except ImportError:
@@ -43,6 +45,87 @@ class TestFunctionUtils(unittest.TestCase):
         for li, lo in zip(lines[1:], out_lines):
             self.assertEqual(li, lo)
 
+    def test_ledger(self):
+        import cluster_tools.utils.function_utils as fu
+        from cluster_tools.utils.parse_utils import (read_ledgers_task, parse_jobs_ledger,
+                                                     parse_blocks_ledger, profile_summary)
+        ledger_prefix = os.path.join(self.tmp_dir, 'task_')
+        n_jobs = 3
+        for job_id in range(n_jobs):
+            os.environ[fu.LEDGER_ENV] = ledger_prefix + '%i.ledger' % job_id
+            fu.init_ledger()
+            for block_id in range(job_id, 12, n_jobs):
+                profile = fu.BlockProfile()
+                data = profile.read(np.zeros((10, 10), dtype='uint8'), np.s_[:5, :2])
+                with profile.phase('compute'):
+                    data = data.astype('uint32')
+                profile.write(np.zeros((10, 10), dtype='uint32'), np.s_[:5, :1], data[:, :1])
+                fu.log_block_success(block_id, profile)
+            # the last job fails
+            if job_id < n_jobs - 1:
+                fu.log_job_success(job_id)
+        del os.environ[fu.LEDGER_ENV]
+        fu.init_ledger()
+
+        ledgers = read_ledgers_task(ledger_prefix, n_jobs)
+        self.assertEqual(parse_jobs_ledger(ledgers), [0, 1])
+        self.assertTrue(np.array_equal(parse_blocks_ledger(ledgers), np.arange(12)))
+        records = ledgers[0]
+        self.assertTrue((records['end'] >= records['start']).all())
+        records = records[records['status'] == fu.BLOCK_DONE]
+        self.assertTrue((records['bytes_read'] == 10).all())
+        self.assertTrue((records['bytes_written'] == 20).all())
+
+        summary = profile_summary(ledgers)
+        self.assertEqual(summary['n_blocks'], 12)
+        self.assertEqual(summary['bytes_read'], 120)
+        self.assertGreater(summary['peak_rss'], 0)
+
+    def test_block_queue(self):
+        import json
+        from cluster_tools.utils.function_utils import iterate_blocks
+        queue_dir = os.path.join(self.tmp_dir, 'queue')
+        os.makedirs(os.path.join(queue_dir, 'pending'))
+        os.makedirs(os.path.join(queue_dir, 'claimed'))
+        n_batches, batch_size = 10, 3
+        for batch_id in range(n_batches):
+            with open(os.path.join(queue_dir, 'pending', 'batch_%08i.json' % batch_id), 'w') as f:
+                json.dump(list(range(batch_id * batch_size, (batch_id + 1) * batch_size)), f)
+
+        # two jobs claim blocks in an interleaved manner
+        job_a = iterate_blocks({'block_queue': queue_dir, 'block_queue_offset': 0})
+        job_b = iterate_blocks({'block_queue': queue_dir, 'block_queue_offset': 5})
+        blocks_a = [next(job_a)]
+        blocks_b = list(job_b)
+        blocks_a.extend(job_a)
+
+        self.assertEqual(blocks_a[:batch_size], [0, 1, 2])
+        self.assertEqual(blocks_b[:batch_size], [15, 16, 17])
+        all_blocks = sorted(blocks_a + blocks_b)
+        self.assertEqual(all_blocks, list(range(n_batches * batch_size)))
+        self.assertEqual(len(os.listdir(os.path.join(queue_dir, 'pending'))), 0)
+
+    def test_block_results(self):
+        from cluster_tools.utils.function_utils import save_block_result, load_block_results
+        save_block_result(self.tmp_dir, 3, 5)
+        save_block_result(self.tmp_dir, 11, 0)
+        # a retry overwrites the result of the block
+        save_block_result(self.tmp_dir, 3, 7)
+        self.assertEqual(load_block_results(self.tmp_dir), {3: 7, 11: 0})
+
+    def test_dependency_timeout(self):
+        from cluster_tools.utils.function_utils import run_with_dependencies
+        done_dir = os.path.join(self.tmp_dir, 'done')
+        os.makedirs(done_dir)
+        processed = []
+        # block 0 is done by this job, block 1 by another job that was killed
+        dependencies = {2: [0], 3: [0, 1]}
+        with self.assertRaises(RuntimeError):
+            run_with_dependencies([0, 2, 3], dependencies, done_dir,
+                                  processed.append, processed.append,
+                                  max_wait=.1, timeout=.5)
+        self.assertEqual(processed, [0, 2])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+import sys
+import unittest
+
+import numpy as np
+
+try:
+    import cluster_tools
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools
+
+
+class TestPartitionUtils(unittest.TestCase):
+    block_list = list(range(3, 103))
+    n_jobs = 7
+
+    def _check_partition(self, partition):
+        self.assertEqual(len(partition), self.n_jobs)
+        self.assertTrue(all(len(blocks) > 0 for blocks in partition))
+        all_blocks = sorted(block_id for blocks in partition for block_id in blocks)
+        self.assertEqual(all_blocks, self.block_list)
+
+    def test_round_robin(self):
+        from cluster_tools.utils.partition_utils import partition_blocks
+        partition = partition_blocks(self.block_list, self.n_jobs)
+        self._check_partition(partition)
+        self.assertEqual(partition[1], self.block_list[1::self.n_jobs])
+
+    def test_contiguous(self):
+        from cluster_tools.utils.partition_utils import partition_blocks
+        partition = partition_blocks(self.block_list, self.n_jobs, 'contiguous')
+        self._check_partition(partition)
+        sizes = [len(blocks) for blocks in partition]
+        self.assertLessEqual(max(sizes) - min(sizes), 1)
+        for blocks in partition:
+            self.assertEqual(blocks, list(range(blocks[0], blocks[-1] + 1)))
+
+    def _costs(self):
+        # most blocks are empty and cheap, some are expensive
+        costs = np.full(len(self.block_list), .05)
+        costs[40:60] = 10.
+        costs[80] = 5.
+        return costs
+
+    def test_balanced(self):
+        from cluster_tools.utils.partition_utils import partition_blocks
+        costs = self._costs()
+        partition = partition_blocks(self.block_list, self.n_jobs, 'balanced', costs)
+        self._check_partition(partition)
+        for blocks in partition:
+            self.assertEqual(blocks, list(range(blocks[0], blocks[-1] + 1)))
+        # the maximal job cost must be better than for equally sized jobs
+        cost_dict = dict(zip(self.block_list, costs))
+        max_cost = max(sum(cost_dict[block_id] for block_id in blocks) for blocks in partition)
+        partition_eq = partition_blocks(self.block_list, self.n_jobs, 'contiguous')
+        max_cost_eq = max(sum(cost_dict[block_id] for block_id in blocks) for blocks in partition_eq)
+        self.assertLess(max_cost, max_cost_eq)
+
+    def test_lpt(self):
+        from cluster_tools.utils.partition_utils import partition_blocks
+        costs = self._costs()
+        partition = partition_blocks(self.block_list, self.n_jobs, 'lpt', costs)
+        self._check_partition(partition)
+        cost_dict = dict(zip(self.block_list, costs))
+        job_costs = [sum(cost_dict[block_id] for block_id in blocks) for blocks in partition]
+        # lpt is within 4 / 3 of the optimum, which is bounded by the mean
+        self.assertLessEqual(max(job_costs), 4. / 3 * max(np.mean(job_costs), costs.max()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import sys
+import unittest
+
+import numpy as np
+
+try:
+    import cluster_tools
+except ImportError:
+    sys.path.append('../..')
+    import cluster_tools
+
+
+class TestBlockPipeline(unittest.TestCase):
+    def _check_pipeline(self, n_threads, n_io_threads=1):
+        from cluster_tools.utils.pipeline_utils import BlockPipeline
+        n_blocks = 25
+        inputs = {block_id: np.full(10, block_id) for block_id in range(n_blocks)}
+        outputs = {}
+
+        def read(block_id):
+            # odd blocks are empty
+            return None if block_id % 2 else inputs[block_id]
+
+        def compute(block_id, data):
+            # skip every fourth block after computing
+            return None if block_id % 4 == 0 else 2 * data
+
+        def write(block_id, result):
+            outputs[block_id] = result
+
+        pipeline = BlockPipeline(read, compute, write, n_threads=n_threads,
+                                 n_io_threads=n_io_threads)
+        pipeline.run(block_id for block_id in range(n_blocks))
+
+        expected = [block_id for block_id in range(n_blocks) if block_id % 2 == 0 and block_id % 4 != 0]
+        self.assertEqual(sorted(outputs.keys()), expected)
+        for block_id in expected:
+            self.assertTrue(np.array_equal(outputs[block_id], 2 * inputs[block_id]))
+
+    def test_pipeline(self):
+        self._check_pipeline(1)
+
+    def test_pipeline_threaded(self):
+        self._check_pipeline(4, n_io_threads=4)
+
+    def test_errors(self):
+        from cluster_tools.utils.pipeline_utils import BlockPipeline
+
+        def compute(block_id, data):
+            if block_id == 3:
+                raise RuntimeError("block failed")
+            return data
+
+        pipeline = BlockPipeline(lambda block_id: block_id, compute, lambda block_id, data: None)
+        with self.assertRaises(RuntimeError):
+            pipeline.run(range(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
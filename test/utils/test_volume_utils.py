@@ -51,6 +51,136 @@ class TestVolumeUtil(unittest.TestCase):
         with file_reader(path) as f:
             _test_io(f)
 
+    def test_occupancy(self):
+        from cluster_tools.utils.volume_utils import file_reader, load_occupancy, blocks_in_volume
+        shape = (32, 64, 64)
+        block_shape = (16, 32, 32)
+        for ext in ('n5', 'zr', 'h5'):
+            path = os.path.join(self.tmp_dir, 'b.%s' % ext)
+            with file_reader(path) as f:
+                ds = f.create_dataset('data', shape=shape, chunks=(8, 16, 16), dtype='uint8')
+                ds[0:8, 32:48, 0:16] = 1
+                ds[20, 60, 60] = 1
+
+            occupancy = load_occupancy(path, 'data')
+            self.assertTrue(occupancy.is_empty(np.s_[0:16, 0:32, 0:32]))
+            self.assertFalse(occupancy.is_empty(np.s_[0:16, 32:64, 0:32]))
+            block_list = blocks_in_volume(shape, block_shape, occupancy=occupancy)
+            self.assertEqual(block_list, [2, 7])
+
+            # check the blocks of the downscaled volume
+            occupancy = load_occupancy(path, 'data', scale_factor=2)
+            self.assertFalse(occupancy.is_empty(np.s_[0:8, 16:32, 0:16]))
+            self.assertTrue(occupancy.is_empty(np.s_[0:8, 0:16, 0:16]))
+
+    def test_changed_blocks(self):
+        from nifty.tools import blocking
+        from cluster_tools.utils.volume_utils import (file_reader, load_occupancy,
+                                                      blocks_with_changed_chunks,
+                                                      write_checksums, read_checksums)
+        shape = (32, 64, 64)
+        blocks = blocking([0, 0, 0], list(shape), [16, 32, 32])
+        block_list = list(range(blocks.numberOfBlocks))
+        for ext in ('n5', 'h5'):
+            path = os.path.join(self.tmp_dir, 'c.%s' % ext)
+            with file_reader(path) as f:
+                f.create_dataset('data', data=np.random.rand(*shape).astype('float32'),
+                                 chunks=(8, 16, 16))
+            checksums = load_occupancy(path, 'data').checksums()
+            self.assertEqual(len(checksums), 64)
+
+            with file_reader(path) as f:
+                f['data'][10, 40, 5] = 2.
+            occupancy = load_occupancy(path, 'data')
+            new_checksums = occupancy.checksums()
+            self.assertEqual(blocks_with_changed_chunks(occupancy, new_checksums, checksums,
+                                                        blocks, block_list), [2])
+            # the blocks with halo also overlap the changed chunk
+            self.assertEqual(blocks_with_changed_chunks(occupancy, new_checksums, checksums,
+                                                        blocks, block_list, [0, 16, 16]), [0, 2])
+            self.assertEqual(blocks_with_changed_chunks(occupancy, new_checksums, new_checksums,
+                                                        blocks, block_list), [])
+
+            # the checksums can be stored and loaded
+            self.assertIsNone(read_checksums(path, 'checksums'))
+            write_checksums(path, 'checksums', new_checksums, occupancy.grid_shape)
+            self.assertEqual(read_checksums(path, 'checksums'), new_checksums)
+
+    def test_checkerboard(self):
+        from nifty.tools import blocking
+        from cluster_tools.utils.volume_utils import (make_checkerboard_block_lists,
+                                                      checkerboard_dependencies)
+        # odd number of blocks per axis
+        blocks = blocking([0, 0, 0], [50, 70, 90], [10, 20, 20])
+        blocks_a, blocks_b = make_checkerboard_block_lists(blocks)
+        self.assertEqual(len(blocks_a) + len(blocks_b), blocks.numberOfBlocks)
+        self.assertIn(0, blocks_a)
+
+        # face neighbors must be in the other list
+        blocks_a = set(blocks_a)
+        for block_id in range(blocks.numberOfBlocks):
+            for axis in range(3):
+                for lower in (False, True):
+                    ngb_id = blocks.getNeighborId(block_id, axis, lower)
+                    if ngb_id != -1:
+                        self.assertNotEqual(block_id in blocks_a, ngb_id in blocks_a)
+
+        # the second pass blocks depend on their face neighbors and the
+        # blocks in the halo, which are all in the first pass
+        dependencies = checkerboard_dependencies(blocks, blocks_a, blocks_b, [0, 4, 4])
+        for block_id in blocks_b:
+            deps = dependencies[block_id]
+            self.assertTrue(all(dep in blocks_a for dep in deps))
+            ngbs = [blocks.getNeighborId(block_id, axis, lower)
+                    for axis in range(3) for lower in (False, True)]
+            self.assertEqual(set(deps), set(ngb for ngb in ngbs if ngb != -1))
+
+    def test_normalize(self):
+        from cluster_tools.utils.volume_utils import normalize
+        data = np.random.randint(0, 255, size=(3, 32, 32)).astype('uint8')
+        expected = normalize(data)
+        self.assertEqual(expected.dtype, np.dtype('float32'))
+        self.assertAlmostEqual(float(expected.min()), 0.)
+        self.assertAlmostEqual(float(expected.max()), 1.)
+
+        # normalize into a buffer and in-place
+        out = np.zeros(data.shape, dtype='float32')
+        res = normalize(data, out=out)
+        self.assertIs(res, out)
+        self.assertTrue(np.allclose(out, expected))
+        out = data.astype('float32')
+        normalize(out, out=out)
+        self.assertTrue(np.allclose(out, expected))
+
+    def test_size_filter(self):
+        import vigra
+        from cluster_tools.utils.volume_utils import apply_size_filter
+        shape = (16, 64, 64)
+        input_ = vigra.filters.gaussianSmoothing(np.random.rand(*shape).astype('float32'), 1.)
+        seeds = np.zeros(shape, dtype='uint32')
+        seed_pos = tuple(np.random.randint(0, sh, size=200) for sh in shape)
+        seeds[seed_pos] = np.arange(1, 201)
+        seg, _ = vigra.analysis.watershedsNew(input_, seeds=seeds)
+
+        size_filter = 100
+        for exclude in (None, np.array([1, 2, 3])):
+            # the expected result with a watershed on the full volume
+            ids, sizes = np.unique(seg, return_counts=True)
+            filter_ids = ids[sizes < size_filter]
+            if exclude is not None:
+                filter_ids = filter_ids[np.logical_not(np.isin(filter_ids, exclude))]
+            self.assertGreater(len(filter_ids), 0)
+            expected = seg.copy()
+            expected[np.isin(expected, filter_ids)] = 0
+            expected, expected_max_id = vigra.analysis.watershedsNew(input_, seeds=expected)
+
+            # refill per region and in the bounding box of all regions
+            for max_regions in (seg.size, 0):
+                res, max_id = apply_size_filter(seg.copy(), input_, size_filter, exclude,
+                                                max_regions=max_regions)
+                self.assertEqual(max_id, expected_max_id)
+                self.assertTrue(np.array_equal(res, expected))
+
     def test_interpol_volume(self):
         from cluster_tools.utils.volume_utils import InterpolatedVolume
         big_shape = (100, 1000, 1000)
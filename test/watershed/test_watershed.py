@@ -69,7 +69,7 @@ class TestWatershed(unittest.TestCase):
         ids1 = np.unique(res_cc)
         self.assertEqual(len(ids0), len(ids1))
 
-    def _run_ws(self, two_pass):
+    def _run_ws(self, two_pass, compact_ids=False, agglomeration=False):
         max_jobs = 8
         task = WatershedWorkflow(input_path=self.input_path,
                                  input_key=self.input_key,
@@ -79,7 +79,9 @@ class TestWatershed(unittest.TestCase):
                                  tmp_folder=self.tmp_folder,
                                  target=self.target,
                                  max_jobs=max_jobs,
-                                 two_pass=two_pass)
+                                 two_pass=two_pass,
+                                 compact_ids=compact_ids,
+                                 agglomeration=agglomeration)
         ret = luigi.build([task], local_scheduler=True)
         return ret
 
@@ -103,6 +105,123 @@ class TestWatershed(unittest.TestCase):
     def test_ws_2d_two_pass(self):
         self._test_ws_2d(True)
 
+    def test_ws_2d_threaded(self):
+        from concurrent import futures
+        from cluster_tools.watershed.watershed import _apply_dt, _apply_watershed
+        with z5py.File(self.input_path) as f:
+            input_ = f[self.input_key][1:3, :10, :256, :256].mean(axis=0)
+        config = WatershedLocal.default_task_config()
+        mask = np.ones(input_.shape, dtype='bool')
+        mask[:, :64] = False
+
+        # the threaded watershed must produce the same ids as the serial one
+        dt = _apply_dt(input_, config)
+        for this_mask in (None, mask):
+            expected = _apply_watershed(input_, dt, config, this_mask)
+            with futures.ThreadPoolExecutor(4) as pool:
+                res = _apply_watershed(input_, dt, config, this_mask, pool)
+            self.assertTrue(np.array_equal(res, expected))
+
+    def test_ws_2d_batched(self):
+        from cluster_tools.watershed.watershed import (_distance_transform_2d, _make_seeds,
+                                                       _make_seeds_2d)
+        with z5py.File(self.input_path) as f:
+            input_ = f[self.input_key][1:3, :10, :256, :256].mean(axis=0)
+        threshd = (input_ > .25).astype('uint32')
+        # add a slice without foreground
+        threshd[3] = 0
+
+        # check the batched distance transform against the per-slice one
+        dt = _distance_transform_2d(threshd)
+        expected = np.concatenate([vigra.filters.distanceTransform(tz)[None]
+                                   for tz in threshd], axis=0)
+        self.assertTrue(np.allclose(dt, expected))
+
+        # check the batched seeds against the per-slice seeds,
+        # without non-maximum suppression, which is always applied per slice
+        config = WatershedLocal.default_task_config()
+        config['non_maximum_suppression'] = False
+        for sigma_seeds in (config['sigma_seeds'], 0.):
+            config['sigma_seeds'] = sigma_seeds
+            seeds = _make_seeds_2d(dt, config)
+            expected = np.concatenate([_make_seeds(dtz, config)[None] for dtz in dt], axis=0)
+            self.assertTrue(np.array_equal(seeds, expected))
+
+    def test_ws_compact_ids(self):
+        config = WatershedLocal.default_task_config()
+        config['halo'] = [0, 32, 32]
+        with open(os.path.join(self.config_folder, 'watershed.config'), 'w') as f:
+            json.dump(config, f)
+        ret = self._run_ws(False, compact_ids=True)
+        self.assertTrue(ret)
+        self._check_result()
+
+        # the ids must be consecutive without a relabeling of the full volume
+        with z5py.File(self.output_path) as f:
+            ds = f[self.output_key]
+            ids = np.unique(ds[:])
+            max_id = ds.attrs['maxId']
+        self.assertTrue(np.array_equal(ids, np.arange(1, max_id + 1)))
+
+    def test_ws_agglomeration(self):
+        from cluster_tools.watershed.agglomerate import AgglomerateLocal
+        config = AgglomerateLocal.default_task_config()
+        config['threads_per_job'] = 4
+        with open(os.path.join(self.config_folder, 'agglomerate.config'), 'w') as f:
+            json.dump(config, f)
+        ret = self._run_ws(False, agglomeration=True)
+        self.assertTrue(ret)
+        self._check_result()
+
+    def test_ws_incremental(self):
+        config = WatershedLocal.default_task_config()
+        config['halo'] = [0, 32, 32]
+        with open(os.path.join(self.config_folder, 'watershed.config'), 'w') as f:
+            json.dump(config, f)
+
+        # copy the input, so that we can change it
+        input_path = os.path.join(self.tmp_folder, 'input.n5')
+        with z5py.File(self.input_path) as f:
+            ds = f[self.input_key]
+            input_ = ds[1:3]
+        with z5py.File(input_path) as f:
+            f.create_dataset('data', data=input_, chunks=(1, 10, 64, 64))
+
+        def _run(tmp_folder):
+            task = WatershedWorkflow(input_path=input_path, input_key='data',
+                                     output_path=self.output_path, output_key=self.output_key,
+                                     config_dir=self.config_folder, tmp_folder=tmp_folder,
+                                     target=self.target, max_jobs=8, incremental=True)
+            self.assertTrue(luigi.build([task], local_scheduler=True))
+            with open(os.path.join(tmp_folder, 'watershed_changed_blocks.json')) as f:
+                return json.load(f)
+
+        # the first run computes all blocks
+        n_blocks = len(_run(os.path.join(self.tmp_folder, 'run0')))
+        with z5py.File(self.output_path) as f:
+            ds = f[self.output_key]
+            seg = ds[:]
+            max_id = ds.attrs['maxId']
+        # all blocks are new, so the ids are consecutive
+        self.assertTrue(np.array_equal(np.unique(seg[seg != 0]), np.arange(1, max_id + 1)))
+
+        # change the input in one chunk and check that only the block of this chunk is recomputed
+        with z5py.File(input_path) as f:
+            f['data'][:, 2:4, 10:20, 10:20] = 1.
+        changed_blocks = _run(os.path.join(self.tmp_folder, 'run1'))
+        self.assertEqual(changed_blocks, [0])
+        self.assertGreater(n_blocks, 1)
+        with z5py.File(self.output_path) as f:
+            ds = f[self.output_key]
+            new_seg = ds[:]
+            new_max_id = ds.attrs['maxId']
+        self.assertGreaterEqual(new_max_id, max_id)
+        self.assertFalse(0 in new_seg)
+        self.assertTrue(np.array_equal(new_seg[:, 256:, 256:], seg[:, 256:, 256:]))
+        # the new ids are consecutive above the previous max id
+        new_ids = np.unique(new_seg[new_seg > max_id])
+        self.assertTrue(np.array_equal(new_ids, np.arange(max_id + 1, new_max_id + 1)))
+
     def _test_ws_3d(self, two_pass):
         config = WatershedLocal.default_task_config()
         config['apply_presmooth_2d'] = False